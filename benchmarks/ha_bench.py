@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""Benchmark the OpenLab HA data layer against synthetic /ha trees.
+
+Every operation is run on trees of the requested sizes. For each of them the
+runner reports the wall time, the ZooKeeper requests, round trips and bytes
+it costs, and the peak memory it allocates, then prints all the results as
+JSON so that they can be compared between commits.
+
+The requests, round trips and bytes are counted by the memory backend only,
+they're null when running against a real ZooKeeper.
+
+Examples:
+
+    ./benchmarks/ha_bench.py --nodes 10,100,1000 --latency-ms 1
+    ./benchmarks/ha_bench.py --backend kazoo --hosts localhost:2181/bench
+
+WARNING: the kazoo backend deletes /ha and /ha-index on the given hosts,
+point it to a scratch ensemble or a chroot.
+"""
+import argparse
+import configparser
+import json
+import logging
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Run from a checkout, the packages don't need to be installed.
+sys.path[:0] = [os.path.join(ROOT, 'openlabcmd'),
+                os.path.join(ROOT, 'ha_healthchecker')]
+
+from openlabcmd import backend  # noqa: E402
+from openlabcmd import zk  # noqa: E402
+
+try:
+    from ha_healthchecker.action import fixer
+    from ha_healthchecker.action import refresher
+    from ha_healthchecker.action import switcher
+    from ha_healthchecker import snapshot
+except ImportError:
+    fixer = refresher = switcher = snapshot = None
+
+
+LOG = logging.getLogger("OpenLab HA Benchmark")
+
+STATS_KEYS = ['round_trips', 'get', 'get_children', 'exists', 'create',
+              'set', 'delete', 'multi', 'bytes_read', 'bytes_written']
+
+
+class BenchClusterConfig(object):
+    """The ClusterConfig of the healthchecker, without the log file setup."""
+
+    def __init__(self, zk_client):
+        for attr, value in zk_client.list_configuration().items():
+            setattr(self, attr, value)
+        self.LOG = LOG
+
+
+def _local(action_class):
+    # The probes of the local host are the only part of the cycle which
+    # isn't about the HA data, they report every service and node as up.
+    class LocalAction(action_class):
+        def _get_services_states(self, services, down_level=None,
+                                 restarts=True):
+            return dict((service, ('up', 0)) for service in services)
+
+        def _ping(self, ipaddr):
+            return True
+
+        def _is_serving(self, ipaddr):
+            return True
+
+    return LocalAction
+
+
+class Bench(object):
+    def __init__(self, args, node_count):
+        self.args = args
+        self.node_count = node_count
+        self.store = None
+        self.zk = None
+        self.results = []
+
+    def _config(self, hosts):
+        config = configparser.ConfigParser()
+        config.read_dict({'ha': {
+            'zookeeper_hosts': hosts,
+            'backend': self.args.backend,
+            'zookeeper_cache': str(self.args.cache),
+            'zookeeper_compact_format': str(self.args.compact),
+        }})
+        return config
+
+    def setup(self):
+        """Connect and build a tree of node_count nodes.
+
+        The first node is named after the local host, so that the
+        healthchecker actions run as if they were deployed on it.
+        """
+        if self.args.backend == 'memory':
+            hosts = 'ha-bench-%s' % self.node_count
+            backend.MemoryStore.forget(hosts)
+            self.store = backend.MemoryStore.named(hosts)
+        else:
+            hosts = self.args.hosts
+        self.zk = zk.ZooKeeper(self._config(hosts))
+        self.zk.connect()
+        for path in ('/ha', zk.INDEX_ROOT):
+            if self.zk.client.exists(path):
+                self.zk.client.delete(path, recursive=True)
+        self.zk.update_configuration('allow_switch', True)
+        self.zk.create_node('zookeeper-0', 'zookeeper', 'zookeeper',
+                            '10.0.0.1')
+        names = [socket.gethostname()] + ['node-%05d' % i
+                                          for i in range(1, self.node_count)]
+        heartbeat = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+        for i, name in enumerate(names):
+            role = 'master' if i % 4 < 2 else 'slave'
+            n_type = 'zuul' if i % 2 == 0 else 'nodepool'
+            self.zk.create_node(name, role, n_type, '10.1.%d.%d' %
+                                (i // 256, i % 256))
+            self.zk.update_node(name, heartbeat=heartbeat)
+        self.zk.update_node('zookeeper-0', heartbeat=heartbeat)
+        if self.args.cache:
+            # Let the mirror catch up with the watch events of the setup.
+            time.sleep(0.5)
+        if self.store is not None:
+            self.zk.client.latency = self.args.latency_ms / 1000.0
+
+    def teardown(self):
+        self.zk.disconnect()
+        if self.store is not None:
+            backend.MemoryStore.forget('ha-bench-%s' % self.node_count)
+
+    def operations(self):
+        local = socket.gethostname()
+        some_service = self.zk.list_services(node_name_filter=local)[0].name
+        ops = [
+            ('list_nodes', self.zk.list_nodes),
+            ('list_nodes_by_role',
+             lambda: self.zk.list_nodes(node_role_filter='master')),
+            ('list_services', self.zk.list_services),
+            ('list_services_of_node',
+             lambda: self.zk.list_services(node_name_filter=local)),
+            ('list_services_by_status',
+             lambda: self.zk.list_services(status_filter='down')),
+            ('update_service',
+             lambda: self.zk.update_service(some_service, local,
+                                            alarmed=False)),
+        ]
+        if refresher is not None:
+            ops.append(('healthchecker_cycle', self._cycle))
+        else:
+            LOG.warning("The ha_healthchecker requirements aren't "
+                        "installed, skip the healthchecker cycle.")
+        # Last, the cycle would start switching after it.
+        ops.append(('switch_master_and_slave',
+                    self.zk.switch_master_and_slave))
+        return ops
+
+    def _cycle(self):
+        cluster_config = BenchClusterConfig(self.zk)
+        cluster = snapshot.ClusterSnapshot(self.zk)
+        _local(refresher.Refresher)(self.zk, cluster_config,
+                                    cluster=cluster).run()
+        _local(fixer.Fixer)(self.zk, cluster_config, None,
+                            cluster=cluster).run()
+        _local(switcher.Switcher)(self.zk, cluster_config, None,
+                                  cluster=cluster).run()
+
+    def measure(self, name, func):
+        stats = None
+        if self.store is not None:
+            self.store.stats.clear()
+        func()
+        if self.store is not None:
+            stats = dict((key, self.store.stats[key]) for key in STATS_KEYS)
+
+        times = []
+        for _ in range(self.args.repeat):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+
+        # Tracing slows everything down, it's kept out of the timed runs.
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        self.results.append({
+            'operation': name,
+            'nodes': self.node_count,
+            'wall_time_min_s': min(times),
+            'wall_time_median_s': statistics.median(times),
+            'peak_alloc_bytes': peak,
+            'zookeeper': stats,
+        })
+
+    def run(self):
+        self.setup()
+        try:
+            for name, func in self.operations():
+                self.measure(name, func)
+        finally:
+            self.teardown()
+        return self.results
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+            stderr=subprocess.DEVNULL).decode('utf8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the OpenLab HA data layer.')
+    parser.add_argument('--backend', choices=backend.BACKENDS,
+                        default='memory')
+    parser.add_argument('--hosts', default='localhost:2181',
+                        help='The ZooKeeper hosts of the kazoo backend.')
+    parser.add_argument('--nodes', default='10,100,1000',
+                        help='Comma separated sizes of the /ha trees.')
+    parser.add_argument('--latency-ms', type=float, default=1,
+                        help='The round trip time injected by the memory '
+                             'backend.')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='How many timed runs per operation.')
+    parser.add_argument('--cache', action='store_true',
+                        help='Serve the reads from the watched mirror.')
+    parser.add_argument('--compact', action='store_true',
+                        help='Write the nodes and services in the compact '
+                             'format.')
+    parser.add_argument('--output', help='Write the JSON results to a file '
+                                         'instead of stdout.')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    results = []
+    for node_count in [int(n) for n in args.nodes.split(',')]:
+        results.extend(Bench(args, node_count).run())
+    report = {
+        'revision': _git_revision(),
+        'python': sys.version.split()[0],
+        'backend': args.backend,
+        'latency_ms': args.latency_ms if args.backend == 'memory' else None,
+        'cache': args.cache,
+        'compact': args.compact,
+        'repeat': args.repeat,
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
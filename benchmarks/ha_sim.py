@@ -0,0 +1,777 @@
+#!/usr/bin/env python3
+"""Simulate failures of an OpenLab HA cluster and time the failover.
+
+Every node of a cluster (the zuul and nodepool masters and slaves, and the
+zookeeper node) runs its own ha_healthchecker `HealthChecker`, all of them
+in this process and against one in-memory ZooKeeper. Their systemd, the
+ping probes, DNSimple and github are faked, and the time is virtual: the
+cycles, the session timeouts and the waits for the services happen
+instantly in a fixed order, so that a scenario is repeatable.
+
+Each scenario lets the cluster settle, injects a failure, then runs for the
+given duration and reports:
+
+* `detection_s`: the seconds until the failure is recorded in ZooKeeper, or
+  alerted for the failures which don't change the state.
+* `switch_s`: the seconds until the zuul slave became the master and the
+  switch ended, null if there was no switch.
+* `zookeeper`: the requests sent to ZooKeeper by all the healthcheckers,
+  by type, and `client_calls`, the calls of the openlabcmd client.
+* the cycles, service restarts, github issues and DNS updates.
+
+Examples:
+
+    ./benchmarks/ha_sim.py
+    ./benchmarks/ha_sim.py --scenario master_unreachable --no-events
+"""
+import argparse
+import collections
+import configparser
+import contextlib
+import datetime
+import heapq
+import json
+import logging
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import types
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Run from a checkout, the packages don't need to be installed.
+sys.path[:0] = [os.path.join(ROOT, 'openlabcmd'),
+                os.path.join(ROOT, 'ha_healthchecker')]
+
+from openlabcmd import backend  # noqa: E402
+from openlabcmd import node  # noqa: E402
+from openlabcmd import service  # noqa: E402
+from openlabcmd import zk  # noqa: E402
+
+from ha_healthchecker.action import base  # noqa: E402
+from ha_healthchecker.action import probe  # noqa: E402
+from ha_healthchecker.action import refresher  # noqa: E402
+from ha_healthchecker.action import switcher  # noqa: E402
+from ha_healthchecker.action import systemd  # noqa: E402
+from ha_healthchecker import dnsimple  # noqa: E402
+from ha_healthchecker import health  # noqa: E402
+from ha_healthchecker import process  # noqa: E402
+from ha_healthchecker import timeline  # noqa: E402
+
+
+LOG = logging.getLogger("OpenLab HA Simulator")
+
+STATS_KEYS = ['round_trips', 'get', 'get_children', 'exists', 'create',
+              'set', 'delete', 'multi', 'bytes_read', 'bytes_written']
+
+# The virtual clock starts there, any fixed time would do.
+EPOCH = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc
+                          ).timestamp()
+
+# name -> (role, type, ip)
+CLUSTER = collections.OrderedDict([
+    ('zk', ('zookeeper', 'zookeeper', '10.0.0.1')),
+    ('zuul-master', ('master', 'zuul', '10.0.0.2')),
+    ('nodepool-master', ('master', 'nodepool', '10.0.0.3')),
+    ('zuul-slave', ('slave', 'zuul', '10.0.0.4')),
+    ('nodepool-slave', ('slave', 'nodepool', '10.0.0.5')),
+])
+
+CONFIGURATION = {
+    'allow_switch': True,
+    'dns_master_public_ip': '192.0.2.1',
+    'dns_slave_public_ip': '192.0.2.2',
+    'dns_provider_account': 'openlab',
+    # The secrets are base64 encoded.
+    'dns_provider_token': 'dG9rZW4=',
+    'github_app_name': 'theopenlab-ci',
+    'github_repo': 'theopenlab/openlab',
+    'github_user_name': 'openlab',
+    'github_user_password': 'cGFzc3dvcmQ=',
+    'github_user_token': 'dG9rZW4=',
+}
+
+
+class VirtualClock(object):
+    def __init__(self, now=EPOCH):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(seconds, 0)
+
+
+def _datetime_module(clock):
+    """Return a datetime module whose now and utcnow follow clock."""
+
+    class VirtualDatetime(datetime.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.datetime.fromtimestamp(clock.time(), tz)
+
+        @classmethod
+        def utcnow(cls):
+            return datetime.datetime.fromtimestamp(
+                clock.time(), datetime.timezone.utc).replace(tzinfo=None)
+
+    module = types.ModuleType('datetime')
+    module.__dict__.update(datetime.__dict__)
+    module.datetime = VirtualDatetime
+    return module
+
+
+class FakeSystemd(object):
+    """The systemd of a node, with the API of systemd.SystemctlManager.
+
+    Every unit is active until told otherwise. A started unit is activating
+    for start_delay seconds, a broken unit fails to start.
+    """
+
+    def __init__(self, sim, start_delay=2):
+        self.sim = sim
+        self.start_delay = start_delay
+        # unit -> [ActiveState, when it's active if it's activating]
+        self.units = {}
+        self.broken = set()
+        self.watchers = []
+        self.restarts = 0
+        self.unit_restarts = collections.Counter()
+
+    def _set_state(self, unit, state, ready_at=None):
+        old = self.units.get(unit, ['active', None])[0]
+        self.units[unit] = [state, ready_at]
+        if state != old:
+            for watcher in list(self.watchers):
+                watcher.notify(unit, state)
+
+    def state(self, unit):
+        state, ready_at = self.units.get(unit, ['active', None])
+        if state == 'activating' and self.sim.clock.time() >= ready_at:
+            state = 'active'
+            self._set_state(unit, state)
+        return state
+
+    def crash(self, unit):
+        self._set_state(unit, 'failed')
+
+    def show(self, units, restarts=True):
+        return dict((unit, {'ActiveState': self.state(unit),
+                            'SubState': 'running', 'NRestarts': '0'})
+                    for unit in units)
+
+    def run(self, action, units):
+        result = {}
+        for unit in units:
+            result[unit] = None
+            if action == 'stop':
+                self._set_state(unit, 'inactive')
+                continue
+            if action == 'restart':
+                self.restarts += 1
+                self.unit_restarts[unit] += 1
+            if unit in self.broken:
+                self._set_state(unit, 'activating')
+                self._set_state(unit, 'failed')
+                result[unit] = 'The %s job is failed' % action
+                continue
+            ready_at = self.sim.clock.time() + self.start_delay
+            self._set_state(unit, 'activating', ready_at)
+            self.sim.schedule(ready_at, self.state, unit)
+        return result
+
+
+class FakeUnitWatcher(object):
+    """systemd.UnitWatcher, on a FakeSystemd."""
+
+    def __init__(self, manager, units, callback):
+        self.manager = manager
+        self.units = set(units)
+        self.callback = callback
+
+    def start(self):
+        self.manager.watchers.append(self)
+
+    def stop(self):
+        if self in self.manager.watchers:
+            self.manager.watchers.remove(self)
+
+    def notify(self, unit, state):
+        if unit in self.units:
+            self.callback(unit, state)
+
+
+class FakeGithub(object):
+    """github.GithubAction, the issues are only recorded."""
+
+    def __init__(self, sim):
+        self.sim = sim
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def refresh(self, cluster_config):
+        pass
+
+    def create_issue(self, issuer_node, issue_type, affect_node=None,
+                     affect_services=None):
+        self.sim.issues.append({
+            'time': self.sim.elapsed(),
+            'type': issue_type,
+            'issuer': issuer_node.name,
+            'node': (affect_node or issuer_node).name,
+            'service': affect_services.name if affect_services else None})
+
+    def update_github_app_webhook(self):
+        pass
+
+
+class FakeDNSClient(object):
+    """dnsimple.DNSimpleClient, the updates are only recorded."""
+
+    def __init__(self, sim):
+        self.sim = sim
+
+    def refresh(self, domains, content):
+        pass
+
+    def update_records(self, domains, old_content, new_content):
+        for domain in domains:
+            self.sim.dns_updates.append({'time': self.sim.elapsed(),
+                                         'domain': domain,
+                                         'content': new_content})
+        return dict((domain, None) for domain in domains)
+
+
+class SimScheduler(object):
+    """The scheduler of a HealthChecker, for HealthChecker.trigger."""
+
+    timezone = datetime.timezone.utc
+
+    def __init__(self, sim, sim_node):
+        self.sim = sim
+        self.sim_node = sim_node
+
+    def modify_job(self, job_id, next_run_time=None):
+        self.sim.schedule_cycle(self.sim_node, next_run_time.timestamp())
+
+
+class SimClusterConfig(process.ClusterConfig):
+    def _set_log(self):
+        # The log of the healthcheckers goes where the simulator's goes.
+        self.LOG = logging.getLogger("OpenLab HA HealthChecker")
+
+
+class SimNode(object):
+    def __init__(self, sim, name, ip):
+        self.name = name
+        self.ip = ip
+        self.systemd = FakeSystemd(sim)
+        self.checker = None
+        self.alive = True
+        # The time of the next cycle, see Simulator.schedule_cycle.
+        self.next_cycle = None
+        self.cycles = 0
+
+    @property
+    def client(self):
+        """The KazooClient-like client of the healthchecker."""
+        return self.checker.zk_client.client
+
+
+class Simulator(object):
+    """Run the healthcheckers of a cluster on a virtual clock.
+
+    The simulator runs one thing at a time: a cycle of a healthchecker, or
+    an event of a scenario. In between, it waits for the ZooKeeper watches
+    to be delivered, so the triggers of the cycles don't depend on the
+    thread scheduling.
+    """
+
+    def __init__(self, args, name):
+        self.args = args
+        self.store_name = 'ha-sim-%s' % name
+        self.clock = VirtualClock()
+        self.store = None
+        self.nodes = collections.OrderedDict()
+        self.current = None
+        # (time, order, sequence, func, args) of the things to run, see
+        # schedule.
+        self._queue = []
+        self._sequence = 0
+        # The (client, watch, event) of the watches to deliver, see settle.
+        self._deliveries = collections.deque()
+        self._dispatch = backend.MemoryClient._dispatch
+        self.started_at = None
+        self.issues = []
+        self.dns_updates = []
+        self.client_calls = 0
+        self.errors = 0
+
+    def elapsed(self):
+        if self.started_at is None:
+            return None
+        return round(self.clock.time() - self.started_at, 3)
+
+    # The scheduling.
+
+    def schedule(self, when, func, *args, **kwargs):
+        """Run func(*args) at when.
+
+        :param order: Among the things to run at the same time, the lowest
+            order runs first, then the first scheduled.
+        """
+        self._sequence += 1
+        heapq.heappush(self._queue, (when, kwargs.get('order', -1),
+                                     self._sequence, func, args))
+
+    def schedule_cycle(self, sim_node, when):
+        if not sim_node.alive:
+            return
+        sim_node.next_cycle = when
+        # The cycles due at the same time run in the order of the nodes.
+        self.schedule(when, self._run_cycles, sim_node, when,
+                      order=list(self.nodes).index(sim_node.name))
+
+    def _run_cycles(self, sim_node, when):
+        if not sim_node.alive or sim_node.next_cycle != when:
+            # Rescheduled in the meantime.
+            return
+        self.schedule_cycle(sim_node,
+                            when + sim_node.checker.sweep_interval)
+        self.current = sim_node.name
+        try:
+            sim_node.checker._run_cycles()
+        except Exception:
+            self.errors += 1
+            LOG.exception("Cycle of %s failed", sim_node.name)
+
+    def run_until(self, end, on_step=None):
+        while self._queue and self._queue[0][0] <= end:
+            when, _, _, func, args = heapq.heappop(self._queue)
+            # A cycle which waited for the services may end after when.
+            self.clock.now = max(self.clock.now, when)
+            func(*args)
+            self.settle()
+            if on_step is not None:
+                on_step()
+        self.clock.now = max(self.clock.now, end)
+
+    def _hold(self, client, watch, event):
+        # Replaces MemoryClient._dispatch, the watches wait for settle.
+        self._deliveries.append((client, watch, event))
+
+    def settle(self, timeout=5):
+        """Deliver the watches triggered so far, one at a time.
+
+        Each watch runs in the event thread of its client, like it does
+        with kazoo, but the next one waits for it. This way the triggers of
+        the cycles don't depend on the thread scheduling, and the time
+        doesn't pass while the watches run.
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if not self._mirrors_ready():
+                # Loading in a thread of its own once a session is back.
+                time.sleep(0.001)
+                continue
+            if not self._deliveries:
+                return
+            client, watch, event = self._deliveries.popleft()
+            if client._event_thread is None:
+                # Stopped in the meantime.
+                continue
+            delivered = threading.Event()
+            self._dispatch(client, watch, event)
+            self._dispatch(client, lambda event: delivered.set(), None)
+            delivered.wait(timeout)
+        LOG.warning("The cluster didn't settle in %s seconds.", timeout)
+
+    def _mirrors_ready(self):
+        for sim_node in self.nodes.values():
+            if sim_node.checker is None:
+                continue
+            zk_client = sim_node.checker.zk_client
+            if (zk_client.client.connected and zk_client._cache is not None
+                    and not zk_client._cache.ready):
+                return False
+        return True
+
+    # The fakes.
+
+    def gethostname(self):
+        # The watches of a healthchecker run in the event thread of its
+        # client, the rest runs in the current cycle.
+        thread = threading.current_thread()
+        for sim_node in self.nodes.values():
+            if (sim_node.checker is not None and
+                    sim_node.checker.zk_client.client is not None and
+                    sim_node.client._event_thread is thread):
+                return sim_node.name
+        return self.current
+
+    def current_node(self):
+        return self.nodes[self.gethostname()]
+
+    def probe(self, host, ports=None, timeout=None):
+        if any(sim_node.ip == host and sim_node.alive
+               for sim_node in self.nodes.values()):
+            return probe.SERVING
+        return probe.UNREACHABLE
+
+    def _count_call(self, name, seconds):
+        self.client_calls += 1
+
+    def _action(self, sim_node, action):
+        sim_node.cycles += 1
+        action()
+        # The watches fired by the cycle are delivered before the cycle
+        # ends, so a cycle which triggered another one always runs it.
+        self.settle()
+
+    @contextlib.contextmanager
+    def patched(self):
+        datetime_module = _datetime_module(self.clock)
+        time_module = types.SimpleNamespace(monotonic=self.clock.time,
+                                            time=self.clock.time,
+                                            sleep=self.clock.sleep)
+        patches = [
+            mock.patch.object(socket, 'gethostname', self.gethostname),
+            mock.patch.object(
+                backend.MemoryClient, '_dispatch',
+                lambda client, watch, event: self._hold(client, watch,
+                                                        event)),
+            mock.patch.object(zk, 'datetime', datetime_module),
+            mock.patch.object(base, 'datetime', datetime_module),
+            mock.patch.object(refresher, 'datetime', datetime_module),
+            mock.patch.object(process, 'datetime', datetime_module),
+            mock.patch.object(switcher, 'time', time_module),
+            mock.patch.object(timeline, 'time', time_module),
+            mock.patch.object(health, 'time', time_module),
+            mock.patch.object(probe, 'probe', self.probe),
+            mock.patch.object(systemd, 'get_manager',
+                              lambda: self.current_node().systemd),
+            mock.patch.object(
+                systemd, 'UnitWatcher',
+                lambda units, callback: FakeUnitWatcher(
+                    self.current_node().systemd, units, callback)),
+            mock.patch.object(dnsimple, 'get_client',
+                              lambda cluster_config: FakeDNSClient(self)),
+            mock.patch.object(timeline, 'append_record',
+                              lambda record: None),
+        ]
+        with contextlib.ExitStack() as stack:
+            for patch in patches:
+                stack.enter_context(patch)
+            yield
+
+    # The cluster.
+
+    def write_config(self, directory):
+        config = configparser.ConfigParser()
+        config.read_dict({'ha': {
+            'zookeeper_hosts': self.store_name,
+            'backend': 'memory',
+            'healthchecker_event_driven': str(self.args.events),
+        }})
+        path = os.path.join(directory, 'openlab.conf')
+        with open(path, 'w') as f:
+            config.write(f)
+        return path
+
+    def setup(self, config_file):
+        backend.MemoryStore.forget(self.store_name)
+        self.store = backend.MemoryStore.named(self.store_name)
+        self.store.clock = self.clock.time
+        config = configparser.ConfigParser()
+        config.read(config_file)
+        admin = zk.ZooKeeper(config)
+        admin.connect()
+        for option, value in CONFIGURATION.items():
+            admin.update_configuration(option, value)
+        # The heartbeats are old, like in a cluster where all the
+        # healthcheckers hold a live znode.
+        heartbeat = datetime.datetime.fromtimestamp(
+            self.clock.time() - 3600, datetime.timezone.utc).strftime(
+                '%Y-%m-%d %H:%M:%S')
+        for name, (role, n_type, ip) in CLUSTER.items():
+            admin.create_node(name, role, n_type, ip)
+            admin.update_node(name, heartbeat=heartbeat)
+            self.nodes[name] = SimNode(self, name, ip)
+        admin.disconnect()
+
+        for i, sim_node in enumerate(self.nodes.values()):
+            self.current = sim_node.name
+            checker = process.HealthChecker(config_file)
+            # A cycle doesn't wait for a lost connection, the time doesn't
+            # pass while it waits.
+            checker.reconnect_timeout = 0
+            checker._action = lambda sim_node=sim_node, action=(
+                checker._action): self._action(sim_node, action)
+            sim_node.checker = checker
+            checker.zk_client.add_op_listener(self._count_call)
+            checker.zk_client.connect()
+            # The live znode is restored right after a session loss, not
+            # in a thread.
+            checker.zk_client.client.handler.spawn = (
+                lambda func, *args, **kwargs: func(*args, **kwargs))
+            checker.zk_client.register_live(sim_node.name)
+            checker.cluster_config = SimClusterConfig(checker.zk_client)
+            checker.github = FakeGithub(self)
+            checker.scheduler = SimScheduler(self, sim_node)
+            if checker.event_driven:
+                checker._watch_events()
+            # Started one after the other.
+            self.schedule_cycle(sim_node, self.clock.time() + i)
+        self.settle()
+
+    def teardown(self):
+        for sim_node in self.nodes.values():
+            if sim_node.checker is not None:
+                sim_node.checker.zk_client.disconnect()
+        backend.MemoryStore.forget(self.store_name)
+
+    # The failures.
+
+    def kill(self, name):
+        """Power off a node, its session expires after the timeout."""
+        sim_node = self.nodes[name]
+        sim_node.alive = False
+        self.schedule(self.clock.time() + self.args.session_timeout,
+                      sim_node.client.stop)
+
+    def partition(self, name, duration):
+        """Cut a node from ZooKeeper only, for duration seconds."""
+        sim_node = self.nodes[name]
+        client = sim_node.client
+        client.suspend()
+
+        def expire():
+            # The session expires on the server side, the client only
+            # learns it once it's back.
+            client._drop_watches()
+            self.store.close_session(client.session_id)
+
+        if duration > self.args.session_timeout:
+            self.schedule(self.clock.time() + self.args.session_timeout,
+                          expire)
+            self.schedule(self.clock.time() + duration,
+                          client.expire_session)
+        else:
+            self.schedule(self.clock.time() + duration, client.resume)
+
+    # The state of the cluster, read from the store without a request.
+
+    def get_node(self, name):
+        znode = self.store.nodes.get('/ha/%s' % name)
+        if znode is None:
+            return None
+        return node.Node.from_zk_bytes((znode.data, znode.stat()))
+
+    def get_service(self, node_name, service_name):
+        sim_node = self.get_node(node_name)
+        znode = self.store.nodes.get('/ha/%s/%s/%s' % (
+            node_name, sim_node.role, service_name))
+        if znode is None:
+            return None
+        return service.Service.from_zk_bytes((znode.data, znode.stat()))
+
+
+class Scenario(object):
+    name = None
+    description = None
+
+    def inject(self, sim):
+        raise NotImplementedError
+
+    def detected(self, sim):
+        raise NotImplementedError
+
+    def switched(self, sim):
+        """Whether the zuul slave became the master and the switch ended."""
+        nodes = [sim.get_node(name) for name in CLUSTER]
+        return (sim.get_node('zuul-slave').role == 'master' and
+                not any(node_obj.switch_status for node_obj in nodes))
+
+
+class SchedulerDown(Scenario):
+    name = 'scheduler_down'
+    description = ("zuul-scheduler of the zuul master dies and fails to "
+                   "start again.")
+
+    def inject(self, sim):
+        systemd = sim.nodes['zuul-master'].systemd
+        systemd.broken.add('zuul-scheduler')
+        systemd.crash('zuul-scheduler')
+
+    def detected(self, sim):
+        return sim.get_service('zuul-master',
+                               'zuul-scheduler').status != 'up'
+
+
+class MasterUnreachable(Scenario):
+    name = 'master_unreachable'
+    description = "The zuul master powers off."
+
+    def inject(self, sim):
+        sim.kill('zuul-master')
+
+    def detected(self, sim):
+        return sim.get_node('zuul-master').status == 'down'
+
+
+class ZookeeperPartition(Scenario):
+    name = 'zookeeper_partition'
+    description = ("The zuul master loses ZooKeeper for 2 minutes, the "
+                   "other nodes still reach it.")
+    duration = 120
+
+    def inject(self, sim):
+        sim.partition('zuul-master', self.duration)
+
+    def detected(self, sim):
+        return any(issue['node'] == 'zuul-master' for issue in sim.issues)
+
+
+class FlappingService(Scenario):
+    name = 'flapping_service'
+    description = ("nodepool-launcher of the nodepool master crashes every "
+                   "30 seconds.")
+    period = 30
+
+    def inject(self, sim):
+        systemd = sim.nodes['nodepool-master'].systemd
+
+        def crash():
+            systemd.crash('nodepool-launcher')
+            sim.schedule(sim.clock.time() + self.period, crash)
+
+        crash()
+
+    def detected(self, sim):
+        return sim.get_service('nodepool-master',
+                               'nodepool-launcher').status != 'up'
+
+
+SCENARIOS = collections.OrderedDict(
+    (scenario.name, scenario) for scenario in (
+        SchedulerDown, MasterUnreachable, ZookeeperPartition,
+        FlappingService))
+
+
+def run_scenario(args, scenario):
+    sim = Simulator(args, scenario.name)
+    result = {'scenario': scenario.name,
+              'description': scenario.description,
+              'detection_s': None,
+              'switch_s': None}
+    with tempfile.TemporaryDirectory() as directory, sim.patched():
+        sim.setup(sim.write_config(directory))
+        try:
+            sim.run_until(sim.clock.time() + args.warmup)
+            if sim.get_node('zuul-master').role != 'master':
+                raise RuntimeError("The cluster switched during the warm "
+                                   "up.")
+            stats = collections.Counter(sim.store.stats)
+            sim.issues, sim.dns_updates, sim.client_calls = [], [], 0
+            cycles = dict((name, sim_node.cycles)
+                          for name, sim_node in sim.nodes.items())
+            restarts = sum(sim_node.systemd.restarts
+                           for sim_node in sim.nodes.values())
+            unit_restarts = dict((name, collections.Counter(
+                sim_node.systemd.unit_restarts))
+                for name, sim_node in sim.nodes.items())
+            sim.started_at = sim.clock.time()
+            scenario.inject(sim)
+            sim.settle()
+
+            def on_step():
+                if (result['detection_s'] is None and
+                        scenario.detected(sim)):
+                    result['detection_s'] = sim.elapsed()
+                if result['switch_s'] is None and scenario.switched(sim):
+                    result['switch_s'] = sim.elapsed()
+
+            on_step()
+            sim.run_until(sim.started_at + args.duration, on_step)
+            result.update({
+                'cycles': dict((name, sim_node.cycles - cycles[name])
+                               for name, sim_node in sim.nodes.items()),
+                'restarts': sum(sim_node.systemd.restarts
+                                for sim_node in sim.nodes.values()) -
+                restarts,
+                'unit_restarts': dict(
+                    ('%s/%s' % (name, unit), count)
+                    for name, sim_node in sorted(sim.nodes.items())
+                    for unit, count in sorted(
+                        (sim_node.systemd.unit_restarts -
+                         unit_restarts[name]).items())),
+                'issues': sim.issues,
+                'dns_updates': sim.dns_updates,
+                'roles': dict((name, sim.get_node(name).role)
+                              for name in sim.nodes),
+                'zookeeper': dict((key, sim.store.stats[key] - stats[key])
+                                  for key in STATS_KEYS),
+                'client_calls': sim.client_calls,
+                'errors': sim.errors,
+            })
+        finally:
+            sim.teardown()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Simulate failures of an OpenLab HA cluster.')
+    parser.add_argument('--scenario', action='append',
+                        choices=list(SCENARIOS),
+                        help='The scenario to run, all of them by default. '
+                             'Can be repeated.')
+    parser.add_argument('--warmup', type=float, default=300,
+                        help='The seconds the cluster runs before the '
+                             'failure.')
+    parser.add_argument('--duration', type=float, default=900,
+                        help='The seconds the cluster runs after the '
+                             'failure.')
+    parser.add_argument('--session-timeout', type=float, default=10,
+                        help='The seconds the session of a lost client '
+                             'lasts.')
+    parser.add_argument('--no-events', dest='events', action='store_false',
+                        help='Only run the cycles every sweep interval, '
+                             'like healthchecker_event_driven = False.')
+    parser.add_argument('--output', help='Write the JSON results to a file '
+                                         'instead of stdout.')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Print the log of the healthcheckers.')
+    args = parser.parse_args()
+    logging.basicConfig(
+        format='%(levelname)s %(name)s %(message)s',
+        level=logging.DEBUG if args.verbose else logging.CRITICAL)
+
+    results = [run_scenario(args, SCENARIOS[name]())
+               for name in args.scenario or SCENARIOS]
+    report = {
+        'python': sys.version.split()[0],
+        'event_driven': args.events,
+        'warmup_s': args.warmup,
+        'duration_s': args.duration,
+        'session_timeout_s': args.session_timeout,
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
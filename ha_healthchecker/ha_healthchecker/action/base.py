@@ -1,14 +1,27 @@
 import datetime
+import logging
 import socket
-import subprocess
 
 import iso8601
 import six
 
+from ha_healthchecker.action import probe
+from ha_healthchecker.action import systemd
+from ha_healthchecker import metrics
+from ha_healthchecker import snapshot
+
 
 class Action(object):
-    def __init__(self, zk, cluster_config):
-        self.zk = zk
+    def __init__(self, zk, cluster_config, prober=None, cluster=None):
+        """
+        :param zk: The openlabcmd.zk.ZooKeeper client.
+        :param prober: The probe.Prober of the cycle, shared by its actions
+            so that each host is probed once per cycle.
+        :param cluster: The snapshot.ClusterSnapshot of the cycle, shared by
+            its actions. The actions read and write the cluster through it.
+        """
+        self.zk = cluster or snapshot.ClusterSnapshot(zk)
+        self.prober = prober or probe.Prober()
         self.node = self.zk.get_node(socket.gethostname())
         self.oppo_node, self.zk_node = self._get_oppo_and_zk_node()
         self.cluster_config = cluster_config
@@ -28,6 +41,10 @@ class Action(object):
         return oppo_node, zk_node
 
     def _is_check_heart_beat_overtime(self, node_obj):
+        if node_obj.name in self.zk.list_live_nodes():
+            return False
+        # The healthchecker of the node is gone, or it's an older one which
+        # only reports the heartbeat timestamp.
         try:
             timeout = int(self.cluster_config.heartbeat_timeout_second)
             over_time = iso8601.parse_date(
@@ -42,12 +59,10 @@ class Action(object):
         return current_time > over_time
 
     def _ping(self, ipaddr):
-        cli = ['ping', '-c1', '-w1', ipaddr]
-        proc = subprocess.Popen(cli, stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        proc.communicate()
+        return self.prober.is_reachable(ipaddr)
 
-        return proc.returncode == 0
+    def _is_serving(self, ipaddr):
+        return self.prober.is_serving(ipaddr)
 
     def _parse_isotime(self, timestr):
         try:
@@ -71,21 +86,85 @@ class Action(object):
         current_time = datetime.datetime.utcnow().replace(tzinfo=iso8601.UTC)
         return current_time > over_time
 
-    def _get_service_status(self, service):
-        # timer tasks are handled by crontab
-        if service in ['zuul-timer-tasks', 'nodepool-timer-tasks']:
-            service = 'cron'
+    def _show_units(self, units, restarts=True):
+        """Read the state of the systemd units in one request.
+
+        :param restarts: Whether to read the NRestarts properties too.
+        :return: a dict of unit to its ActiveState, SubState and NRestarts
+            properties, None if systemd can't be reached.
+        """
+        try:
+            with metrics.timer('systemd_show'):
+                return systemd.get_manager().show(units, restarts)
+        except systemd.SystemdError as e:
+            self.LOG.error("Failed to show the services %(units)s: %(err)s",
+                           {'units': ' '.join(units), 'err': e})
+            return None
+
+    def _control_services(self, action, services):
+        """Start, stop or restart the services, the jobs run at once.
 
-        cmd = "systemctl status {srvc}".format(srvc=service)
+        :return: a dict of service to the error message, None if the job
+            succeeded.
+        """
         try:
-            # 0 means OK
-            # if using status command, 0 means active, non-zero means error
-            # status.
-            subprocess.check_output(cmd.split(), stderr=subprocess.STDOUT)
-            self.LOG.debug("Service %(name)s runs well.",
-                                          {'name': service})
-            return 'up'
-        except subprocess.CalledProcessError as e:
-            self.LOG.error("Service %(name)s runs error: %(err)s %(out)s.",
-                           {'name': service, 'err': e, 'out': e.output})
-            return 'down'
+            return systemd.get_manager().run(action, services)
+        except systemd.SystemdError as e:
+            return dict((service, str(e)) for service in services)
+
+    def _get_services_states(self, services, down_level=logging.ERROR,
+                             restarts=True):
+        """Read the state of the local services in one request.
+
+        :param down_level: The level the services which aren't up are
+            logged at.
+        :param restarts: Whether to read the restarts too.
+        :return: a dict of service name to a (status, restarts) tuple, None
+            if systemd can't be reached. status is 'up' or 'down', restarts
+            is how many times systemd restarted the unit by itself (its
+            NRestarts property), None if it's unknown.
+        """
+        # timer tasks are handled by crontab
+        units = dict((service, 'cron' if service in [
+            'zuul-timer-tasks', 'nodepool-timer-tasks'] else service)
+            for service in services)
+        states = self._show_units(sorted(set(units.values())), restarts)
+        if states is None:
+            return None
+        result = {}
+        for service, unit in units.items():
+            state = states.get(unit, {})
+            try:
+                restarts = int(state['NRestarts'])
+            except (KeyError, ValueError):
+                restarts = None
+            if state.get('ActiveState') in ['active', 'reloading']:
+                result[service] = ('up', restarts)
+            else:
+                self.LOG.log(down_level,
+                             "Service %(name)s runs error: %(state)s.",
+                             {'name': unit, 'state': state})
+                result[service] = ('down', restarts)
+        if self.LOG.isEnabledFor(logging.DEBUG):
+            # One line for all of them, it's logged every cycle.
+            up_units = sorted(set(units[service] for service, (status, _)
+                                  in result.items() if status == 'up'))
+            self.LOG.debug("Services %(names)s run well.",
+                           {'names': ', '.join(up_units)})
+        return result
+
+    def _get_services_status(self, services, down_level=logging.ERROR):
+        """Return a dict of service name to 'up' or 'down'.
+
+        None if systemd can't be reached.
+        """
+        states = self._get_services_states(services, down_level,
+                                           restarts=False)
+        if states is None:
+            return None
+        return dict((service, status)
+                    for service, (status, _) in states.items())
+
+    def _get_service_status(self, service):
+        statuses = self._get_services_status([service])
+        return statuses[service] if statuses is not None else None
@@ -1,13 +1,20 @@
 import datetime
-import subprocess
 
 from ha_healthchecker.action import base
+from ha_healthchecker import health
+from ha_healthchecker import metrics
 
 
 class Fixer(base.Action):
-    def __init__(self, zk, cluster_config, github):
-        super(Fixer, self).__init__(zk, cluster_config)
+    def __init__(self, zk, cluster_config, github, prober=None,
+                 cluster=None, service_tracker=None):
+        """
+        :param service_tracker: The health.ServiceTracker of the Refresher,
+            it tells when a restarting service may be restarted again.
+        """
+        super(Fixer, self).__init__(zk, cluster_config, prober, cluster)
         self.github = github
+        self.service_tracker = service_tracker or health.ServiceTracker()
 
     def _set_alarmed(self, obj, is_service):
         if not obj.alarmed:
@@ -22,18 +29,15 @@ class Fixer(base.Action):
                                                'role': obj.role})
 
     def _service_restart(self, service):
-        cmd = "systemctl restart {srvc}".format(srvc=service)
-        try:
-            # 0 means OK
-            # if using status command, 0 means active, non-zero means error
-            # status.
-            subprocess.check_output(cmd.split(), stderr=subprocess.STDOUT)
+        error = self._control_services('restart', [service])[service]
+        metrics.incr('service_restarts', service=service,
+                     result='success' if error is None else 'failure')
+        if error is None:
             self.LOG.info("Service %(name)s restarted success.",
                           {'name': service})
-        except subprocess.CalledProcessError as e:
-            self.LOG.error("Service %(name)s restarted failed.: %(err)s "
-                           "%(out)s", {'name': service, 'err': e,
-                                       'out': e.output})
+        else:
+            self.LOG.error("Service %(name)s restarted failed.: %(err)s",
+                           {'name': service, 'err': error})
 
     def _fix_service(self, service_obj):
         if service_obj.status == 'restarting':
@@ -41,7 +45,20 @@ class Fixer(base.Action):
                 service_name = 'cron'
             else:
                 service_name = service_obj.name
+            if not self.service_tracker.can_restart(
+                    service_obj.name,
+                    int(self.cluster_config.service_restart_max_times)):
+                self.LOG.debug("Service %(name)s was restarted recently or "
+                               "too many times, don't restart it now.",
+                               {'name': service_obj.name})
+                return
+            count = self.service_tracker.record_restart(service_obj.name)
             self._service_restart(service_name)
+            if count is not None:
+                # The budget of restarts survives a restart of the
+                # healthchecker.
+                self.zk.update_service(service_obj.name, self.node.name,
+                                       restarted_count=count)
         elif service_obj.status == 'down':
             if not service_obj.alarmed:
                 self.github.create_issue(self.node, 'service_down',
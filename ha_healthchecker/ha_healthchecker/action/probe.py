@@ -0,0 +1,220 @@
+from concurrent import futures
+import errno
+import math
+import selectors
+import socket
+import struct
+import subprocess
+import threading
+import time
+
+from ha_healthchecker import metrics
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+
+# The results of a probe.
+UNREACHABLE = 'unreachable'
+# The host answers, but none of the ports accepts a connection.
+ALIVE = 'alive'
+# A port accepts the connections.
+SERVING = 'serving'
+# Nothing answers in time, but no echo could be sent. The ports may be
+# filtered, so the host isn't taken as down.
+UNKNOWN = 'unknown'
+
+
+def _checksum(data):
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def _icmp_echo_socket(ipaddr):
+    """Send an ICMP echo request from an unprivileged datagram socket.
+
+    :raise: OSError if the ICMP datagram sockets aren't allowed for this
+        user, see the net.ipv4.ping_group_range sysctl.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                         socket.IPPROTO_ICMP)
+    try:
+        sock.setblocking(False)
+        payload = b'openlab-ha'
+        # The kernel sets the identifier of the datagram ICMP sockets.
+        header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, 0, 1)
+        header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0,
+                             _checksum(header + payload), 0, 1)
+        sock.sendto(header + payload, (ipaddr, 0))
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def _ping_process(ipaddr, timeout):
+    """Start the ping command, where the ICMP datagram sockets aren't allowed.
+
+    :return: the Popen of ping, None if it can't be run.
+    """
+    cli = ['ping', '-c1', '-w%d' % max(math.ceil(timeout), 1), ipaddr]
+    try:
+        return subprocess.Popen(cli, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+    except OSError:
+        return None
+
+
+def _ping_result(proc, deadline):
+    """Wait for the ping command.
+
+    :return: True if the host replied, False if it didn't, None if ping
+        failed on its own.
+    """
+    try:
+        returncode = proc.wait(max(deadline - time.monotonic(), 0) + 1)
+    except subprocess.TimeoutExpired:
+        return False
+    # ping exits with 1 when there's no reply, 2 on the other errors.
+    return {0: True, 1: False}.get(returncode)
+
+
+def probe(host, ports=(22, 2181), timeout=1):
+    """Check whether host and its services answer in time.
+
+    An ICMP echo and a TCP connection to every port are tried at once. The
+    echo is sent by the ping command where the ICMP datagram sockets aren't
+    allowed.
+
+    :return: SERVING as soon as a port accepts the connection. ALIVE if the
+        host only answers the echo or refuses the connections, only the
+        host can refuse them. That's what ping tells, the host is up but
+        its services may not be. UNREACHABLE if nothing answers in time,
+        UNKNOWN if a connection timed out and no echo could be sent.
+    """
+    try:
+        ipaddr = socket.gethostbyname(host)
+    except (socket.gaierror, UnicodeError):
+        return UNREACHABLE
+    deadline = time.monotonic() + timeout
+    alive = False
+    # Whether the host got an echo request, and a connection timed out.
+    echoed = False
+    timed_out = False
+    selector = selectors.DefaultSelector()
+    sockets = []
+    ping_proc = None
+    try:
+        try:
+            icmp_sock = _icmp_echo_socket(ipaddr)
+            sockets.append(icmp_sock)
+            selector.register(icmp_sock, selectors.EVENT_READ)
+            echoed = True
+        except OSError:
+            icmp_sock = None
+            ping_proc = _ping_process(ipaddr, timeout)
+        for port in ports:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sockets.append(sock)
+            sock.setblocking(False)
+            err = sock.connect_ex((ipaddr, port))
+            if err == 0:
+                return SERVING
+            if err == errno.ECONNREFUSED:
+                alive = True
+            elif err == errno.EINPROGRESS:
+                selector.register(sock, selectors.EVENT_WRITE)
+        while selector.get_map():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                timed_out = any(key.fileobj is not icmp_sock
+                                for key in selector.get_map().values())
+                break
+            for key, _ in selector.select(remaining):
+                sock = key.fileobj
+                if sock is icmp_sock:
+                    try:
+                        reply = sock.recv(1024)
+                    except OSError:
+                        selector.unregister(sock)
+                        continue
+                    if reply[:1] == bytes([ICMP_ECHO_REPLY]):
+                        alive = True
+                        selector.unregister(sock)
+                else:
+                    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if err == 0:
+                        return SERVING
+                    if err == errno.ECONNREFUSED:
+                        alive = True
+                    selector.unregister(sock)
+        if not alive and ping_proc is not None:
+            replied = _ping_result(ping_proc, deadline)
+            alive = bool(replied)
+            echoed = replied is not None
+        if alive:
+            return ALIVE
+        return UNKNOWN if timed_out and not echoed else UNREACHABLE
+    finally:
+        selector.close()
+        for sock in sockets:
+            sock.close()
+        if ping_proc is not None and ping_proc.poll() is None:
+            ping_proc.kill()
+            ping_proc.wait()
+
+
+class Prober(object):
+    """Probe the reachability of hosts concurrently.
+
+    Every host is probed once in the life of the Prober, the healthchecker
+    uses one per cycle. `start` launches the probes in the background, so
+    that they run along the rest of the cycle.
+
+    :param timeout: How many seconds a probe waits for an answer.
+    """
+
+    def __init__(self, timeout=1, ports=(22, 2181), max_workers=16):
+        self.timeout = timeout
+        self.ports = ports
+        self._executor = futures.ThreadPoolExecutor(max_workers)
+        self._lock = threading.Lock()
+        # host -> Future of the probe result
+        self._results = {}
+
+    def _probe(self, host):
+        start = time.monotonic()
+        result = probe(host, self.ports, self.timeout)
+        # The time to the answer, or the timeout.
+        metrics.timing('probe', time.monotonic() - start, host=host,
+                       result=result)
+        return result
+
+    def _future(self, host):
+        with self._lock:
+            if host not in self._results:
+                self._results[host] = self._executor.submit(self._probe,
+                                                            host)
+            return self._results[host]
+
+    def start(self, hosts):
+        for host in hosts:
+            self._future(host)
+
+    def is_reachable(self, host):
+        """Whether the host is up, like ping tells.
+
+        An UNKNOWN host is taken as up, a filtered port alone doesn't tell
+        it's down.
+        """
+        return self._future(host).result() != UNREACHABLE
+
+    def is_serving(self, host):
+        """Whether a service of the host accepts the connections."""
+        return self._future(host).result() == SERVING
+
+    def close(self):
+        self._executor.shutdown(wait=False)
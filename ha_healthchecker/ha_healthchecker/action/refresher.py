@@ -1,53 +1,57 @@
 import datetime
 
+import iso8601
+
 from ha_healthchecker.action import base
+from ha_healthchecker import health
+from ha_healthchecker import metrics
 
 
 class Refresher(base.Action):
-    def __init__(self, zk, cluster_config):
-        super(Refresher, self).__init__(zk, cluster_config)
+    def __init__(self, zk, cluster_config, prober=None, cluster=None,
+                 service_tracker=None):
+        """
+        :param service_tracker: The health.ServiceTracker which keeps the
+            samples of the local services across the cycles.
+        """
+        super(Refresher, self).__init__(zk, cluster_config, prober, cluster)
+        self.service_tracker = service_tracker or health.ServiceTracker()
 
     def _local_node_service_process(self, node_obj):
         service_objs = self.zk.list_services(node_name_filter=node_obj.name)
+        states = self._get_services_states(
+            [service_obj.name for service_obj in service_objs])
+        if states is None:
+            # Not a failure of the services, they're checked next cycle.
+            self.LOG.warning("Skip the check of the local services, systemd "
+                             "can't be reached.")
+            service_objs = []
         for service_obj in service_objs:
-            self._refresh_service(service_obj, node_obj)
+            cur_status, unit_restarts = states[service_obj.name]
+            metrics.gauge('service_up', int(cur_status == 'up'),
+                          service=service_obj.name)
+            self._refresh_service(service_obj, node_obj, cur_status,
+                                  unit_restarts)
 
         self._report_heart_beat(node_obj)
 
-    def _refresh_service(self, service_obj, node_obj):
-        cur_status = self._get_service_status(service_obj.name)
-        update_dict = {}
-        if cur_status == 'up':
-            if service_obj.status != 'up':
-                update_dict['status'] = 'up'
-                update_dict['restarted'] = False
-                update_dict['alarmed'] = False
-                update_dict['restarted_account'] = 0
-                self.LOG.debug("Fix Service %(name)s status from %(orig)s to "
-                               "UP.", {'name': service_obj.name,
-                                       'orig': service_obj.status})
-        else:
-            if not service_obj.restarted:
-                update_dict['status'] = 'restarting'
-                update_dict['restarted'] = True
-                self.LOG.debug("Service %(name)s is Restarting.",
-                               {'name': service_obj.name})
-            else:
-                if (service_obj.restarted_count >=
-                        self.cluster_config.service_restart_max_times):
-                    update_dict['status'] = 'down'
-                    self.LOG.debug("Service %(name)s is Down.",
-                                   {'name': service_obj.name})
-                else:
-                    update_dict[
-                        'restarted_account'] = service_obj.restarted_count + 1
-                    self.LOG.debug("Service %(name)s continue in restarting, "
-                                   "tried %(count)s times",
-                                   {'name': service_obj.name,
-                                    'count': service_obj.restarted_count})
-        if update_dict:
-            self.zk.update_service(service_obj.name, node_obj.name,
-                                   **update_dict)
+    def _refresh_service(self, service_obj, node_obj, cur_status,
+                         unit_restarts=None):
+        update_dict = self.service_tracker.sample(
+            service_obj, cur_status == 'up',
+            int(self.cluster_config.service_restart_max_times),
+            unit_restarts)
+        if not update_dict:
+            return
+        if self.service_tracker.is_flapping(service_obj.name):
+            self.LOG.info("Service %(name)s is flapping.",
+                          {'name': service_obj.name})
+        self.LOG.info("Service %(name)s is updated from %(orig)s to "
+                      "%(status)s.", {'name': service_obj.name,
+                                      'orig': service_obj.status,
+                                      'status': update_dict['status'].upper()})
+        self.zk.update_service(service_obj.name, node_obj.name,
+                               **update_dict)
 
     def _need_fix_alarmed_status(self, node):
         if not node.alarmed:
@@ -64,16 +68,43 @@ class Refresher(base.Action):
 
         return True
 
+    def _need_heart_beat(self, node_obj):
+        # The heartbeat timestamp is reported every cycle while a node of
+        # the cluster has no live znode, that's an older healthchecker which
+        # still relies on it.
+        live_nodes = self.zk.list_live_nodes()
+        if node_obj.name not in live_nodes:
+            return True
+        if any(other.name not in live_nodes
+               for other in self.zk.list_nodes()):
+            return True
+        # Otherwise it's only used while the live znode of this node is gone,
+        # like when its session is lost for a moment. It's kept fresh enough
+        # for heartbeat_timeout_second to apply then.
+        try:
+            timeout = int(self.cluster_config.heartbeat_timeout_second)
+            last = self._parse_isotime(node_obj.heartbeat)
+        except ValueError:
+            return True
+        current_time = datetime.datetime.utcnow().replace(tzinfo=iso8601.UTC)
+        return current_time >= last + datetime.timedelta(seconds=timeout / 2)
+
     def _report_heart_beat(self, node_obj):
-        hb = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
-        update_dict = {'heartbeat': hb}
+        update_dict = {}
+        if self._need_heart_beat(node_obj):
+            update_dict['heartbeat'] = datetime.datetime.utcnow().strftime(
+                '%Y-%m-%d %H:%M:%S')
         if node_obj.status == 'initializing' or node_obj.status == 'down':
             update_dict['status'] = 'up'
         if self._need_fix_alarmed_status(node_obj):
             update_dict['alarmed'] = False
+        if not update_dict:
+            return
         self.zk.update_node(node_obj.name, **update_dict)
-        self.LOG.debug("Report node %(name)s heartbeat %(hb)s",
-                       {'name': node_obj.name, 'hb': hb})
+        if 'heartbeat' in update_dict:
+            self.LOG.debug("Report node %(name)s heartbeat %(hb)s",
+                           {'name': node_obj.name,
+                            'hb': update_dict['heartbeat']})
 
     def _other_node_check(self, other_node_obj):
         if other_node_obj.status == 'maintaining':
@@ -87,6 +118,12 @@ class Refresher(base.Action):
                               {'role': other_node_obj.role,
                                'name': other_node_obj.name,
                                'status': 'down'.upper()})
+        elif not self._is_serving(other_node_obj.ip):
+            # It's still up for the HA, like ping would tell.
+            self.LOG.warning("%(role)s node %(name)s may be up, but its ssh "
+                             "and zookeeper ports don't accept connections.",
+                             {'role': other_node_obj.role,
+                              'name': other_node_obj.name})
 
     def run(self):
         if self.node.status == 'maintaining':
@@ -1,19 +1,25 @@
-import json
-import subprocess
+import logging
 import time
 
-import requests
+from openlabcmd import service
 
 from ha_healthchecker.action import base
-
-# Simpledns provider
-DOMAIN_NAME = 'openlabtesting.org'
+from ha_healthchecker import dnsimple
+from ha_healthchecker import timeline
 
 
 class Switcher(base.Action):
-    def __init__(self, zk, cluster_config, github):
-        super(Switcher, self).__init__(zk, cluster_config)
+    # How many seconds a started service has to come up.
+    ready_timeout = 60
+    ready_poll_delay = 0.5
+    ready_poll_max_delay = 8
+
+    def __init__(self, zk, cluster_config, github, prober=None,
+                 cluster=None):
+        super(Switcher, self).__init__(zk, cluster_config, prober, cluster)
         self.github = github
+        # The steps of the switch done in this cycle, see _save_timeline.
+        self.timeline = timeline.SwitchTimeline(self.node)
 
     def _is_need_switch(self):
         all_nodes = self.zk.list_nodes()
@@ -38,9 +44,8 @@ class Switcher(base.Action):
                                    'role': node.role,
                                    'status': 'down'.upper()})
                     return True
-                node_services = self.zk.list_services(
-                    node_name_filter=node.name)
-                err_services = [e for e in node_services if e.status == 'down']
+                err_services = self.zk.list_services(
+                    node_name_filter=node.name, status_filter='down')
                 # Service analysis
                 for err_svc in err_services:
                     if err_svc.is_necessary:
@@ -55,7 +60,7 @@ class Switcher(base.Action):
                     elif (not err_svc.is_necessary and
                           self._is_alarmed_timeout(err_svc)):
                         self.LOG.info(
-                            "Global checking: Found a necessary service "
+                            "Global checking: Found an unnecessary service "
                             "%(service_name)s is in %(service_status)s "
                             "status on %(role)s node %(name)s. ", {
                                 'service_name': err_svc.name,
@@ -64,41 +69,78 @@ class Switcher(base.Action):
                         return True
         return False
 
-    def _set_switch_status(self):
-        if not self.node.switch_status:
-            self.zk.update_node(self.node.name, switch_status='start')
-            self.node.switch_status = 'start'
-            self.LOG.info("Global checking result: setting switch_status "
-                          "%(status)s.", {'status': 'start'.upper()})
-
-        if self.node.role == 'slave' and (not self._ping(self.oppo_node.ip) and
-                 self._is_check_heart_beat_overtime(self.oppo_node)):
-            self.zk.update_node(self.oppo_node.name,
-                                switch_status='start')
-            self.oppo_node.switch_status = 'start'
-            self.LOG.info(
-                "Global checking result: setting switch_status "
-                "%(status)s and role=slave on OPPO %(role)s "
-                "node %(name)s.",
-                {'status': 'start'.upper(),
-                 'role': self.oppo_node.role,
-                 'name': self.oppo_node.name})
-
-    def _run_systemctl_command(self, command, service):
-        cmd = "systemctl {cmd} {srvc}".format(cmd=command, srvc=service)
-        try:
-            # 0 means OK
-            # if using status command, 0 means active, non-zero means error status.
-            subprocess.check_output(cmd.split(), stderr=subprocess.STDOUT)
-            self.LOG.debug("Run CMD: %(cmd)s", {'cmd': cmd})
-            if command == 'status':
-                return 'up'
-        except subprocess.CalledProcessError as e:
-            self.LOG.error("Failed to %(cmd)s %(srvc)s service: %(err)s "
-                           "%(out)s", {'cmd': command, 'srvc': service,
-                                       'err': e, 'out': e.output})
-            if command == 'status':
-                return 'down'
+    def _start_switch(self):
+        """Assign the switch to all the nodes, as its coordinator."""
+        node_objs = [node_obj for node_obj in
+                     self.zk.list_nodes(with_zk=False)
+                     if node_obj.type != 'zookeeper']
+        started = [node_obj for node_obj in node_objs
+                   if node_obj.switch_status == 'start']
+        if started:
+            # The previous coordinator assigned the switch to some of the
+            # nodes only, its plan stays.
+            self.timeline.switch_id = started[0].switch_id
+        else:
+            # The switch is identified by the time it's started.
+            self.timeline.switch_id = timeline.now_isotime()
+            self.zk.set_switch_plan({'id': self.timeline.switch_id,
+                                     'coordinator': self.node.name,
+                                     'forced': False})
+        for node_obj in node_objs:
+            if node_obj.switch_status != 'start':
+                self.zk.update_node(node_obj.name, switch_status='start',
+                                    switch_id=self.timeline.switch_id)
+                self.LOG.info("Global checking result: setting switch_status "
+                              "%(status)s on %(role)s node %(name)s.",
+                              {'status': 'start'.upper(),
+                               'role': node_obj.role, 'name': node_obj.name})
+        self.node = self.zk.get_node(self.node.name)
+        self.oppo_node, self.zk_node = self._get_oppo_and_zk_node()
+
+    def _end_switch(self):
+        """Set the nodes back to no switch, as its coordinator."""
+        ended = False
+        for node_obj in self.zk.list_nodes(with_zk=False):
+            if node_obj.switch_status == 'end':
+                self.zk.update_node(node_obj.name, switch_status=None,
+                                    switch_id=None)
+                ended = True
+                switch_id = node_obj.switch_id
+                self.LOG.info(
+                    "Global checking result: setting back switch_status "
+                    "from %(status)s to None on %(role)s node %(name)s.",
+                    {'status': 'end'.upper(), 'role': node_obj.role,
+                     'name': node_obj.name})
+        if ended:
+            self.timeline.switch_id = switch_id
+            self.timeline.mark('end_switch')
+            self.zk.set_switch_plan(None)
+
+    def _save_timeline(self):
+        if not self.timeline.spans:
+            return
+        record = self.timeline.to_dict()
+        timeline.append_record(record)
+        self.zk.add_switch_record(record)
+
+    def _run_services_command(self, command, services):
+        for name, error in self._control_services(command,
+                                                  services).items():
+            if error is None:
+                self.LOG.debug("Run %(cmd)s on %(srvc)s service.",
+                               {'cmd': command, 'srvc': name})
+            else:
+                self.LOG.error("Failed to %(cmd)s %(srvc)s service: "
+                               "%(err)s", {'cmd': command, 'srvc': name,
+                                           'err': error})
+
+    @staticmethod
+    def _role_services(node_obj, role):
+        """Return the services of node_obj in role, the timer tasks aside."""
+        services = service.service_mapping[role].get(node_obj.type, {})
+        return sorted(name for names in services.values() for name in names
+                      if name not in ['zuul-timer-tasks',
+                                      'nodepool-timer-tasks'])
 
     def _shut_down_all_services(self, node_obj, force_switch):
         service_objs = self.zk.list_services(
@@ -106,133 +148,115 @@ class Switcher(base.Action):
         exclude_service = ['zuul-timer-tasks', 'nodepool-timer-tasks']
         if force_switch:
             exclude_service.append('zookeeper')
-        for service in service_objs:
-            if service.name not in exclude_service:
-                self._run_systemctl_command('stop', service.name)
-
-    def _setup_necessary_services_and_check(self, node_obj):
-        service_objs = self.zk.list_services(
-            node_name_filter=node_obj.name)
-        for service in service_objs:
-            if service.name not in ['zuul-timer-tasks',
-                                    'nodepool-timer-tasks']:
-                self._run_systemctl_command('start', service)
-                self.LOG.info("Start Service %(name)s.",
-                              {'name': service.name})
-
-        # local deplay 5 seconds
-        time.sleep(5)
-
-        # Then we check all services status in 'SLAVE' env.
-        result = {}
-        for service in service_objs:
-            result[service.name] = self._get_service_status(service.name)
-
-        for svc_name, res in result.items():
-            if res != 0:
-                self.LOG.error(
-                    "%s is failed to start with return code %s" % (
-                        svc_name, res))
-
-    def _match_record(self, name, res):
-        return (name == res['name'] and
-                res['type'] == "A" and
-                self.cluster_config.dns_master_public_ip == res['content'])
+        # The services of the slave keep running, like mysql.
+        exclude_service.extend(self._role_services(node_obj, 'slave'))
+        services = [service_obj.name for service_obj in service_objs
+                    if service_obj.name not in exclude_service]
+        # The services are stopped before the ones they depend on.
+        for wave in reversed(service.start_waves(services)):
+            with self.timeline.span('stop %s' % ','.join(wave)):
+                self._run_services_command('stop', wave)
+
+    def _wait_services_up(self, services):
+        """Poll the services until they're up, with a growing delay.
+
+        :return: the services which are still not up at the deadline.
+        """
+        deadline = time.monotonic() + self.ready_timeout
+        delay = self.ready_poll_delay
+        while True:
+            # They may still be starting, the ones which are still down at
+            # the deadline are logged as errors by the caller.
+            statuses = self._get_services_status(
+                services, down_level=logging.DEBUG) or {}
+            down = [name for name in services
+                    if statuses.get(name) != 'up']
+            remaining = deadline - time.monotonic()
+            if not down or remaining <= 0:
+                return down
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, self.ready_poll_max_delay)
+            services = down
+
+    def _setup_necessary_services_and_check(self, node_obj, role):
+        """Start all the services of node_obj in its new role.
+
+        The ones which already run are left as they are, the ones which
+        don't would be restarted by the Fixer otherwise.
+        """
+        services = self._role_services(node_obj, role)
+        failed = []
+        # Each wave is started once the services it depends on are up.
+        for wave in service.start_waves(services):
+            with self.timeline.span('start %s' % ','.join(wave)):
+                self._run_services_command('start', wave)
+                for name in wave:
+                    self.LOG.info("Start Service %(name)s.", {'name': name})
+                failed.extend(self._wait_services_up(wave))
+        # The services of the first waves may fail along the next ones.
+        failed.extend(self._wait_services_up(
+            [name for name in services if name not in failed]))
+        for name in sorted(failed):
+            self.LOG.error("%s is failed to start in %s seconds." % (
+                name, self.ready_timeout))
 
     def _change_dns_and_github_app_webhook(self):
-        self._change_dns()
-        self.github.update_github_app_webhook()
+        with self.timeline.span('change_dns'):
+            self._change_dns()
+        with self.timeline.span('update_github_app_webhook'):
+            self.github.update_github_app_webhook()
 
     def _change_dns(self):
-        headers = {'Authorization': "Bearer %s" % self.cluster_config.dns_provider_token,
-                   'Accept': 'application/json'}
-        res = requests.get(self.cluster_config.dns_provider_api_url + 'accounts',
-                           headers=headers)
-        if res.status_code != 200:
-            self.LOG.error("Failed to get the accounts")
-            self.LOG.error(
-                "Details: code-status %s\n         message: %s" % (
-                    res.status_code, res.reason))
-            return
-        accounts = json.loads(s=res.content.decode('utf8'))['data']
-        account_id = None
-        for account in accounts:
-            if account['id'] == self.cluster_config.dns_provider_account:
-                account_id = account['id']
-                break
-        if not account_id:
-            self.LOG.error("Failed to get the account_id")
-            return
-
-        target_dict = {self.cluster_config.dns_status_domain: {},
-                       self.cluster_config.dns_log_domain: {}}
-        for target_domain in target_dict.keys():
-            res = requests.get(
-                self.cluster_config.dns_provider_api_url + "%s/zones/%s/records?name=%s" % (
-                account_id, DOMAIN_NAME,
-                target_domain.split(DOMAIN_NAME)[0][:-1]),
-                               headers=headers)
-            if res.status_code != 200:
-                self.LOG.error(
-                    "Failed to get the records by name %s" % target_domain)
-                self.LOG.error(
-                    "Details: code-status %s\n         message: %s" % (
-                        res.status_code, res.reason))
-                return
-            records = json.loads(s=res.content.decode('utf8'))['data']
-            record_id = None
-            for record in records:
-                if self._match_record(target_domain.split(DOMAIN_NAME)[0][:-1],
-                                record):
-                    record_id = record['id']
-                    target_dict[target_domain]['id'] = record_id
-                    break
-            if not record_id:
-                self.LOG.error(
-                    "Failed to get the record_id by name %s" % target_domain)
-                return
-
-        if not any(target_dict.values()):
-            self.LOG.error("Can't not get any records.")
-            return
-
-        headers['Content-Type'] = 'application/json'
-        data = {
-            "content": self.cluster_config.dns_slave_public_ip
-        }
-        for target_domain in target_dict.keys():
-            res = requests.patch(
-                self.cluster_config.dns_provider_api_url + "%s/zones/%s/records/%s" % (
-                    account_id, DOMAIN_NAME, target_dict[target_domain]['id']),
-                data=data, headers=headers)
-            result = json.loads(s=res.content.decode('utf8'))['data']
-            if (res.status_code == 200 and
-                    result['content'] == self.cluster_config.dns_slave_public_ip):
+        domains = [self.cluster_config.dns_status_domain,
+                   self.cluster_config.dns_log_domain]
+        result = dnsimple.get_client(self.cluster_config).update_records(
+            domains, self.cluster_config.dns_master_public_ip,
+            self.cluster_config.dns_slave_public_ip)
+        failed = False
+        for domain, error in sorted(result.items()):
+            if error is None:
                 self.LOG.info(
                     "Success Update -- Domain %s from %s to %s" % (
-                        target_domain, self.cluster_config.dns_master_public_ip,
+                        domain, self.cluster_config.dns_master_public_ip,
                         self.cluster_config.dns_slave_public_ip))
             else:
+                failed = True
                 self.LOG.error(
                     "Fail Update -- Domain %s from %s to %s" % (
-                        target_domain, self.cluster_config.dns_master_public_ip,
+                        domain, self.cluster_config.dns_master_public_ip,
                         self.cluster_config.dns_slave_public_ip))
-                self.LOG.error(
-                    "Details: code-status %s\n         message: %s" % (
-                        res.status_code, res.reason))
-                return
+                self.LOG.error("Details: %s" % error)
+        if failed:
+            return
         self.zk.update_configuration('dns_master_public_ip',
                                      self.cluster_config.dns_slave_public_ip)
         self.zk.update_configuration('dns_slave_public_ip',
                                      self.cluster_config.dns_master_public_ip)
         self.LOG.info("Finish update DNS entry.")
 
+    def _is_master_stopped(self):
+        """Whether the old master is done with its part of the switch.
+
+        It's done once it stopped its services and set its switch_status to
+        end. A master which is gone can't stop them, it's done too.
+        """
+        oppo_node = self.oppo_node
+        if oppo_node is None or oppo_node.role != 'master':
+            return True
+        if oppo_node.switch_status == 'end':
+            return True
+        return (not self._ping(oppo_node.ip) and
+                self._is_check_heart_beat_overtime(oppo_node))
+
     def _do_switch(self, force_switch=False):
         if self.node.role == 'master':
-            self._shut_down_all_services(self.node, force_switch)
+            with self.timeline.span('shut_down_all_services'):
+                self._shut_down_all_services(self.node, force_switch)
             update_dict = {'role': 'slave', 'switch_status': 'end'}
             self.zk.update_node(self.node.name, **update_dict)
             self.node.switch_status = 'end'
+            with self.timeline.span('setup_necessary_services_and_check'):
+                self._setup_necessary_services_and_check(self.node, 'slave')
             self.LOG.info(
                 "M/S switching: local node, %(role)s node %(name)s is "
                 "finishd from master to slave. And update it with "
@@ -241,6 +265,13 @@ class Switcher(base.Action):
                  'ext_msg': ' and status=down' if not force_switch else ''})
 
         elif self.node.role == 'slave':
+            if not self._is_master_stopped():
+                # The services mustn't run on both nodes, the next cycle
+                # runs once the master updates its node.
+                self.LOG.info(
+                    "M/S switching: waiting for master node %(name)s to "
+                    "stop its services.", {'name': self.oppo_node.name})
+                return
             if self.node.type == 'zuul':
                 if not force_switch:
                     self.github.create_issue(self.node, 'switch')
@@ -248,7 +279,9 @@ class Switcher(base.Action):
             self.zk.update_node(self.node.name, role='master',
                                 switch_status='end')
             self.node.switch_status = 'end'
-            self._setup_necessary_services_and_check(self.node)
+            with self.timeline.span('setup_necessary_services_and_check'):
+                self._setup_necessary_services_and_check(self.node,
+                                                         'master')
             self.LOG.info(
                 "M/S switching: local node, %(role)s node %(name)s is "
                 "finishd from slave to master. And update it with "
@@ -267,24 +300,6 @@ class Switcher(base.Action):
                      'role': self.oppo_node.role,
                      'name': self.oppo_node.name})
 
-    def _can_start_switch(self):
-        if self.node.switch_status == 'end':
-            return False
-
-        res = []
-        for zk_node in self.zk.list_nodes(with_zk=False):
-            res.append(zk_node.switch_status)
-
-        if len(set(res)) == 1 and 'start' in set(res):
-            # All status is 'start'
-            return True
-
-        if len(set(res)) == 2 and 'start' in set(res) and 'end' in set(res):
-            # Status contains only 'start' and 'end', no 'None'.
-            return True
-
-        return False
-
     def _not_switching(self):
         res = []
         for zk_node in self.zk.list_nodes(with_zk=False):
@@ -314,27 +329,26 @@ class Switcher(base.Action):
             # zookeeper node don't need master/slave switch
             return
 
-        is_force_switch = True
-        if not self.node.switch_status and self._not_switching():
-            if self._is_need_switch():
-                self._set_switch_status()
-                is_force_switch = False
-
-        if self._can_start_switch():
-            self._do_switch(force_switch=is_force_switch)
-
-        if self._is_end():
-            if self.node.switch_status == 'end':
-                self.zk.update_node(self.node.name, switch_status=None)
-            if self.oppo_node.switch_status == 'end':
-                if (not self._ping(self.oppo_node.ip)
-                        and self._is_check_heart_beat_overtime(
-                            self.oppo_node)):
-                    self.zk.update_node(self.oppo_node.name,
-                                        switch_status=None)
-                    self.LOG.info(
-                        "Global checking result: setting back switch_status "
-                        "from %(status)s to None on %(role)s node %(name)s.",
-                        {'status': 'start'.upper(),
-                         'role': self.node.role,
-                         'name': self.node.name})
+        # One node coordinates the switch: it decides it and assigns it to
+        # all the nodes, then sets them back once they're all done. Each
+        # node does its own part once it's assigned.
+        coordinator = self.zk.acquire_lock('switch', self.node.name)
+        if coordinator and self._not_switching() and self._is_need_switch():
+            self.timeline.mark('detection')
+            with self.timeline.span('set_switch_status'):
+                self._start_switch()
+
+        if self.node.switch_status == 'start':
+            # The switches which aren't started by a coordinator are asked
+            # for by the operators, see openlab ha cluster switch.
+            plan = self.zk.get_switch_plan() or {}
+            if plan.get('id') != self.node.switch_id:
+                # Left by an older switch, this one is asked for by an
+                # openlab command which doesn't write the plan.
+                plan = {}
+            self.timeline.switch_id = self.node.switch_id
+            self._do_switch(force_switch=plan.get('forced', True))
+
+        if coordinator and self._is_end():
+            self._end_switch()
+        self._save_timeline()
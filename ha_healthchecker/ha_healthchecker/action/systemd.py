@@ -0,0 +1,374 @@
+import collections
+import logging
+import string
+import subprocess
+import threading
+import time
+
+try:
+    import jeepney
+    from jeepney.io import blocking as jeepney_blocking
+    from jeepney import wrappers as jeepney_wrappers
+except ImportError:
+    jeepney = None
+
+ACTIONS = ['start', 'stop', 'restart']
+
+LOG = logging.getLogger("OpenLab HA HealthChecker")
+
+
+class SystemdError(Exception):
+    pass
+
+
+_PATH_CHARS = set(string.ascii_letters + string.digits)
+
+
+def _unit_name(unit):
+    if '.' in unit:
+        return unit
+    return unit + '.service'
+
+
+def _unit_path(unit):
+    """Return the D-Bus object path of unit, like sd_bus_path_encode."""
+    name = _unit_name(unit)
+    escaped = ''.join(
+        c if c in _PATH_CHARS and (i or not c.isdigit()) else '_%02x' % ord(c)
+        for i, c in enumerate(name))
+    return DBusManager.PATH + '/unit/' + escaped
+
+
+class SystemctlManager(object):
+    """Control the services with the systemctl command."""
+
+    def show(self, units, restarts=True):
+        """Read the state of units with one systemctl call.
+
+        :param restarts: Whether to read NRestarts too.
+        :return: a dict of unit to its ActiveState, SubState and NRestarts
+            properties.
+        """
+        cmd = ['systemctl', 'show', '-p', 'ActiveState,SubState' +
+               (',NRestarts' if restarts else '')]
+        try:
+            output = subprocess.check_output(cmd + list(units),
+                                             stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError) as e:
+            raise SystemdError(str(e))
+        # One block of properties per unit, in the order of the arguments.
+        blocks = output.decode('utf-8').strip().split('\n\n')
+        result = {}
+        for unit, block in zip(units, blocks):
+            result[unit] = dict(line.split('=', 1)
+                                for line in block.splitlines() if '=' in line)
+        return result
+
+    def run(self, action, units):
+        """Start, stop or restart units and wait for the jobs to finish.
+
+        :return: a dict of unit to the error message, None if the job
+            succeeded.
+        """
+        result = {}
+        processes = {}
+        # All the commands run at once, like the jobs of DBusManager.
+        for unit in units:
+            try:
+                processes[unit] = subprocess.Popen(
+                    ['systemctl', action, unit], stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT)
+            except OSError as e:
+                result[unit] = str(e)
+        for unit, process in processes.items():
+            output = process.communicate()[0]
+            if process.returncode == 0:
+                result[unit] = None
+            else:
+                result[unit] = "'systemctl %s %s' returned %s: %s" % (
+                    action, unit, process.returncode,
+                    output.decode('utf-8', 'replace').strip())
+        return result
+
+
+class _Bus(object):
+    """A connection to the system bus, opened on first use.
+
+    :param match_rule: The signals of manager to receive on the connection,
+        manager is subscribed to if it's set.
+    """
+
+    def __init__(self, timeout, match_rule=None, manager=None):
+        self.timeout = timeout
+        self.match_rule = match_rule
+        self.manager = manager
+        self.lock = threading.Lock()
+        self.connection = None
+
+    def connect(self):
+        if self.connection is not None:
+            return self.connection
+        try:
+            connection = jeepney_blocking.open_dbus_connection(bus='SYSTEM')
+        except (OSError, KeyError, jeepney.AuthenticationError) as e:
+            raise SystemdError("Failed to connect to the system bus: %s" % e)
+        self.connection = connection
+        if self.match_rule is not None:
+            try:
+                self.send(jeepney.message_bus.AddMatch(self.match_rule))
+                # systemd only emits the signals to its subscribers.
+                self.call(self.manager, 'Subscribe')
+            except SystemdError:
+                self.close()
+                raise
+        return connection
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def send(self, message):
+        if self.connection is None:
+            raise SystemdError("Not connected to the system bus.")
+        try:
+            reply = self.connection.send_and_get_reply(message,
+                                                       timeout=self.timeout)
+            return jeepney_wrappers.unwrap_msg(reply)
+        except (OSError, TimeoutError) as e:
+            # The connection can't be trusted anymore, reopen it next time.
+            self.close()
+            raise SystemdError(str(e))
+        except jeepney.DBusErrorResponse as e:
+            raise SystemdError(str(e))
+
+    def call(self, address, method, signature=None, body=()):
+        return self.send(jeepney.new_method_call(address, method, signature,
+                                                 body))
+
+
+class DBusManager(object):
+    """Control the services through the D-Bus API of systemd.
+
+    The jobs of all the units are queued at once, then their JobRemoved
+    signals are waited for, no process is spawned. The states are read on
+    another connection, so they aren't blocked by the jobs, all the units
+    in one call.
+
+    :param timeout: How many seconds to wait for the jobs at most.
+    """
+
+    BUS_NAME = 'org.freedesktop.systemd1'
+    PATH = '/org/freedesktop/systemd1'
+    MANAGER_INTERFACE = 'org.freedesktop.systemd1.Manager'
+    METHODS = {'start': 'StartUnit', 'stop': 'StopUnit',
+               'restart': 'RestartUnit'}
+
+    def __init__(self, timeout=90):
+        self.timeout = timeout
+        self._manager = jeepney.DBusAddress(
+            self.PATH, bus_name=self.BUS_NAME,
+            interface=self.MANAGER_INTERFACE)
+        self._job_removed = jeepney.MatchRule(
+            type='signal', sender=self.BUS_NAME,
+            interface=self.MANAGER_INTERFACE, member='JobRemoved',
+            path=self.PATH)
+        self._jobs = _Bus(timeout, self._job_removed, self._manager)
+        self._queries = _Bus(timeout)
+        # ListUnitsByNames is only there since systemd 230.
+        self._list_by_names = True
+
+    def connect(self):
+        for bus in (self._queries, self._jobs):
+            with bus.lock:
+                bus.connect()
+
+    def _get_property(self, path, interface, name):
+        address = jeepney.DBusAddress(path, bus_name=self.BUS_NAME,
+                                      interface=interface)
+        _, value = self._queries.send(jeepney.Properties(address).get(name))[0]
+        return str(value)
+
+    def _list_units(self, units):
+        """Return a dict of unit to its ActiveState, SubState and path.
+
+        The path is None if the unit isn't loaded.
+        """
+        if self._list_by_names:
+            try:
+                listed = self._queries.call(
+                    self._manager, 'ListUnitsByNames', 'as',
+                    ([_unit_name(unit) for unit in units],))[0]
+            except SystemdError as e:
+                if 'UnknownMethod' not in str(e):
+                    raise
+                self._list_by_names = False
+            else:
+                # One entry per name, in their order. The entry is named
+                # after the unit, not the alias it may be loaded by.
+                return dict(
+                    (unit, {'ActiveState': entry[3], 'SubState': entry[4],
+                            'path': entry[6] if entry[2] == 'loaded' else
+                            None})
+                    for unit, entry in zip(units, listed))
+        result = {}
+        for unit in units:
+            path = self._queries.call(self._manager, 'LoadUnit', 's',
+                                      (_unit_name(unit),))[0]
+            state = {'path': path}
+            for name in ('ActiveState', 'SubState'):
+                state[name] = self._get_property(
+                    path, 'org.freedesktop.systemd1.Unit', name)
+            result[unit] = state
+        return result
+
+    def show(self, units, restarts=True):
+        """Read the state of units.
+
+        :param restarts: Whether to read NRestarts too, it takes a call per
+            service.
+        """
+        with self._queries.lock:
+            self._queries.connect()
+            result = self._list_units(units)
+            for unit, state in result.items():
+                path = state.pop('path')
+                if (not restarts or path is None or
+                        not _unit_name(unit).endswith('.service')):
+                    continue
+                try:
+                    state['NRestarts'] = self._get_property(
+                        path, 'org.freedesktop.systemd1.Service',
+                        'NRestarts')
+                except SystemdError:
+                    # The unit isn't found, or systemd is older than 235.
+                    pass
+        return result
+
+    def run(self, action, units):
+        result = {}
+        with self._jobs.lock:
+            connection = self._jobs.connect()
+            queue = collections.deque()
+            # The filter is set before the jobs are queued, so the signals
+            # received along the replies aren't missed.
+            with connection.filter(self._job_removed, queue=queue):
+                jobs = {}
+                for unit in units:
+                    try:
+                        job = self._jobs.call(
+                            self._manager, self.METHODS[action], 'ss',
+                            (_unit_name(unit), 'replace'))
+                    except SystemdError as e:
+                        result[unit] = str(e)
+                        continue
+                    jobs[job[0]] = unit
+                deadline = time.monotonic() + self.timeout
+                while jobs:
+                    try:
+                        message = connection.recv_until_filtered(
+                            queue, timeout=max(deadline - time.monotonic(),
+                                               0))
+                    except (OSError, TimeoutError) as e:
+                        self._jobs.close()
+                        for unit in jobs.values():
+                            result[unit] = ('The %s job is not finished: %s'
+                                            % (action, str(e) or 'timed out'))
+                        break
+                    _, job, _, job_result = message.body
+                    unit = jobs.pop(job, None)
+                    if unit is not None:
+                        result[unit] = (None if job_result == 'done' else
+                                        'The %s job is %s' % (action,
+                                                              job_result))
+        return result
+
+
+class UnitWatcher(object):
+    """Call callback(unit, state) once the ActiveState of a unit changes.
+
+    It listens to the PropertiesChanged signals of systemd on its own D-Bus
+    connection, in a daemon thread. The callback must not block.
+    """
+
+    def __init__(self, units, callback):
+        # D-Bus object path -> unit
+        self.units = dict((_unit_path(unit), unit) for unit in units)
+        self.callback = callback
+        self._connection = None
+        self._queue = collections.deque()
+
+    def start(self):
+        if jeepney is None:
+            raise SystemdError("jeepney is not installed.")
+        try:
+            connection = jeepney_blocking.open_dbus_connection(bus='SYSTEM')
+        except (OSError, KeyError, jeepney.AuthenticationError) as e:
+            raise SystemdError("Failed to connect to the system bus: %s" % e)
+        rule = jeepney.MatchRule(
+            type='signal', sender=DBusManager.BUS_NAME,
+            interface='org.freedesktop.DBus.Properties',
+            member='PropertiesChanged',
+            path_namespace=DBusManager.PATH + '/unit')
+        rule.add_arg_condition(0, 'org.freedesktop.systemd1.Unit')
+        manager = jeepney.DBusAddress(
+            DBusManager.PATH, bus_name=DBusManager.BUS_NAME,
+            interface=DBusManager.MANAGER_INTERFACE)
+        try:
+            for message in (jeepney.message_bus.AddMatch(rule),
+                            jeepney.new_method_call(manager, 'Subscribe')):
+                jeepney_wrappers.unwrap_msg(
+                    connection.send_and_get_reply(message, timeout=10))
+        except (OSError, TimeoutError, jeepney.DBusErrorResponse) as e:
+            connection.close()
+            raise SystemdError(str(e))
+        connection.filter(rule, queue=self._queue)
+        self._connection = connection
+        thread = threading.Thread(target=self._run, args=(connection,))
+        thread.daemon = True
+        thread.start()
+
+    def _run(self, connection):
+        while True:
+            try:
+                message = connection.recv_until_filtered(self._queue)
+            except (OSError, ValueError):
+                # Closed by stop.
+                return
+            _, changed, _ = message.body
+            unit = self.units.get(
+                message.header.fields.get(jeepney.HeaderFields.path))
+            if unit is None or 'ActiveState' not in changed:
+                continue
+            try:
+                self.callback(unit, changed['ActiveState'][1])
+            except Exception:
+                LOG.exception("Error in unit watcher callback")
+
+    def stop(self):
+        connection, self._connection = self._connection, None
+        if connection is not None:
+            connection.close()
+
+
+_manager = None
+
+
+def get_manager():
+    """Return the service manager of this host.
+
+    It's the D-Bus one if jeepney is installed and the system bus is
+    reachable, otherwise systemctl.
+    """
+    global _manager
+    if _manager is None:
+        manager = SystemctlManager()
+        if jeepney is not None:
+            try:
+                dbus_manager = DBusManager()
+                dbus_manager.connect()
+                manager = dbus_manager
+            except SystemdError as e:
+                LOG.warning("Falling back to systemctl: %s", e)
+        _manager = manager
+    return _manager
@@ -0,0 +1,229 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from ha_healthchecker import metrics
+
+LOG = logging.getLogger("OpenLab HA HealthChecker")
+
+STATE_FILE = '/var/lib/ha_healthchecker/alerts.json'
+
+
+class AlertQueue(object):
+    """Send the alerts from a background thread.
+
+    `put` only queues the alert, so the health loop never waits for the
+    network. The urgent alerts are sent first, then the others in order, a
+    failed one is retried with an exponential backoff and doesn't hold the
+    next ones. The alerts with the same key are coalesced: while one is
+    queued the duplicates are counted, the ones raised while it's sent are
+    counted in the next alert with that key. The duplicates of an alert
+    sent less than window seconds ago are dropped. The queue is saved to
+    state_file, so the alerts survive a restart.
+
+    :param send: Called as send(title, body) to send an alert, it raises on
+        failure.
+    :param max_size: How many alerts can be queued, the new ones are dropped
+        once the queue is full.
+    :param window: The seconds during which the duplicates of a sent alert
+        are dropped.
+    """
+
+    def __init__(self, send, state_file=STATE_FILE, max_size=100,
+                 window=3600, retry_delay=10, max_retry_delay=600,
+                 max_attempts=10):
+        self.send = send
+        self.state_file = state_file
+        self.max_size = max_size
+        self.window = window
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_attempts = max_attempts
+        self._cond = threading.Condition()
+        # The alert dicts waiting to be sent, in order.
+        self._pending = []
+        # alert key -> when it was last sent
+        self._sent = {}
+        # alert key -> the duplicates raised while it was sent, they're
+        # counted in the next alert with that key.
+        self._carried = {}
+        # Whether the queue changed since it was saved.
+        self._dirty = False
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        self._load()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        with self._cond:
+            state = self._state()
+        self._save(state)
+
+    def put(self, key, title, body, urgent=False):
+        """Queue an alert.
+
+        :param key: A tuple of strings which identifies the problem, like
+            (issue type, node name, service name).
+        :param urgent: Send it before the other alerts.
+        """
+        key = list(key)
+        now = time.time()
+        with self._cond:
+            for alert in self._pending:
+                if alert['key'] == key:
+                    alert['count'] += 1
+                    alert['urgent'] = alert.get('urgent') or urgent
+                    self._dirty = True
+                    return
+            sent_at = self._sent.get(tuple(key))
+            if sent_at is not None and now - sent_at < self.window:
+                LOG.debug("Alert %s was sent at %s, skip it.", key,
+                          time.ctime(sent_at))
+                return
+            if len(self._pending) >= self.max_size:
+                LOG.error("The alert queue is full, drop the alert %s.", key)
+                metrics.incr('alerts', result='dropped')
+                return
+            self._pending.append({
+                'key': key, 'title': title, 'body': body,
+                'count': 1 + self._carried.pop(tuple(key), 0),
+                'attempts': 0, 'next_attempt': now, 'urgent': urgent})
+            self._dirty = True
+            self._cond.notify()
+
+    def _load(self):
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            LOG.warning("Failed to load the alerts from %s: %s",
+                        self.state_file, e)
+            return
+        with self._cond:
+            self._pending = []
+            for alert in state.get('pending', []):
+                self._merge(alert)
+            self._sent = dict((tuple(key), sent_at)
+                              for key, sent_at in state.get('sent', []))
+            self._carried = dict((tuple(key), count)
+                                 for key, count in state.get('carried', []))
+        if self._pending:
+            LOG.info("Loaded %s alerts to send from %s.", len(self._pending),
+                     self.state_file)
+
+    def _merge(self, alert):
+        """Queue a loaded alert, or count it in the queued one.
+
+        Must be called with _cond held.
+        """
+        for pending in self._pending:
+            if pending['key'] == alert['key']:
+                pending['count'] += alert['count']
+                pending['urgent'] = (pending.get('urgent') or
+                                     alert.get('urgent'))
+                return
+        self._pending.append(alert)
+
+    def _state(self):
+        now = time.time()
+        for key, sent_at in list(self._sent.items()):
+            if now - sent_at >= self.window:
+                del self._sent[key]
+        self._dirty = False
+        return {'pending': [dict(alert) for alert in self._pending],
+                'sent': [[list(key), sent_at]
+                         for key, sent_at in self._sent.items()],
+                'carried': [[list(key), count]
+                            for key, count in self._carried.items()]}
+
+    def _save(self, state):
+        tmp_file = self.state_file + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+            with open(tmp_file, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_file, self.state_file)
+        except OSError as e:
+            LOG.warning("Failed to save the alerts to %s: %s",
+                        self.state_file, e)
+
+    def _wait(self):
+        """Return the alert to send, None if the queue must be saved first.
+
+        Must be called with _cond held.
+        """
+        while not self._stopped and not self._dirty:
+            now = time.time()
+            due = [alert for alert in self._pending
+                   if alert['next_attempt'] <= now]
+            if due:
+                return min(due, key=lambda alert: (not alert.get('urgent'),
+                                                   alert['next_attempt']))
+            delay = None
+            if self._pending:
+                delay = min(alert['next_attempt']
+                            for alert in self._pending) - now
+            self._cond.wait(delay)
+        return None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                alert = self._wait()
+                if self._stopped:
+                    return
+                state = self._state() if self._dirty else None
+                # The duplicates raised from now on are for the next send.
+                count = alert['count'] if alert is not None else 0
+            if state is not None:
+                self._save(state)
+            if alert is not None:
+                self._send(alert, count)
+
+    def _send(self, alert, count):
+        body = alert['body']
+        if count > 1:
+            body += "\nThe alarm was raised %s times.\n" % count
+        try:
+            self.send(alert['title'], body)
+        except Exception as e:
+            metrics.incr('alerts', result='failed')
+            with self._cond:
+                alert['attempts'] += 1
+                if alert['attempts'] >= self.max_attempts:
+                    LOG.error("Failed to send the alert %s %s times, drop "
+                              "it: %s", alert['key'], alert['attempts'], e)
+                    self._pending.remove(alert)
+                else:
+                    delay = min(
+                        self.retry_delay * 2 ** (alert['attempts'] - 1),
+                        self.max_retry_delay)
+                    alert['next_attempt'] = time.time() + delay
+                    LOG.warning("Failed to send the alert %s, retry in %s "
+                                "seconds: %s", alert['key'], delay, e)
+                self._dirty = True
+            return
+        LOG.info("Sent the alert %s.", alert['key'])
+        metrics.incr('alerts', result='sent')
+        with self._cond:
+            self._pending.remove(alert)
+            key = tuple(alert['key'])
+            self._sent[key] = time.time()
+            if alert['count'] > count:
+                self._carried[key] = (self._carried.get(key, 0) +
+                                      alert['count'] - count)
+            self._dirty = True
@@ -0,0 +1,157 @@
+from concurrent import futures
+import logging
+import threading
+
+import requests
+from requests import adapters
+
+LOG = logging.getLogger("OpenLab HA HealthChecker")
+
+# The zone of the failover records.
+DOMAIN_NAME = 'openlabtesting.org'
+
+
+class DNSError(Exception):
+    pass
+
+
+class DNSimpleClient(object):
+    """A client of the DNSimple v2 API for the failover records.
+
+    The connections are pooled, and the account and the record ids are
+    cached, so that a switch usually costs one PATCH per record, all of
+    them sent at once.
+
+    :param timeout: The (connect, read) timeouts of every request, in
+        seconds.
+    """
+
+    def __init__(self, api_url, token, account, zone=DOMAIN_NAME,
+                 timeout=(3.05, 10), max_workers=4):
+        self.api_url = api_url
+        self.token = token
+        self.account = account
+        self.zone = zone
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.session = requests.Session()
+        self.session.headers.update({'Authorization': "Bearer %s" % token,
+                                     'Accept': 'application/json'})
+        self.session.mount(api_url, adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=max_workers))
+        self._lock = threading.Lock()
+        self._account_id = None
+        # (domain, content) -> the id of the A record of domain to content
+        self._record_ids = {}
+
+    def _request(self, method, path, **kwargs):
+        try:
+            res = self.session.request(method, self.api_url + path,
+                                       timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            raise DNSError("%s %s failed: %s" % (method, path, e))
+        if res.status_code != 200:
+            raise DNSError("%s %s failed: code-status %s, message: %s" % (
+                method, path, res.status_code, res.reason))
+        try:
+            return res.json()['data']
+        except (ValueError, KeyError) as e:
+            raise DNSError("%s %s returned an invalid body: %s" % (
+                method, path, e))
+
+    def _record_name(self, domain):
+        # test-status.openlabtesting.org -> test-status
+        return domain.split(self.zone)[0][:-1]
+
+    def account_id(self):
+        if self._account_id is None:
+            for account in self._request('GET', 'accounts'):
+                if account['id'] == self.account:
+                    self._account_id = account['id']
+                    break
+            else:
+                raise DNSError("Failed to get the account_id")
+        return self._account_id
+
+    def _lookup_record_id(self, domain, content):
+        name = self._record_name(domain)
+        records = self._request(
+            'GET', '%s/zones/%s/records' % (self.account_id(), self.zone),
+            params={'name': name})
+        for record in records:
+            if (record['name'] == name and record['type'] == 'A' and
+                    record['content'] == content):
+                with self._lock:
+                    self._record_ids[(domain, content)] = record['id']
+                return record['id']
+        raise DNSError("Failed to get the record_id by name %s" % domain)
+
+    def record_id(self, domain, content):
+        """Return the id of the A record of domain to content."""
+        record_id = self._record_ids.get((domain, content))
+        if record_id is None:
+            record_id = self._lookup_record_id(domain, content)
+        return record_id
+
+    def refresh(self, domains, content):
+        """Look the records up again, so the switch doesn't have to."""
+        for domain in domains:
+            try:
+                self._lookup_record_id(domain, content)
+            except DNSError as e:
+                LOG.warning("Failed to refresh the DNS record of %s: %s",
+                            domain, e)
+
+    def _update_record(self, domain, old_content, new_content):
+        record_id = self.record_id(domain, old_content)
+        result = self._request(
+            'PATCH', '%s/zones/%s/records/%s' % (self.account_id(), self.zone,
+                                                 record_id),
+            json={'content': new_content})
+        if result.get('content') != new_content:
+            raise DNSError("The record of %s still points to %s" % (
+                domain, result.get('content')))
+        with self._lock:
+            self._record_ids.pop((domain, old_content), None)
+            self._record_ids[(domain, new_content)] = record_id
+
+    def update_records(self, domains, old_content, new_content):
+        """Point the A records of domains from old_content to new_content.
+
+        The records are updated at once.
+
+        :return: a dict of domain to the error message, None if the record
+            is updated.
+        """
+        result = {}
+        with futures.ThreadPoolExecutor(
+                min(len(domains), self.max_workers) or 1) as executor:
+            jobs = dict((domain, executor.submit(
+                self._update_record, domain, old_content, new_content))
+                for domain in domains)
+            for domain, job in jobs.items():
+                try:
+                    job.result()
+                    result[domain] = None
+                except DNSError as e:
+                    result[domain] = str(e)
+        return result
+
+
+_client = None
+
+
+def get_client(cluster_config):
+    """Return the DNS client of the cluster configuration.
+
+    The client is kept as long as the DNS provider options don't change.
+    """
+    global _client
+    if (_client is None or
+            _client.api_url != cluster_config.dns_provider_api_url or
+            _client.token != cluster_config.dns_provider_token or
+            _client.account != cluster_config.dns_provider_account):
+        _client = DNSimpleClient(cluster_config.dns_provider_api_url,
+                                 cluster_config.dns_provider_token,
+                                 cluster_config.dns_provider_account)
+    return _client
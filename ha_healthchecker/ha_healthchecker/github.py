@@ -5,14 +5,29 @@ from github import Github
 from html.parser import HTMLParser
 import requests
 
+from ha_healthchecker import alert
+
 
 class GithubAction(object):
-    def __init__(self, cluster_config):
+    # The cluster options the Github client is built from.
+    CLIENT_OPTIONS = ['github_user_token', 'github_repo', 'github_app_name']
+    # The issues which are posted before the others.
+    URGENT_ISSUES = ['switch']
+
+    def __init__(self, cluster_config, alert_state_file=alert.STATE_FILE):
         self.cluster_config = cluster_config
         self.token = cluster_config.github_user_token
         self.repo_name = cluster_config.github_repo
         self.app_name = cluster_config.github_app_name
         self.repo = Github(login_or_token=self.token).get_repo(self.repo_name)
+        # The issues are posted in the background once start is called.
+        self.alerts = alert.AlertQueue(self.post_issue, alert_state_file)
+
+    def start(self):
+        self.alerts.start()
+
+    def stop(self):
+        self.alerts.stop()
 
     def _format_body_for_issue(self, issuer_node, issue_type, affect_node=None,
                                affect_services=None):
@@ -102,11 +117,17 @@ class GithubAction(object):
 
     def create_issue(self, issuer_node, issue_type, affect_node=None,
                      affect_services=None):
+        """Queue an issue, the duplicates of a recent one are coalesced."""
         title, body = self._format_body_for_issue(
             issuer_node, issue_type, affect_node=affect_node,
             affect_services=affect_services)
-        self.repo.create_issue(
-            title=title, body=body)
+        key = (issue_type, (affect_node or issuer_node).name,
+               affect_services.name if affect_services else None)
+        self.alerts.put(key, title, body,
+                        urgent=issue_type in self.URGENT_ISSUES)
+
+    def post_issue(self, title, body):
+        self.repo.create_issue(title=title, body=body)
 
     def _get_login_page_authenticity_token(self, session):
         login_page = session.get('https://github.com/login')
@@ -0,0 +1,179 @@
+import collections
+import time
+
+
+class _ServiceState(object):
+    def __init__(self, status, restarted_count, window):
+        # The status last written to zookeeper.
+        self.status = status
+        # The last samples, True if the service was up.
+        self.samples = collections.deque(maxlen=window)
+        # The times the service went from up to down, and was restarted.
+        self.failures = collections.deque()
+        # The NRestarts counter of the unit at the last sample.
+        self.unit_restarts = None
+        # restarted_count is the number of restarts in the flap window when
+        # it was written, they're taken as done now.
+        now = time.monotonic()
+        self.restarts = collections.deque([now] * (restarted_count or 0))
+
+    def streak(self, up):
+        """How many of the last samples are up (or down) in a row."""
+        count = 0
+        for sample in reversed(self.samples):
+            if sample != up:
+                break
+            count += 1
+        return count
+
+
+class ServiceTracker(object):
+    """Decide the status of the local services from their recent samples.
+
+    The samples live in memory across the cycles, zookeeper is only written
+    when a service changes its status or is restarted. The restarted_count
+    written is always the number of restarts in flap_window, so a new
+    tracker starts from it after a restart of the healthchecker.
+
+    :param fail_samples: How many down samples in a row turn an up service
+        to restarting.
+    :param recover_samples: How many up samples in a row turn a restarting
+        or down service back up.
+    :param flap_window: The seconds over which the failures and the restarts
+        of a service are counted.
+    :param flap_threshold: How many failures in flap_window make a service
+        flapping. A flapping service is set down instead of being restarted,
+        until it fails less. The restarts done by systemd itself count as
+        failures, so a crash loop is found even if the samples are up.
+    :param restart_interval: The minimum seconds between two restarts of a
+        service, it gives a slow service the time to start.
+    """
+
+    def __init__(self, fail_samples=2, recover_samples=1, flap_window=1800,
+                 flap_threshold=5, restart_interval=60):
+        self.fail_samples = max(fail_samples, 1)
+        self.recover_samples = max(recover_samples, 1)
+        self.flap_window = flap_window
+        self.flap_threshold = flap_threshold
+        self.restart_interval = restart_interval
+        self._states = {}
+
+    def _get_state(self, service_obj):
+        state = self._states.get(service_obj.name)
+        if state is None or (service_obj.status == 'initializing' and
+                             state.status != 'initializing'):
+            # New, or created again for another role of the node.
+            state = _ServiceState(
+                service_obj.status, service_obj.restarted_count,
+                max(self.fail_samples, self.recover_samples))
+            self._states[service_obj.name] = state
+        elif state.status != service_obj.status:
+            # Changed by hand, or the last write failed.
+            state.status = service_obj.status
+        return state
+
+    def _expire(self, state, now):
+        for times in (state.failures, state.restarts):
+            while times and times[0] <= now - self.flap_window:
+                times.popleft()
+
+    def _is_flapping(self, state):
+        return len(state.failures) >= self.flap_threshold
+
+    def sample(self, service_obj, up, max_restarts, unit_restarts=None):
+        """Record a sample of the service.
+
+        :param up: Whether the service was found up.
+        :param max_restarts: How many restarts in flap_window are tried
+            before the service is set down.
+        :param unit_restarts: The NRestarts counter of the unit, None if
+            it's unknown.
+        :return: a dict of the fields to update in zookeeper, empty if the
+            status of the service doesn't change.
+        """
+        now = time.monotonic()
+        state = self._get_state(service_obj)
+        if unit_restarts is not None:
+            # The counter is reset when the unit is started by hand.
+            if (state.unit_restarts is not None and
+                    unit_restarts > state.unit_restarts):
+                state.failures.extend(
+                    [now] * min(unit_restarts - state.unit_restarts,
+                                self.flap_threshold))
+            state.unit_restarts = unit_restarts
+        if not up and state.samples and state.samples[-1]:
+            state.failures.append(now)
+        state.samples.append(up)
+        self._expire(state, now)
+
+        if up:
+            if self._is_flapping(state):
+                if state.status in ('initializing', 'up'):
+                    return self._transit(
+                        state, status='down',
+                        restarted_count=len(state.restarts))
+                return {}
+            if state.status == 'initializing' or (
+                    state.status in ('restarting', 'down') and
+                    state.streak(True) >= self.recover_samples):
+                return self._transit(state, status='up', restarted=False,
+                                     alarmed=False,
+                                     restarted_count=len(state.restarts))
+            return {}
+        if state.status in ('initializing', 'up'):
+            if state.streak(False) < self.fail_samples:
+                return {}
+            if (not self._is_flapping(state) and
+                    len(state.restarts) < max_restarts):
+                return self._transit(state, status='restarting',
+                                     restarted=True)
+        elif (state.status != 'restarting' or
+                (not self._is_flapping(state) and
+                 len(state.restarts) < max_restarts)):
+            return {}
+        return self._transit(state, status='down',
+                             restarted_count=len(state.restarts))
+
+    def _transit(self, state, **update_dict):
+        state.status = update_dict['status']
+        return update_dict
+
+    def is_flapping(self, name):
+        state = self._states.get(name)
+        return state is not None and self._is_flapping(state)
+
+    def suspects(self):
+        """Return the up services which were just found down.
+
+        They're restarted if they're still down fail_samples times in a row.
+        """
+        return sorted(
+            name for name, state in self._states.items()
+            if state.status in ('initializing', 'up') and
+            0 < state.streak(False) < self.fail_samples)
+
+    def can_restart(self, name, max_restarts):
+        """Whether a restarting service may be restarted now.
+
+        :param max_restarts: How many restarts in flap_window are allowed.
+        """
+        state = self._states.get(name)
+        if state is None:
+            return True
+        self._expire(state, time.monotonic())
+        if self._is_flapping(state) or len(state.restarts) >= max_restarts:
+            return False
+        return not state.restarts or (
+            time.monotonic() - state.restarts[-1] >= self.restart_interval)
+
+    def record_restart(self, name):
+        """Record a restart of the service.
+
+        :return: the restarts of the service in flap_window, None if it's
+            not tracked.
+        """
+        state = self._states.get(name)
+        if state is None:
+            return None
+        state.restarts.append(time.monotonic())
+        return len(state.restarts)
@@ -0,0 +1,76 @@
+import logging
+from logging import handlers
+import os
+import queue
+
+LOG_FILE = '/var/log/ha_healthchecker/ha_healthchecker.log'
+LOG_FORMAT = '%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s'
+LEVELS = ['DEBUG', 'INFO', 'ERROR']
+
+_listener = None
+_queue_handler = None
+
+
+class _QueueHandler(handlers.QueueHandler):
+    """Queue the records, drop them if the queue is full.
+
+    The writer thread is behind when the disk stalls, the health checks
+    must not wait for it.
+    """
+
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _QueueListener(handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # The queue may be full, wait for the writer to make room.
+        self.queue.put(self._sentinel)
+
+
+def setup(level='DEBUG', log_file=LOG_FILE, max_records=10000):
+    """Send the logs of the process to log_file, from a background thread.
+
+    The loggers only put the records in a queue, a QueueListener writes
+    them to the rotated log file. It's done once, the next calls only set
+    the level.
+    """
+    global _listener, _queue_handler
+    if _listener is None:
+        os.makedirs(os.path.dirname(log_file), exist_ok=True)
+        file_handler = handlers.RotatingFileHandler(
+            log_file, maxBytes=10*1024*1024, backupCount=5)
+        file_handler.setFormatter(logging.Formatter(LOG_FORMAT,
+                                                    datefmt='%H:%M:%S'))
+        records = queue.Queue(max_records)
+        _queue_handler = _QueueHandler(records)
+        _listener = _QueueListener(records, file_handler)
+        _listener.start()
+        logging.getLogger().addHandler(_queue_handler)
+    set_level(level)
+
+
+def set_level(level):
+    """Set the level of all the loggers, one of LEVELS."""
+    logging.getLogger().setLevel(getattr(logging, level.upper()))
+
+
+def stop():
+    """Write the queued records and stop the background thread."""
+    global _listener, _queue_handler
+    if _listener is None:
+        return
+    logging.getLogger().removeHandler(_queue_handler)
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    if _queue_handler.dropped:
+        logging.getLogger("OpenLab HA HealthChecker").warning(
+            "%s log records were dropped, the log file couldn't keep up.",
+            _queue_handler.dropped)
+    _listener = _queue_handler = None
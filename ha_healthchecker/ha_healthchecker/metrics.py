@@ -0,0 +1,189 @@
+import contextlib
+from http import server
+import logging
+import re
+import socket
+import socketserver
+import threading
+import time
+
+LOG = logging.getLogger("OpenLab HA HealthChecker")
+
+PREFIX = 'openlab_ha'
+
+
+def _parse_address(address, default_host):
+    host, _, port = address.rpartition(':')
+    try:
+        return host or default_host, int(port)
+    except ValueError:
+        raise ValueError("%s should be in the host:port format." % address)
+
+
+def _statsd_name(value):
+    return re.sub(r'[^a-zA-Z0-9_-]', '_', str(value))
+
+
+class StatsdClient(object):
+    """Send the metrics to StatsD over UDP, fire and forget."""
+
+    def __init__(self, host, port, prefix):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+    def send(self, name, labels, value, kind):
+        # StatsD has no labels, their values are part of the name.
+        parts = [self.prefix, name] + [_statsd_name(label_value)
+                                       for _, label_value in labels]
+        line = '%s:%s|%s' % ('.'.join(parts), value, kind)
+        try:
+            self.socket.sendto(line.encode('utf8'), self.address)
+        except OSError as e:
+            LOG.debug("Failed to send %s to statsd: %s", line, e)
+
+
+class Registry(object):
+    """Keep the metrics of the healthchecker.
+
+    The counters, gauges and timers are kept for the Prometheus endpoint
+    and sent to StatsD as they're updated, if StatsD is configured. A
+    metric is identified by its name and its labels.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        # key -> [count, sum of the seconds]
+        self._timers = {}
+        self.statsd = None
+        self._http_server = None
+
+    def incr(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        if self.statsd is not None:
+            self.statsd.send(name, key[1], value, 'c')
+
+    def gauge(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+        if self.statsd is not None:
+            self.statsd.send(name, key[1], value, 'g')
+
+    def timing(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            timer = self._timers.setdefault(key, [0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+        if self.statsd is not None:
+            self.statsd.send(name, key[1], int(seconds * 1000), 'ms')
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Record the time spent in the with block."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.timing(name, time.monotonic() - start, **labels)
+
+    @staticmethod
+    def _sample(name, labels, value):
+        if labels:
+            name += '{%s}' % ','.join(
+                '%s="%s"' % (label, str(label_value).replace('"', '\\"'))
+                for label, label_value in labels)
+        return '%s %s' % (name, value)
+
+    def render(self):
+        """Return the metrics in the Prometheus text format."""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+            timers = sorted(self._timers.items())
+        lines = []
+        seen = set()
+
+        def add_type(name, kind):
+            if name not in seen:
+                seen.add(name)
+                lines.append('# TYPE %s %s' % (name, kind))
+
+        for (name, labels), value in counters:
+            metric = '%s_%s_total' % (PREFIX, name)
+            add_type(metric, 'counter')
+            lines.append(self._sample(metric, labels, value))
+        for (name, labels), value in gauges:
+            metric = '%s_%s' % (PREFIX, name)
+            add_type(metric, 'gauge')
+            lines.append(self._sample(metric, labels, value))
+        for (name, labels), (count, total) in timers:
+            metric = '%s_%s_seconds' % (PREFIX, name)
+            add_type(metric, 'summary')
+            lines.append(self._sample(metric + '_count', labels, count))
+            lines.append(self._sample(metric + '_sum', labels, total))
+        return '\n'.join(lines) + '\n'
+
+    def configure(self, statsd=None, prometheus=None):
+        """Set up the exporters.
+
+        :param statsd: The host:port of StatsD, None to not send to it.
+        :param prometheus: The [host]:port to serve /metrics on, None to not
+            serve it. The host defaults to all the interfaces.
+        """
+        if statsd:
+            host, port = _parse_address(statsd, 'localhost')
+            self.statsd = StatsdClient(
+                host, port,
+                '%s.%s' % (PREFIX, _statsd_name(socket.gethostname())))
+        if prometheus:
+            self._http_server = _HTTPServer(_parse_address(prometheus, ''),
+                                            _handler(self))
+            thread = threading.Thread(target=self._http_server.serve_forever)
+            thread.daemon = True
+            thread.start()
+
+    def shutdown(self):
+        if self._http_server is not None:
+            self._http_server.shutdown()
+            self._http_server.server_close()
+            self._http_server = None
+
+
+class _HTTPServer(socketserver.ThreadingMixIn, server.HTTPServer):
+    # Like server.ThreadingHTTPServer, which is not in python 3.5 and 3.6.
+    daemon_threads = True
+
+
+def _handler(registry):
+    class MetricsHandler(server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf8')
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            LOG.debug("metrics endpoint: " + format, *args)
+
+    return MetricsHandler
+
+
+# The registry of the process, the actions report to it.
+REGISTRY = Registry()
+incr = REGISTRY.incr
+gauge = REGISTRY.gauge
+timing = REGISTRY.timing
+timer = REGISTRY.timer
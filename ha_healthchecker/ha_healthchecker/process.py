@@ -1,17 +1,30 @@
 #!/usr/bin/python3
 import base64
 import configparser
+import datetime
 import logging
-from logging import handlers
-import os
+import socket
+import threading
 
+from apscheduler.jobstores import base as jobstores_base
 from apscheduler.schedulers import blocking
+from openlabcmd import exceptions
+from openlabcmd import node
+from openlabcmd import service
 from openlabcmd import zk
 
+from ha_healthchecker.action import probe
+from ha_healthchecker.action import systemd
 from ha_healthchecker.action import refresher
 from ha_healthchecker.action import fixer
 from ha_healthchecker.action import switcher
+from ha_healthchecker import dnsimple
 from ha_healthchecker import github
+from ha_healthchecker import health
+from ha_healthchecker import log
+from ha_healthchecker import metrics
+from ha_healthchecker import snapshot
+from ha_healthchecker import timeline
 
 
 class ClusterConfig(object):
@@ -19,73 +32,299 @@ class ClusterConfig(object):
                               'github_user_token']
 
     def __init__(self, zk_client):
+        # The options as stored in zookeeper, before decoding.
+        self._raw_options = {}
+        # (callback, option names) tuples, see subscribe.
+        self._subscribers = []
         self._init_options(zk_client)
         self._set_log()
 
     def _init_options(self, zk_client):
-        for attr, value in zk_client.list_configuration().items():
+        options = zk_client.list_configuration()
+        for attr, value in options.items():
             if value is None:
                 raise Exception("Openlab HA related options haven't been "
                                 "initialized, try 'openlab ha config list'"
                                 " to get more detail.")
+        self._update_options(options)
+
+    def _update_options(self, options):
+        """Decode and set the changed options, return their names."""
+        changed = set()
+        for attr, value in options.items():
+            if attr in self._raw_options and self._raw_options[attr] == value:
+                continue
+            self._raw_options[attr] = value
             if attr in self.BASE64_ENCODED_OPTIONS:
                 value = base64.b64decode(value).decode("utf-8").split('\n')[0]
             setattr(self, attr, value)
+            changed.add(attr)
+        return changed
+
+    def subscribe(self, callback, options=None):
+        """Call callback(cluster_config) once a refresh changes options.
+
+        :param options: The option names to watch, None means all of them.
+        """
+        self._subscribers.append((callback, options))
 
     def _set_log(self):
-        file_dir = '/var/log/ha_healthchecker'
-        log_file = '/var/log/ha_healthchecker/ha_healthchecker.log'
-        if not os.path.isdir(file_dir):
-            os.makedirs(file_dir)
-        if not os.path.exists(log_file):
-            os.system('touch %s' % log_file)
-        if not self.logging_level.upper() in ['DEBUG', 'INFO', 'ERROR']:
+        # The log file is set up once by HealthChecker.run, only the level
+        # follows the configuration.
+        if not self.logging_level.upper() in log.LEVELS:
             # use the default level
             self.logging_level = 'DEBUG'
-        rt_handler = handlers.RotatingFileHandler(
-            log_file, maxBytes=10*1024*1024, backupCount=5)
-        logging.basicConfig(
-            format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
-            datefmt='%H:%M:%S',
-            level=getattr(logging, self.logging_level.upper()),
-            handlers=[rt_handler])
+        log.set_level(self.logging_level)
         self.LOG = logging.getLogger("OpenLab HA HealthChecker")
 
     def refresh(self, zk_client):
-        for attr, value in zk_client.list_configuration().items():
-            if attr in self.BASE64_ENCODED_OPTIONS:
-                value = base64.b64decode(value).decode("utf-8").split('\n')[0]
-            setattr(self, attr, value)
-        self._set_log()
+        changed = self._update_options(zk_client.list_configuration())
+        if 'logging_level' in changed:
+            self._set_log()
+        for callback, options in self._subscribers:
+            if changed and (options is None or changed.intersection(options)):
+                callback(self)
 
 
 class HealthChecker(object):
+    JOB_ID = 'health-cycle'
+    # How many seconds a cycle waits for the zookeeper connection to be back.
+    reconnect_timeout = 60
+    # The seconds between two cycles when nothing happens. With the event
+    # triggers, it's only the safety net for the missed events.
+    sweep_interval = 120
+    # A triggered cycle is delayed a bit, so a burst of events is handled
+    # by one cycle.
+    trigger_delay = 1
+    # The ActiveState values a unit settles to, the transient ones
+    # (activating, deactivating) don't trigger a cycle.
+    settled_unit_states = ('active', 'inactive', 'failed')
+    # The seconds between two lookups of the DNS records, so that the
+    # switch finds their ids cached.
+    dns_refresh_interval = 600
+    # The seconds before a local service which was just found down is
+    # checked again, see health.ServiceTracker.
+    recheck_delay = 10
+
     def __init__(self, config_file):
         zk_cfg = configparser.ConfigParser()
         zk_cfg.read(config_file)
-        self.zk_client = zk.ZooKeeper(zk_cfg)
+        # The session lives as long as the daemon, so the reads are served
+        # from the watched mirror of /ha.
+        self.zk_client = zk.ZooKeeper(zk_cfg, use_cache=True)
+        self.event_driven = zk_cfg.getboolean(
+            'ha', 'healthchecker_event_driven', fallback=True)
+        self.statsd = zk_cfg.get('ha', 'healthchecker_statsd', fallback='')
+        self.prometheus = zk_cfg.get('ha', 'healthchecker_prometheus',
+                                     fallback='')
+        self.service_tracker = health.ServiceTracker(
+            fail_samples=zk_cfg.getint(
+                'ha', 'healthchecker_service_fail_samples', fallback=2),
+            recover_samples=zk_cfg.getint(
+                'ha', 'healthchecker_service_recover_samples', fallback=1),
+            flap_window=zk_cfg.getint(
+                'ha', 'healthchecker_service_flap_window', fallback=1800),
+            flap_threshold=zk_cfg.getint(
+                'ha', 'healthchecker_service_flap_threshold', fallback=5))
         self.cluster_config = None
         self.github = None
+        self.scheduler = None
+        self.unit_watcher = None
+        self._cycle_lock = threading.Lock()
+        self._running = False
+        self._pending = False
+        # /ha path -> the state of the node or service which was last seen,
+        # see _on_ha_change.
+        self._seen = {}
 
     def _refresh(self):
         self.cluster_config.refresh(self.zk_client)
-        self.github.refresh(self.cluster_config)
 
     def _action(self):
-        if self.zk_client.client is None:
-            self.zk_client.connect()
+        if not self.zk_client.wait_connected(self.reconnect_timeout):
+            self.cluster_config.LOG.warning(
+                "Zookeeper is unreachable, skip the cycle.")
+            return
+        try:
+            self._cycle()
+        except exceptions.ConnectionLostError as e:
+            self.cluster_config.LOG.warning(
+                "%s, resume the cycle once reconnected.", e)
+            if self.zk_client.wait_connected(self.reconnect_timeout):
+                self._cycle()
+            else:
+                self.cluster_config.LOG.warning(
+                    "Zookeeper is unreachable, skip the cycle.")
+
+    def _cycle(self):
         self._refresh()
-        refresher.Refresher(self.zk_client, self.cluster_config).run()
-        fixer.Fixer(self.zk_client, self.cluster_config, self.github).run()
-        switcher.Switcher(self.zk_client, self.cluster_config,
-                          self.github).run()
-        self.zk_client.disconnect()
+        # All the actions of the cycle work on the same view of the cluster.
+        cluster = snapshot.ClusterSnapshot(self.zk_client)
+        prober = probe.Prober()
+        # Probe the other nodes in the background while the local services
+        # are checked.
+        prober.start([node_obj.ip for node_obj in cluster.list_nodes()
+                      if node_obj.name != socket.gethostname()])
+        try:
+            with metrics.timer('action', action='refresher'):
+                refresher.Refresher(self.zk_client, self.cluster_config,
+                                    prober, cluster,
+                                    self.service_tracker).run()
+            with metrics.timer('action', action='fixer'):
+                fixer.Fixer(self.zk_client, self.cluster_config,
+                            self.github, prober, cluster,
+                            self.service_tracker).run()
+            with metrics.timer('action', action='switcher'):
+                switcher.Switcher(self.zk_client, self.cluster_config,
+                                  self.github, prober, cluster).run()
+        except exceptions.ConflictError as e:
+            # The other healthchecker updated the same object in the
+            # meantime, the next cycle will work on the fresh data.
+            self.cluster_config.LOG.warning("Skip the rest of the cycle: %s",
+                                            e)
+        finally:
+            prober.close()
+
+    def _run_cycles(self):
+        with self._cycle_lock:
+            self._running = True
+        while True:
+            with metrics.timer('cycle'):
+                self._action()
+            with self._cycle_lock:
+                # Something was triggered during the cycle, its data may
+                # have been read before the change.
+                if not self._pending:
+                    self._running = False
+                    break
+                self._pending = False
+        suspects = self.service_tracker.suspects()
+        if suspects:
+            self.trigger("%s found down" % ', '.join(suspects),
+                         delay=self.recheck_delay)
+
+    def trigger(self, reason, delay=None):
+        """Run a cycle soon, or right after the running one.
+
+        :param delay: The seconds before the cycle, trigger_delay by default.
+        """
+        with self._cycle_lock:
+            if self._running:
+                self._pending = True
+                return
+        self.cluster_config.LOG.debug("Cycle triggered: %s", reason)
+        run_time = (datetime.datetime.now(self.scheduler.timezone) +
+                    datetime.timedelta(seconds=delay or self.trigger_delay))
+        try:
+            self.scheduler.modify_job(self.JOB_ID, next_run_time=run_time)
+        except jobstores_base.JobLookupError:
+            # The scheduler is shutting down.
+            pass
+
+    def _on_ha_change(self, path, obj):
+        if obj is None:
+            return
+        if isinstance(obj, node.Node):
+            state = (obj.role, obj.status, obj.switch_status)
+        elif obj.node_name == socket.gethostname():
+            # The local services are written by the cycles themselves, their
+            # real state comes from systemd.
+            return
+        else:
+            state = obj.status
+        if self._seen.get(path) != state:
+            self._seen[path] = state
+            self.trigger("%s changed" % path)
+
+    def _on_live_change(self, node_name, alive):
+        if node_name != socket.gethostname():
+            self.trigger("the healthchecker of %s is %s" % (
+                node_name, 'back' if alive else 'gone'))
+
+    def _on_configuration_change(self, changed):
+        if 'allow_switch' in changed:
+            self.trigger("allow_switch changed")
+
+    def _on_unit_change(self, unit, state):
+        with self._cycle_lock:
+            if self._running:
+                # The units change during a cycle because the cycle starts,
+                # stops or restarts them. Triggering another cycle for that
+                # would restart a unit which fails to start over and over.
+                return
+        if state in self.settled_unit_states:
+            self.trigger("%s is %s" % (unit, state))
+
+    def _refresh_dns(self):
+        # Only the zuul slave changes the records, see Switcher._change_dns.
+        try:
+            local_node = self.zk_client.get_node(socket.gethostname())
+        except exceptions.ClientError as e:
+            self.cluster_config.LOG.warning(
+                "Skip the DNS records refresh: %s", e)
+            return
+        if local_node.type != 'zuul' or local_node.role != 'slave':
+            return
+        config = self.cluster_config
+        dnsimple.get_client(config).refresh(
+            [config.dns_status_domain, config.dns_log_domain],
+            config.dns_master_public_ip)
+
+    def _local_units(self):
+        node_type = self.zk_client.get_node(socket.gethostname()).type
+        units = set()
+        for types in service.service_mapping.values():
+            for services in types.get(node_type, {}).values():
+                units.update(services)
+        return sorted('cron' if unit.endswith('-timer-tasks') else unit
+                      for unit in units)
+
+    def _watch_events(self):
+        self.zk_client.add_change_listener(self._on_ha_change)
+        self.zk_client.add_configuration_listener(
+            self._on_configuration_change)
+        self.zk_client.add_live_listener(self._on_live_change)
+        self.unit_watcher = systemd.UnitWatcher(self._local_units(),
+                                                self._on_unit_change)
+        try:
+            self.unit_watcher.start()
+        except systemd.SystemdError as e:
+            self.unit_watcher = None
+            self.cluster_config.LOG.warning(
+                "Can't watch the local services, they're checked every %s "
+                "seconds only: %s", self.sweep_interval, e)
+
+    def _on_zk_op(self, name, seconds):
+        metrics.timing('zookeeper_op', seconds, op=name)
 
     def run(self):
+        log.setup()
+        metrics.REGISTRY.configure(statsd=self.statsd,
+                                   prometheus=self.prometheus)
+        self.zk_client.add_op_listener(self._on_zk_op)
         self.zk_client.connect()
+        self.zk_client.register_live(socket.gethostname())
         self.cluster_config = ClusterConfig(self.zk_client)
         self.github = github.GithubAction(self.cluster_config)
+        self.cluster_config.subscribe(self.github.refresh,
+                                      github.GithubAction.CLIENT_OPTIONS)
+        self.github.start()
 
-        job_scheduler = blocking.BlockingScheduler()
-        job_scheduler.add_job(self._action, 'interval', seconds=120)
-        job_scheduler.start()
+        self.scheduler = blocking.BlockingScheduler()
+        self.scheduler.add_job(self._run_cycles, 'interval',
+                               seconds=self.sweep_interval, id=self.JOB_ID)
+        self.scheduler.add_job(self._refresh_dns, 'interval',
+                               seconds=self.dns_refresh_interval,
+                               next_run_time=datetime.datetime.now(
+                                   self.scheduler.timezone))
+        if self.event_driven:
+            self._watch_events()
+        try:
+            self.scheduler.start()
+        finally:
+            if self.unit_watcher is not None:
+                self.unit_watcher.stop()
+            self.github.stop()
+            metrics.REGISTRY.shutdown()
+            timeline.stop()
+            log.stop()
@@ -0,0 +1,113 @@
+import copy
+
+from openlabcmd import exceptions
+
+
+def _as_list(value):
+    if isinstance(value, str):
+        return [value]
+    return value
+
+
+class ClusterSnapshot(object):
+    """The nodes and services of the HA cluster, read once per cycle.
+
+    It has the part of the ZooKeeper client API used by the actions. The
+    reads are served from the snapshot. The writes go to ZooKeeper and the
+    written objects replace their old version in the snapshot, so that all
+    the actions of a cycle decide on the same view.
+
+    :param zk_client: The connected openlabcmd.zk.ZooKeeper client.
+    """
+
+    def __init__(self, zk_client):
+        self.zk_client = zk_client
+        self._nodes = dict((node_obj.name, node_obj)
+                           for node_obj in zk_client.list_nodes())
+        # node name -> services under the current role of the node
+        self._services = {}
+        for service_obj in zk_client.list_services():
+            self._services.setdefault(service_obj.node_name, []).append(
+                service_obj)
+        self._live_nodes = zk_client.list_live_nodes()
+
+    def get_node(self, node_name):
+        try:
+            return copy.copy(self._nodes[node_name])
+        except KeyError:
+            raise exceptions.ClientError('Node %s not found.' % node_name)
+
+    def list_nodes(self, with_zk=True, node_role_filter=None,
+                   node_type_filter=None):
+        node_role_filter = _as_list(node_role_filter)
+        node_type_filter = _as_list(node_type_filter)
+        result = []
+        for name in sorted(self._nodes):
+            node_obj = self._nodes[name]
+            if not with_zk and 'zookeeper' in name:
+                continue
+            if node_role_filter and node_obj.role not in node_role_filter:
+                continue
+            if node_type_filter and node_obj.type not in node_type_filter:
+                continue
+            result.append(copy.copy(node_obj))
+        return result
+
+    def list_services(self, node_name_filter=None, node_role_filter=None,
+                      status_filter=None):
+        node_name_filter = _as_list(node_name_filter)
+        node_role_filter = _as_list(node_role_filter)
+        status_filter = _as_list(status_filter)
+        result = []
+        for name in sorted(self._services):
+            if node_name_filter and name not in node_name_filter:
+                continue
+            node_obj = self._nodes.get(name)
+            if node_role_filter and (node_obj is None or
+                                     node_obj.role not in node_role_filter):
+                continue
+            for service_obj in self._services[name]:
+                if status_filter and service_obj.status not in status_filter:
+                    continue
+                result.append(copy.copy(service_obj))
+        return result
+
+    def list_live_nodes(self):
+        return set(self._live_nodes)
+
+    def update_node(self, node_name, **kwargs):
+        node_obj = self.zk_client.update_node(node_name, **kwargs)
+        old_node = self._nodes.get(node_name)
+        self._nodes[node_name] = node_obj
+        if old_node is not None and old_node.role != node_obj.role:
+            # The services of a node are the ones of its current role.
+            self._services[node_name] = self.zk_client.list_services(
+                node_name_filter=node_name)
+        return copy.copy(node_obj)
+
+    def update_service(self, service_name, node_name, **kwargs):
+        service_obj = self.zk_client.update_service(service_name, node_name,
+                                                    **kwargs)
+        services = self._services.setdefault(node_name, [])
+        for i, old_service in enumerate(services):
+            if old_service.name == service_name:
+                services[i] = service_obj
+                break
+        else:
+            services.append(service_obj)
+        return copy.copy(service_obj)
+
+    def update_configuration(self, name, value):
+        self.zk_client.update_configuration(name, value)
+
+    def acquire_lock(self, name, identifier):
+        return self.zk_client.acquire_lock(name, identifier)
+
+    def get_switch_plan(self):
+        return self.zk_client.get_switch_plan()
+
+    def set_switch_plan(self, plan):
+        self.zk_client.set_switch_plan(plan)
+
+    def add_switch_record(self, record):
+        self.zk_client.add_switch_record(record)
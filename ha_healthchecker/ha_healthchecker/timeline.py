@@ -0,0 +1,104 @@
+import contextlib
+import datetime
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+LOG = logging.getLogger("OpenLab HA HealthChecker")
+
+TIMELINE_FILE = '/var/log/ha_healthchecker/switch_timeline.jsonl'
+
+# The (record, path) to write, None stops the writer.
+_records = queue.Queue()
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def _isotime(timestamp):
+    return datetime.datetime.fromtimestamp(
+        timestamp, datetime.timezone.utc).isoformat()
+
+
+def now_isotime():
+    return _isotime(time.time())
+
+
+class SwitchTimeline(object):
+    """The timed steps of a switch done by one node in one cycle.
+
+    A switch is done by several nodes over several cycles, their records
+    share the switch_id of the switch plan.
+    """
+
+    def __init__(self, node_obj):
+        self.node = node_obj.name
+        self.role = node_obj.role
+        self.switch_id = None
+        self.spans = []
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """Record the time spent in the with block as the step name."""
+        started_at = time.time()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.spans.append({'step': name, 'start': _isotime(started_at),
+                               'duration': round(time.monotonic() - start,
+                                                 3)})
+
+    def mark(self, name):
+        """Record the instant step name."""
+        self.spans.append({'step': name, 'start': now_isotime(),
+                           'duration': 0})
+
+    def to_dict(self):
+        return {'switch_id': self.switch_id, 'node': self.node,
+                'role': self.role, 'spans': self.spans}
+
+
+def _write_record(record, path):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+    except OSError as e:
+        LOG.warning("Failed to write the switch timeline to %s: %s", path, e)
+
+
+def _write_records():
+    while True:
+        item = _records.get()
+        if item is None:
+            return
+        _write_record(*item)
+
+
+def append_record(record, path=TIMELINE_FILE):
+    """Append the record of a timeline to the JSON lines file path.
+
+    It's written by a background thread, the switch doesn't wait for the
+    disk.
+    """
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = threading.Thread(target=_write_records)
+            _writer.daemon = True
+            _writer.start()
+    _records.put((record, path))
+
+
+def stop():
+    """Write the queued records and stop the background thread."""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            return
+        _records.put(None)
+        _writer.join()
+        _writer = None
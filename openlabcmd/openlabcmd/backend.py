@@ -0,0 +1,629 @@
+import collections
+import itertools
+import logging
+import threading
+import time
+
+from kazoo.client import KazooClient, KazooState
+from kazoo import exceptions as kze
+from kazoo.handlers.threading import SequentialThreadingHandler
+from kazoo.protocol.states import EventType
+from kazoo.protocol.states import KeeperState
+from kazoo.protocol.states import WatchedEvent
+from kazoo.protocol.states import ZnodeStat
+
+
+BACKENDS = ['kazoo', 'memory']
+
+
+def make_client(backend, hosts, timeout, read_only=False, latency=0):
+    """Build the client object used by `openlabcmd.zk.ZooKeeper`.
+
+    :param backend: 'kazoo' talks to a real ZooKeeper ensemble, 'memory'
+        keeps the tree in this process, see `MemoryClient`.
+    :param hosts: The ZooKeeper hosts. For the memory backend, the clients
+        built with the same hosts share the same tree.
+    :param timeout: The session timeout in seconds.
+    :param read_only: Allow connecting to a read-only server.
+    :param latency: The round trip time in seconds injected into every
+        request of the memory backend.
+    """
+    if backend == 'kazoo':
+        return KazooClient(hosts=hosts, timeout=timeout, read_only=read_only)
+    if backend == 'memory':
+        return MemoryClient(MemoryStore.named(hosts), timeout=timeout,
+                            latency=latency)
+    raise ValueError("Unknown ZooKeeper backend %s, should be one of %s." %
+                     (backend, BACKENDS))
+
+
+class _Znode(object):
+    __slots__ = ('data', 'czxid', 'mzxid', 'ctime', 'mtime', 'version',
+                 'cversion', 'pzxid', 'ephemeral_owner', 'children')
+
+    def __init__(self, data, zxid, now, ephemeral_owner):
+        self.data = data
+        self.czxid = self.mzxid = self.pzxid = zxid
+        self.ctime = self.mtime = now
+        self.version = 0
+        self.cversion = 0
+        self.ephemeral_owner = ephemeral_owner
+        self.children = set()
+
+    def copy(self):
+        znode = _Znode(self.data, self.czxid, self.ctime,
+                       self.ephemeral_owner)
+        znode.mzxid, znode.mtime = self.mzxid, self.mtime
+        znode.version, znode.cversion = self.version, self.cversion
+        znode.pzxid = self.pzxid
+        znode.children = set(self.children)
+        return znode
+
+    def stat(self):
+        return ZnodeStat(self.czxid, self.mzxid, self.ctime, self.mtime,
+                         self.version, self.cversion, 0, self.ephemeral_owner,
+                         len(self.data), len(self.children), self.pzxid)
+
+
+class MemoryStore(object):
+    """A ZooKeeper tree living in this process.
+
+    It's shared by all the `MemoryClient` objects connected to it, the same
+    way a real ensemble is shared by its clients. Every request is counted
+    in `stats`, along the round trips waited for by the clients, so that the
+    callers can measure how much an operation costs.
+    """
+
+    _stores = {}
+    _stores_lock = threading.Lock()
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.zxid = 0
+        self.nodes = {'/': _Znode(b'', 0, 0, 0)}
+        self.data_watches = collections.defaultdict(set)
+        self.child_watches = collections.defaultdict(set)
+        self.sessions = {}
+        self._session_ids = itertools.count(1)
+        self.clock = time.time
+        self.stats = collections.Counter()
+        # The saved znodes to restore if the running multi fails.
+        self._undo = None
+
+    @classmethod
+    def named(cls, name):
+        """Return the store called name, create it if needed."""
+        with cls._stores_lock:
+            if name not in cls._stores:
+                cls._stores[name] = cls()
+            return cls._stores[name]
+
+    @classmethod
+    def forget(cls, name=None):
+        """Forget the store called name, or all of them."""
+        with cls._stores_lock:
+            if name is None:
+                cls._stores.clear()
+            else:
+                cls._stores.pop(name, None)
+
+    def _now(self):
+        return int(self.clock() * 1000)
+
+    @staticmethod
+    def _split(path):
+        parent, name = path.rsplit('/', 1)
+        return parent or '/', name
+
+    def _node(self, path):
+        try:
+            return self.nodes[path]
+        except KeyError:
+            raise kze.NoNodeError(path)
+
+    def open_session(self, client):
+        with self.lock:
+            session_id = next(self._session_ids)
+            self.sessions[session_id] = client
+            return session_id
+
+    def close_session(self, session_id):
+        """End a session, its ephemeral znodes are deleted."""
+        with self.lock:
+            self.sessions.pop(session_id, None)
+            ephemerals = sorted(
+                (path for path, znode in self.nodes.items()
+                 if znode.ephemeral_owner == session_id), reverse=True)
+            events = []
+            for path in ephemerals:
+                events.extend(self._delete(path, -1))
+        self._fire(events)
+
+    # The _create, _set, _delete and _check functions change the tree
+    # without firing the watches, they return the watch events to fire
+    # instead. They are called with the lock held.
+
+    def _save(self, *paths):
+        if self._undo is None:
+            return
+        for path in paths:
+            znode = self.nodes.get(path)
+            self._undo.append((path, znode.copy() if znode else None))
+
+    def _create(self, path, value, ephemeral_owner, sequence):
+        parent_path, name = self._split(path)
+        parent = self._node(parent_path)
+        if parent.ephemeral_owner:
+            raise kze.NoChildrenForEphemeralsError(path)
+        if sequence:
+            path = '%s%010d' % (path, parent.cversion)
+            name = self._split(path)[1]
+        if path in self.nodes:
+            raise kze.NodeExistsError(path)
+        self._save(path, parent_path)
+        self.zxid += 1
+        self.nodes[path] = _Znode(value, self.zxid, self._now(),
+                                  ephemeral_owner)
+        parent.children.add(name)
+        parent.cversion += 1
+        parent.pzxid = self.zxid
+        return path, [(path, EventType.CREATED),
+                      (parent_path, EventType.CHILD)]
+
+    def _set(self, path, value, version):
+        znode = self._node(path)
+        if version != -1 and version != znode.version:
+            raise kze.BadVersionError(path)
+        self._save(path)
+        self.zxid += 1
+        znode.data = value
+        znode.mzxid = self.zxid
+        znode.mtime = self._now()
+        znode.version += 1
+        return znode.stat(), [(path, EventType.CHANGED)]
+
+    def _delete(self, path, version):
+        znode = self._node(path)
+        if version != -1 and version != znode.version:
+            raise kze.BadVersionError(path)
+        if znode.children:
+            raise kze.NotEmptyError(path)
+        parent_path, name = self._split(path)
+        parent = self.nodes[parent_path]
+        self._save(path, parent_path)
+        self.zxid += 1
+        del self.nodes[path]
+        parent.children.discard(name)
+        parent.cversion += 1
+        parent.pzxid = self.zxid
+        return [(path, EventType.DELETED), (path, EventType.CHILD),
+                (parent_path, EventType.CHILD)]
+
+    def _check(self, path, version):
+        znode = self._node(path)
+        if version != znode.version:
+            raise kze.BadVersionError(path)
+        return True, []
+
+    def _fire(self, events):
+        with self.lock:
+            triggered = []
+            for path, event_type in events:
+                if event_type == EventType.CHILD:
+                    watches = self.child_watches.pop(path, ())
+                    if (path, EventType.DELETED) in events:
+                        # Children watches see the deletion of their znode.
+                        event_type = EventType.DELETED
+                else:
+                    watches = self.data_watches.pop(path, ())
+                for client, watch in watches:
+                    triggered.append((client, watch, WatchedEvent(
+                        event_type, KeeperState.CONNECTED, path)))
+        for client, watch, event in triggered:
+            client._dispatch(watch, event)
+
+    def _watch(self, watches, path, client, watch):
+        if watch is not None:
+            watches[path].add((client, watch))
+
+    def get(self, client, path, watch=None):
+        with self.lock:
+            self.stats['get'] += 1
+            znode = self._node(path)
+            self._watch(self.data_watches, path, client, watch)
+            self.stats['bytes_read'] += len(znode.data)
+            return znode.data, znode.stat()
+
+    def get_children(self, client, path, watch=None, include_data=False):
+        with self.lock:
+            self.stats['get_children'] += 1
+            znode = self._node(path)
+            self._watch(self.child_watches, path, client, watch)
+            children = sorted(znode.children)
+            self.stats['bytes_read'] += sum(len(c) for c in children)
+            if include_data:
+                return children, znode.stat()
+            return children
+
+    def exists(self, client, path, watch=None):
+        with self.lock:
+            self.stats['exists'] += 1
+            # Like ZooKeeper, exists watches the path even if it's missing.
+            self._watch(self.data_watches, path, client, watch)
+            znode = self.nodes.get(path)
+            return znode.stat() if znode else None
+
+    def create(self, client, path, value, ephemeral, sequence, makepath):
+        with self.lock:
+            self.stats['create'] += 1
+            self.stats['bytes_written'] += len(value)
+            events = []
+            if makepath:
+                parent_path = self._split(path)[0]
+                missing = []
+                while parent_path not in self.nodes:
+                    missing.append(parent_path)
+                    parent_path = self._split(parent_path)[0]
+                for missing_path in reversed(missing):
+                    events.extend(self._create(missing_path, b'', 0,
+                                               False)[1])
+            owner = client.session_id if ephemeral else 0
+            path, create_events = self._create(path, value, owner, sequence)
+            events.extend(create_events)
+        self._fire(events)
+        return path
+
+    def set(self, client, path, value, version):
+        with self.lock:
+            self.stats['set'] += 1
+            self.stats['bytes_written'] += len(value)
+            stat, events = self._set(path, value, version)
+        self._fire(events)
+        return stat
+
+    def delete(self, client, path, version, recursive):
+        with self.lock:
+            self.stats['delete'] += 1
+            events = []
+            if recursive:
+                self._node(path)
+                prefix = path.rstrip('/') + '/'
+                for sub_path in sorted(
+                        (p for p in self.nodes if p.startswith(prefix)),
+                        reverse=True):
+                    events.extend(self._delete(sub_path, -1))
+            events.extend(self._delete(path, version))
+        self._fire(events)
+        return True
+
+    def multi(self, client, operations):
+        """Apply the operations atomically, like ZooKeeper multi."""
+        with self.lock:
+            self.stats['multi'] += 1
+            saved_zxid = self.zxid
+            self._undo = []
+            results = []
+            events = []
+            failed = False
+            try:
+                for op, args in operations:
+                    if failed:
+                        results.append(kze.RuntimeInconsistency())
+                        continue
+                    try:
+                        result, op_events = self._multi_op(client, op, args)
+                    except kze.ZookeeperError as e:
+                        failed = True
+                        results = [kze.RolledBackError()] * len(results)
+                        results.append(e)
+                        continue
+                    results.append(result)
+                    events.extend(op_events)
+                if failed:
+                    for path, znode in reversed(self._undo):
+                        if znode is None:
+                            self.nodes.pop(path, None)
+                        else:
+                            self.nodes[path] = znode
+                    self.zxid = saved_zxid
+                    return results
+            finally:
+                self._undo = None
+        self._fire(events)
+        return results
+
+    def _multi_op(self, client, op, args):
+        if op == 'create':
+            path, value, ephemeral, sequence = args
+            self.stats['bytes_written'] += len(value)
+            owner = client.session_id if ephemeral else 0
+            return self._create(path, value, owner, sequence)
+        if op == 'set_data':
+            self.stats['bytes_written'] += len(args[1])
+            return self._set(*args)
+        if op == 'delete':
+            return True, self._delete(*args)
+        return self._check(*args)
+
+
+class MemoryAsyncResult(object):
+    """The result of an asynchronous request of `MemoryClient`.
+
+    The request is done when it's issued, but the result is only available
+    after the client latency passed, so that several requests in flight
+    share one round trip like they do with kazoo.
+    """
+
+    def __init__(self, client, func):
+        self._client = client
+        self._epoch = client._epoch
+        self._clock = client.store.clock
+        self._ready_at = self._clock() + client.latency
+        self._value = None
+        self._exception = None
+        try:
+            self._value = func()
+        except Exception as e:
+            self._exception = e
+
+    def get(self, block=True, timeout=None):
+        client = self._client
+        if self._epoch == client._epoch:
+            # The first wait for a request sent since the previous wait, all
+            # the requests sent in between share this round trip.
+            client._epoch += 1
+            client.store.stats['round_trips'] += 1
+        delay = self._ready_at - self._clock()
+        if delay > 0:
+            time.sleep(delay)
+        if self._exception is not None:
+            raise self._exception
+        return self._value
+
+    def successful(self):
+        return self._exception is None
+
+
+class MemoryTransaction(object):
+    def __init__(self, client):
+        self.client = client
+        self.operations = []
+        self.committed = False
+
+    def create(self, path, value=b'', acl=None, ephemeral=False,
+               sequence=False):
+        self.operations.append(('create', (path, value, ephemeral,
+                                           sequence)))
+
+    def delete(self, path, version=-1):
+        self.operations.append(('delete', (path, version)))
+
+    def set_data(self, path, value, version=-1):
+        self.operations.append(('set_data', (path, value, version)))
+
+    def check(self, path, version):
+        self.operations.append(('check', (path, version)))
+
+    def commit_async(self):
+        if self.committed:
+            raise ValueError('Transaction already committed')
+        self.committed = True
+        return self.client._async(self.client.store.multi, self.client,
+                                  self.operations)
+
+    def commit(self):
+        return self.commit_async().get()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if not exc_type:
+            self.commit()
+
+
+class MemoryClient(object):
+    """A client of a `MemoryStore`, with the KazooClient API.
+
+    Only the part of the API used by openlabcmd and the kazoo recipes it
+    relies on is implemented. The watches are called from a dedicated
+    thread, the way kazoo does.
+
+    :param store: The MemoryStore to connect to.
+    :param timeout: The session timeout in seconds, unused.
+    :param latency: The round trip time in seconds to inject into every
+        request.
+    """
+
+    log = logging.getLogger("OpenLabCMD.MemoryClient")
+
+    def __init__(self, store, timeout=10, latency=0):
+        self.store = store
+        self.timeout = timeout
+        self.latency = latency
+        self.handler = SequentialThreadingHandler()
+        self.state = KazooState.LOST
+        self.session_id = None
+        self._listeners = []
+        # Incremented at the end of each round trip.
+        self._epoch = 0
+        self._events = None
+        self._event_thread = None
+
+    @property
+    def connected(self):
+        return self.state == KazooState.CONNECTED
+
+    @property
+    def client_id(self):
+        return (self.session_id, b'') if self.session_id else None
+
+    def add_listener(self, listener):
+        if listener not in self._listeners:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def _set_state(self, state):
+        self.state = state
+        for listener in list(self._listeners):
+            try:
+                if listener(state) is True:
+                    self.remove_listener(listener)
+            except Exception:
+                self.log.exception("Error in connection state listener")
+
+    def start(self, timeout=15):
+        if self.connected:
+            return
+        self._events_ready = threading.Condition()
+        self._events = collections.deque()
+        self._event_thread = threading.Thread(target=self._event_loop)
+        self._event_thread.daemon = True
+        self._event_thread.start()
+        self.session_id = self.store.open_session(self)
+        self._set_state(KazooState.CONNECTED)
+
+    def stop(self):
+        if self.session_id is not None:
+            self.store.close_session(self.session_id)
+            self.session_id = None
+        self._drop_watches()
+        self._set_state(KazooState.LOST)
+        if self._event_thread is not None:
+            with self._events_ready:
+                self._events.append(None)
+                self._events_ready.notify()
+            if self._event_thread is not threading.current_thread():
+                self._event_thread.join()
+            self._event_thread = None
+
+    def close(self):
+        pass
+
+    def suspend(self):
+        """Simulate a connection loss which doesn't expire the session."""
+        self._set_state(KazooState.SUSPENDED)
+
+    def resume(self):
+        """Recover from `suspend`."""
+        self._set_state(KazooState.CONNECTED)
+
+    def expire_session(self):
+        """Simulate a session expiration followed by a reconnection.
+
+        The ephemeral znodes and the watches of the session are dropped and
+        a new session is opened, the listeners see LOST then CONNECTED.
+        """
+        self.store.close_session(self.session_id)
+        self._drop_watches()
+        self._set_state(KazooState.LOST)
+        self.session_id = self.store.open_session(self)
+        self._set_state(KazooState.CONNECTED)
+
+    def _drop_watches(self):
+        with self.store.lock:
+            for watches in (self.store.data_watches,
+                            self.store.child_watches):
+                for path in list(watches):
+                    watches[path] = set(
+                        w for w in watches[path] if w[0] is not self)
+
+    def _dispatch(self, watch, event):
+        if self._events is None:
+            return
+        with self._events_ready:
+            self._events.append((watch, event))
+            self._events_ready.notify()
+
+    def _event_loop(self):
+        while True:
+            with self._events_ready:
+                while not self._events:
+                    self._events_ready.wait()
+                item = self._events.popleft()
+            if item is None:
+                return
+            watch, event = item
+            try:
+                watch(event)
+            except Exception:
+                self.log.exception("Error in watch callback")
+
+    def _check_state(self):
+        if self.state == KazooState.LOST:
+            raise kze.SessionExpiredError()
+        if self.state == KazooState.SUSPENDED:
+            raise kze.ConnectionLoss()
+
+    def _async(self, func, *args):
+        self._check_state()
+        return MemoryAsyncResult(self, lambda: func(*args))
+
+    def _sync(self, func, *args):
+        return self._async(func, *args).get()
+
+    def retry(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+    def get(self, path, watch=None):
+        return self._sync(self.store.get, self, path, watch)
+
+    def get_async(self, path, watch=None):
+        return self._async(self.store.get, self, path, watch)
+
+    def get_children(self, path, watch=None, include_data=False):
+        return self._sync(self.store.get_children, self, path, watch,
+                          include_data)
+
+    def get_children_async(self, path, watch=None, include_data=False):
+        return self._async(self.store.get_children, self, path, watch,
+                           include_data)
+
+    def exists(self, path, watch=None):
+        return self._sync(self.store.exists, self, path, watch)
+
+    def exists_async(self, path, watch=None):
+        return self._async(self.store.exists, self, path, watch)
+
+    def create(self, path, value=b'', acl=None, ephemeral=False,
+               sequence=False, makepath=False):
+        return self._sync(self.store.create, self, path, value, ephemeral,
+                          sequence, makepath)
+
+    def create_async(self, path, value=b'', acl=None, ephemeral=False,
+                     sequence=False, makepath=False):
+        return self._async(self.store.create, self, path, value, ephemeral,
+                           sequence, makepath)
+
+    def ensure_path(self, path, acl=None):
+        try:
+            self.create(path, makepath=True)
+        except kze.NodeExistsError:
+            pass
+        return True
+
+    def set(self, path, value, version=-1):
+        return self._sync(self.store.set, self, path, value, version)
+
+    def set_async(self, path, value, version=-1):
+        return self._async(self.store.set, self, path, value, version)
+
+    def delete(self, path, version=-1, recursive=False):
+        return self._sync(self.store.delete, self, path, version, recursive)
+
+    def delete_async(self, path, version=-1):
+        return self._async(self.store.delete, self, path, version, False)
+
+    def transaction(self):
+        return MemoryTransaction(self)
+
+    def Lock(self, path, identifier=None):
+        from kazoo.recipe.lock import Lock
+        return Lock(self, path, identifier)
+
+    def Election(self, path, identifier=None):
+        from kazoo.recipe.election import Election
+        return Election(self, path, identifier)
@@ -0,0 +1,258 @@
+import copy
+import logging
+import threading
+
+from kazoo.client import KazooState
+from kazoo import exceptions as kze
+from kazoo.protocol.states import EventType
+
+
+class TreeMirror(object):
+
+    log = logging.getLogger("OpenLabCMD.TreeMirror")
+
+    def __init__(self, client, root, depth):
+        """
+        In-memory mirror of the znodes under root, kept current by
+        ZooKeeper data and child watches.
+
+        The writes done by the owner should be reported by `apply` and
+        `apply_delete` once they succeed, so that they can be read back
+        before the watch event arrives. The entries are ordered by mzxid, an
+        older version never replaces a newer one.
+
+        :param client: The started KazooClient.
+        :param root: The root path of the mirrored tree.
+        :param depth: How many levels under the root are mirrored.
+        """
+        self.client = client
+        self.root = root
+        self.depth = depth
+        self._lock = threading.RLock()
+        self._load_lock = threading.Lock()
+        self._ready = threading.Event()
+        self._closed = False
+        # path -> (data, stat)
+        self._data = {}
+        # path -> set of child names
+        self._children = {}
+        # path -> decoded object, dropped once the data changes.
+        self._objects = {}
+        # paths which have a data watch set.
+        self._watched = set()
+        self._listeners = []
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def add_listener(self, listener):
+        """Call listener(path) once the data of path changes or it's deleted.
+
+        The listener is called from the ZooKeeper event thread, it must not
+        block. The changes seen while the mirror is loaded aren't reported.
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def _notify(self, paths):
+        for path in paths:
+            for listener in list(self._listeners):
+                try:
+                    listener(path)
+                except Exception:
+                    self.log.exception("Error in mirror listener")
+
+    def covers(self, path):
+        return path == self.root or path.startswith(self.root + '/')
+
+    def start(self):
+        self.client.add_listener(self._session_listener)
+        self._load()
+
+    def stop(self):
+        self._closed = True
+        self.client.remove_listener(self._session_listener)
+        self._reset()
+
+    def _reset(self):
+        with self._lock:
+            self._ready.clear()
+            self._data.clear()
+            self._children.clear()
+            self._objects.clear()
+            self._watched.clear()
+
+    def _session_listener(self, state):
+        if state == KazooState.LOST:
+            # Watches are gone with the session, the mirror can't be trusted
+            # until it's reloaded in the new session.
+            self._reset()
+        elif state == KazooState.CONNECTED and not self._closed:
+            if not self._ready.is_set():
+                # Listeners run in the connection thread, never block it.
+                loader = threading.Thread(target=self._load)
+                loader.daemon = True
+                loader.start()
+
+    def _load(self):
+        with self._load_lock:
+            if self._closed or self._ready.is_set():
+                return
+            try:
+                self._load_subtree(self.root)
+                if self.get(self.root) is None:
+                    # Get notified once the root is created.
+                    if not self.client.exists(self.root,
+                                              watch=self._data_watcher):
+                        self.log.debug("%s doesn't exist yet.", self.root)
+            except (kze.ConnectionLoss, kze.SessionExpiredError):
+                self.log.warning("Failed to load the mirror of %s, will "
+                                 "retry once reconnected.", self.root)
+                self._reset()
+                return
+            self._ready.set()
+
+    def _depth_of(self, path):
+        if path == self.root:
+            return 0
+        return path[len(self.root):].count('/')
+
+    def _load_subtree(self, path):
+        # Read the tree level by level, each level is one pipelined batch.
+        level = [path]
+        while level:
+            data_requests = [
+                (p, self.client.get_async(p, watch=self._data_watcher))
+                for p in level]
+            children_requests = [
+                (p, self.client.get_children_async(
+                    p, watch=self._child_watcher))
+                for p in level if self._depth_of(p) < self.depth]
+            for p, async_result in data_requests:
+                try:
+                    data, stat = async_result.get()
+                except kze.NoNodeError:
+                    continue
+                with self._lock:
+                    self._watched.add(p)
+                self.apply(p, data, stat)
+            level = []
+            for p, async_result in children_requests:
+                try:
+                    children = async_result.get()
+                except kze.NoNodeError:
+                    continue
+                with self._lock:
+                    if p in self._data:
+                        self._children[p] = set(children)
+                level.extend(p + '/' + child for child in children)
+
+    def refresh(self, path):
+        """Re-read path and the znodes under it from ZooKeeper."""
+        self._load_subtree(path)
+
+    def _data_watcher(self, event):
+        if self._closed:
+            return
+        if event.type == EventType.DELETED:
+            self.apply_delete(event.path)
+        elif event.type == EventType.CHANGED:
+            try:
+                data, stat = self.client.get(event.path,
+                                             watch=self._data_watcher)
+            except kze.NoNodeError:
+                self.apply_delete(event.path)
+                return
+            self.apply(event.path, data, stat)
+        elif event.type == EventType.CREATED:
+            self._load_subtree(event.path)
+
+    def _child_watcher(self, event):
+        if self._closed or event.type != EventType.CHILD:
+            return
+        try:
+            children = self.client.get_children(event.path,
+                                                watch=self._child_watcher)
+        except kze.NoNodeError:
+            return
+        with self._lock:
+            if event.path not in self._data:
+                return
+            self._children[event.path] = set(children)
+            new_paths = [event.path + '/' + child for child in children
+                         if event.path + '/' + child not in self._watched]
+        for new_path in new_paths:
+            self._load_subtree(new_path)
+
+    def apply(self, path, data, stat):
+        """Record the data and stat of path read or written by the owner."""
+        with self._lock:
+            cached = self._data.get(path)
+            if cached is not None and cached[1].mzxid > stat.mzxid:
+                return
+            changed = (self._ready.is_set() and
+                       (cached is None or cached[1].mzxid != stat.mzxid))
+            self._data[path] = (data, stat)
+            self._objects.pop(path, None)
+            if self._depth_of(path) < self.depth:
+                self._children.setdefault(path, set())
+            if path != self.root:
+                parent, name = path.rsplit('/', 1)
+                if parent in self._children:
+                    self._children[parent].add(name)
+        if changed:
+            self._notify([path])
+
+    def apply_delete(self, path):
+        """Drop path and the znodes under it."""
+        with self._lock:
+            prefix = path + '/'
+            deleted = [p for p in self._data
+                       if p == path or p.startswith(prefix)]
+            for p in deleted:
+                self._data.pop(p, None)
+                self._children.pop(p, None)
+                self._objects.pop(p, None)
+                self._watched.discard(p)
+            if path != self.root:
+                parent, name = path.rsplit('/', 1)
+                if parent in self._children:
+                    self._children[parent].discard(name)
+        if self._ready.is_set():
+            self._notify(sorted(deleted))
+
+    def get(self, path):
+        with self._lock:
+            return self._data.get(path)
+
+    def get_children(self, path):
+        with self._lock:
+            children = self._children.get(path)
+            if children is None:
+                return None
+            return sorted(children)
+
+    def get_object(self, path, factory):
+        """Return a copy of the object decoded from the data of path.
+
+        The decoded object is kept until the data changes, so factory is
+        called once per znode version.
+        """
+        entry = self.get_object_and_stat(path, factory)
+        return entry[0] if entry else None
+
+    def get_object_and_stat(self, path, factory):
+        """Like get_object, but return the znode stat along the object."""
+        with self._lock:
+            entry = self._data.get(path)
+            if entry is None:
+                return None
+            obj = self._objects.get(path)
+            if obj is None:
+                obj = factory(entry)
+                self._objects[path] = obj
+        return copy.copy(obj), entry[1]
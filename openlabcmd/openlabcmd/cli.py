@@ -211,6 +211,19 @@ class OpenLabCmd(object):
                               ' not try to repair if there is a check error.',
             action='store_true')
 
+        # openlab ha cluster reindex
+        cmd_ha_cluster_reindex = cmd_ha_cluster_subparsers.add_parser(
+            'reindex', help='Rebuild the indexes of the HA cluster data.')
+        cmd_ha_cluster_reindex.set_defaults(func=self.ha_cluster_reindex)
+
+        # openlab ha cluster timeline
+        cmd_ha_cluster_timeline = cmd_ha_cluster_subparsers.add_parser(
+            'timeline', help='Show the timeline of the last switches.')
+        cmd_ha_cluster_timeline.set_defaults(func=self.ha_cluster_timeline)
+        cmd_ha_cluster_timeline.add_argument(
+            '--limit', type=int, default=20,
+            help='How many records of the nodes to show at most.')
+
     def _add_ha_config_cmd(self, parser):
         # openlab ha cluster
         cmd_ha_config = parser.add_parser('config',
@@ -432,6 +445,27 @@ class OpenLabCmd(object):
             except exceptions.OpenLabCmdError:
                 print("Check failed")
 
+    @_zk_wrapper
+    def ha_cluster_reindex(self):
+        self.zk.rebuild_index()
+        print("Reindex success")
+
+    @_zk_wrapper
+    def ha_cluster_timeline(self):
+        records = self.zk.list_switch_records(limit=self.args.limit)
+        if self.args.format != 'pretty':
+            print(records)
+            return
+        steps = []
+        for record in records:
+            for span in record['spans']:
+                step = dict(span)
+                step.update(switch_id=record['switch_id'] or '-',
+                            node=record['node'], role=record['role'])
+                steps.append(step)
+        steps.sort(key=lambda step: (step['switch_id'], step['start']))
+        print(utils.format_output('switch', steps))
+
     @_zk_wrapper
     def ha_config_list(self):
         result = self.zk.list_configuration()
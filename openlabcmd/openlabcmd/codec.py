@@ -0,0 +1,63 @@
+import datetime
+import json
+
+# The first byte of the compact znode payloads. The JSON objects written by
+# the older versions start with '{', so both can be told apart.
+COMPACT_V1 = b'\x01'
+
+
+def encode(obj, fields, compact=False, legacy_names=None):
+    """Encode the fields of obj as a znode payload.
+
+    :param compact: Only store the values, in the order of fields, so the
+        key names aren't repeated in every znode. New fields must be
+        appended to the end. The versions older than the compact format
+        can't read it, only turn it on once every client is upgraded.
+    :param legacy_names: A dict of field to the key the JSON object uses
+        for it.
+    """
+    if compact:
+        values = [getattr(obj, field) for field in fields]
+        return COMPACT_V1 + json.dumps(
+            values, separators=(',', ':')).encode('utf8')
+    legacy_names = legacy_names or {}
+    return json.dumps(dict((legacy_names.get(field, field),
+                            getattr(obj, field)) for field in fields)
+                      ).encode('utf8')
+
+
+def decode(data, fields):
+    """Decode a compact or a legacy JSON payload to a dict."""
+    if data[:1] == COMPACT_V1:
+        values = json.loads(data[1:].decode('utf8'))
+        return dict(zip(fields, values))
+    return json.loads(data.decode('utf8'))
+
+
+class LazyIsoTime(object):
+    """A znode timestamp which is only formatted when it's read.
+
+    ZooKeeper stores ctime and mtime as milliseconds. The raw value is kept
+    in ms_attr and formatted to an ISO 8601 UTC string on first access.
+    Setting the attribute overrides the raw value.
+    """
+
+    def __init__(self, attr, ms_attr):
+        self.attr = attr
+        self.ms_attr = ms_attr
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        value = obj.__dict__.get(self.attr)
+        if value is None:
+            ms = obj.__dict__.get(self.ms_attr)
+            if ms is not None:
+                value = datetime.datetime.fromtimestamp(
+                    ms / 1000, datetime.timezone.utc).isoformat()
+                obj.__dict__[self.attr] = value
+        return value
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.attr] = value
+        obj.__dict__[self.ms_attr] = None
@@ -8,3 +8,11 @@ class ClientError(OpenLabCmdError):
 
 class ValidationError(OpenLabCmdError):
     pass
+
+
+class ConflictError(ClientError):
+    pass
+
+
+class ConnectionLostError(ClientError):
+    pass
@@ -1,7 +1,4 @@
-import datetime
-import json
-
-import pytz
+from openlabcmd import codec
 
 
 class NodeStatus(object):
@@ -12,9 +9,16 @@ class NodeStatus(object):
 
 
 class Node(object):
+    # The order of the fields in the compact payload, append only.
+    ZK_FIELDS = ('name', 'role', 'type', 'ip', 'heartbeat', 'alarmed',
+                 'status', 'switch_status', 'switch_id')
+
+    created_at = codec.LazyIsoTime('created_at', '_ctime')
+    updated_at = codec.LazyIsoTime('updated_at', '_mtime')
+
     def __init__(self, name, role, type, ip, heartbeat=None, alarmed=None,
                  status=None, created_at=None, updated_at=None,
-                 switch_status=None, **kwargs):
+                 switch_status=None, switch_id=None, **kwargs):
         self.name = name
         self.role = role
         self.type = type
@@ -25,22 +29,18 @@ class Node(object):
         self.created_at = created_at
         self.updated_at = updated_at
         self.switch_status = switch_status
+        # The id of the switch the node is assigned to, see
+        # ZooKeeper.get_switch_plan.
+        self.switch_id = switch_id
 
-    def to_zk_bytes(self):
-        node_dict = {
-            'name': self.name,
-            'role': self.role,
-            'type': self.type,
-            'ip': self.ip,
-            'heartbeat': self.heartbeat,
-            'alarmed': self.alarmed,
-            'status': self.status,
-            'switch_status': self.switch_status
-        }
-        return json.dumps(node_dict).encode('utf8')
+    def to_zk_bytes(self, compact=False):
+        return codec.encode(self, self.ZK_FIELDS, compact)
 
     def to_dict(self):
-        return self.__dict__
+        node_dict = {k: getattr(self, k) for k in self.ZK_FIELDS}
+        node_dict['created_at'] = self.created_at
+        node_dict['updated_at'] = self.updated_at
+        return node_dict
 
     def update(self, update_dict):
         for k, v in update_dict.items():
@@ -52,11 +52,8 @@ class Node(object):
 
     @classmethod
     def from_zk_bytes(cls, zk_bytes):
-        node_dict = json.loads(zk_bytes[0].decode('utf8'))
-        # ctime and mtime is millisecond in zk. Convert to second.
-        ctime, mtime = zk_bytes[1].ctime / 1000, zk_bytes[1].mtime / 1000
-        node_dict['created_at'] = datetime.datetime.fromtimestamp(
-                ctime, pytz.utc).isoformat()
-        node_dict['updated_at'] = datetime.datetime.fromtimestamp(
-                mtime, pytz.utc).isoformat()
-        return cls(**node_dict)
+        node_obj = cls(**codec.decode(zk_bytes[0], cls.ZK_FIELDS))
+        # ctime and mtime are formatted on first access only.
+        node_obj._ctime = zk_bytes[1].ctime
+        node_obj._mtime = zk_bytes[1].mtime
+        return node_obj
@@ -1,7 +1,4 @@
-import datetime
-import json
-
-import pytz
+from openlabcmd import codec
 
 # NOTE(wxy): Add more if needed.
 service_mapping = {
@@ -37,6 +34,39 @@ service_mapping = {
 
 MIXED_SERVICE = ['mysql', 'zookeeper']
 
+# service -> the services of the same node which must run before it starts.
+service_dependencies = {
+    'zuul-scheduler': ['mysql', 'gearman-job-server'],
+    'zuul-executor': ['zuul-scheduler'],
+    'zuul-merger': ['zuul-scheduler'],
+    'zuul-web': ['zuul-scheduler'],
+    'zuul-fingergw': ['zuul-scheduler'],
+    'nodepool-launcher': ['zookeeper'],
+    'nodepool-builder': ['zookeeper'],
+}
+
+
+def start_waves(services):
+    """Split services into waves, the services of a wave can start at once.
+
+    A service comes in a later wave than the services it depends on, see
+    service_dependencies. The dependencies out of services are ignored.
+    Stopping the waves in the reverse order stops the services before
+    their dependencies.
+    """
+    remaining = set(services)
+    waves = []
+    while remaining:
+        wave = sorted(
+            name for name in remaining
+            if not remaining.intersection(service_dependencies.get(name, [])))
+        if not wave:
+            # A dependency cycle, start the rest at once.
+            wave = sorted(remaining)
+        waves.append(wave)
+        remaining.difference_update(wave)
+    return waves
+
 
 class ServiceStatus(object):
     INITIALIZING = 'initializing'
@@ -50,6 +80,14 @@ class ServiceStatus(object):
 
 
 class Service(object):
+    # The order of the fields in the compact payload, append only.
+    ZK_FIELDS = ('name', 'node_name', 'alarmed', 'alarmed_at', 'restarted',
+                 'restarted_at', 'is_necessary', 'status', 'restarted_count')
+    # The keys of the JSON payload which differ from the field names.
+    LEGACY_NAMES = {'restarted_count': 'restarted_account'}
+
+    updated_at = codec.LazyIsoTime('updated_at', '_mtime')
+
     def __init__(self, name, node_name, alarmed=None,
                  alarmed_at=None, restarted=None, restarted_at=None,
                  is_necessary=None, status=None, created_at=None,
@@ -66,22 +104,14 @@ class Service(object):
         self.updated_at = updated_at
         self.restarted_count = restarted_count or 0
 
-    def to_zk_bytes(self):
-        node_dict = {
-            'name': self.name,
-            'node_name': self.node_name,
-            'alarmed': self.alarmed,
-            'alarmed_at': self.alarmed_at,
-            'restarted': self.restarted,
-            'restarted_at': self.restarted_at,
-            'is_necessary': self.is_necessary,
-            'status': self.status,
-            'restarted_account': self.restarted_count
-        }
-        return json.dumps(node_dict).encode('utf8')
+    def to_zk_bytes(self, compact=False):
+        return codec.encode(self, self.ZK_FIELDS, compact, self.LEGACY_NAMES)
 
     def to_dict(self):
-        return self.__dict__
+        service_dict = {k: getattr(self, k) for k in self.ZK_FIELDS}
+        service_dict['created_at'] = self.created_at
+        service_dict['updated_at'] = self.updated_at
+        return service_dict
 
     def update(self, update_dict):
         for k, v in update_dict.items():
@@ -93,12 +123,15 @@ class Service(object):
 
     @classmethod
     def from_zk_bytes(cls, zk_bytes):
-        service_dict = json.loads(zk_bytes[0].decode('utf8'))
-        # mtime is millisecond in zk. Convert to second.
-        mtime = zk_bytes[1].mtime / 1000
-        service_dict['updated_at'] = datetime.datetime.fromtimestamp(
-                mtime, pytz.utc).isoformat()
-        return cls(**service_dict)
+        service_dict = codec.decode(zk_bytes[0], cls.ZK_FIELDS)
+        # The legacy JSON payload names the restart counter this way.
+        if 'restarted_account' in service_dict:
+            service_dict.setdefault('restarted_count',
+                                    service_dict.pop('restarted_account'))
+        service_obj = cls(**service_dict)
+        # mtime is formatted on first access only.
+        service_obj._mtime = zk_bytes[1].mtime
+        return service_obj
 
 
 class NecessaryService(Service):
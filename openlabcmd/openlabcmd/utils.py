@@ -45,6 +45,14 @@ _headers_table_mapping = {
     ]),
     'repo': OrderedDict([
         ("repo", "Repo")
+    ]),
+    'switch': OrderedDict([
+        ("switch_id", "Switch"),
+        ("node", "Node"),
+        ("role", "Role"),
+        ("step", "Step"),
+        ("start", "Start"),
+        ("duration", "Duration")
     ])
 }
 
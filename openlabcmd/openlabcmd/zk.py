@@ -3,13 +3,16 @@ import copy
 import datetime
 import json
 import logging
+import threading
 import time
 
-from kazoo.client import KazooClient, KazooState
+from kazoo.client import KazooState
 from kazoo import exceptions as kze
 from kazoo.handlers.threading import KazooTimeoutError
 import os_client_config
 
+from openlabcmd import backend
+from openlabcmd import cache
 from openlabcmd import constants
 from openlabcmd import exceptions
 from openlabcmd import node
@@ -36,6 +39,32 @@ CONFIGURATION_DICT = {
     'unnecessary_service_switch_timeout_hour': 48,
 }
 
+# The secondary indexes of /ha. The znodes are named
+# /ha-index/<kind>/<value>/<key>, the key is the node name for the 'role' and
+# 'type' kinds and <node>:<role>:<service> for the 'status' kind.
+INDEX_ROOT = '/ha-index'
+# The data of INDEX_ROOT once the indexes are complete. The clients older
+# than the indexes write /ha alone, so the indexes are only read once
+# rebuild_index marked them, after every client is upgraded.
+INDEX_VERSION = b'1'
+INDEX_VALUES = {
+    'role': ['master', 'slave', 'zookeeper'],
+    'type': ['nodepool', 'zuul', 'zookeeper'],
+    'status': service.ServiceStatus().all_status,
+}
+
+# /ha-live/<node> is an ephemeral znode held by the healthchecker of the
+# node, it's gone once the session of the healthchecker is.
+LIVE_ROOT = '/ha-live'
+
+# The locks of the HA deployment, /ha-locks/<name>. Like the indexes, they're
+# kept out of /ha.
+LOCK_ROOT = '/ha-locks'
+
+# The timelines of the last switches, /ha-switch-history/record-<sequence>.
+SWITCH_HISTORY_ROOT = '/ha-switch-history'
+SWITCH_HISTORY_SIZE = 100
+
 
 class ZooKeeper(object):
 
@@ -44,12 +73,16 @@ class ZooKeeper(object):
     # Log zookeeper retry every 10 seconds
     retry_log_rate = 10
 
-    def __init__(self, config=None):
+    def __init__(self, config=None, use_cache=None):
         """
         Zookeeper Client for OpenLab HA management.
 
         :param config: The config object.
         :type: configparser.ConfigParser.
+        :param use_cache: Whether to serve the reads of /ha from an in-memory
+            mirror kept current by watches. It's a good fit for long-running
+            clients. Default to the [ha]zookeeper_cache option.
+        :type: bool.
         """
         self.client = None
         self.config = config
@@ -57,15 +90,80 @@ class ZooKeeper(object):
                                           configparser.ConfigParser):
             raise exceptions.ClientError("config should be a ConfigParser "
                                          "object.")
+        if use_cache is None and self.config:
+            try:
+                use_cache = self.config.getboolean('ha', 'zookeeper_cache',
+                                                   fallback=False)
+            except ValueError:
+                raise exceptions.ClientError("zookeeper_cache should be "
+                                             "boolean-like format.")
+        self.use_cache = bool(use_cache)
+        # Write the nodes and services in the compact format, which the
+        # clients older than it can't read.
+        self.compact_format = False
+        if self.config:
+            try:
+                self.compact_format = self.config.getboolean(
+                    'ha', 'zookeeper_compact_format', fallback=False)
+            except ValueError:
+                raise exceptions.ClientError("zookeeper_compact_format should "
+                                             "be boolean-like format.")
+        self._cache = None
         self._last_retry_log = 0
+        self._connected_event = threading.Event()
+        # (whether INDEX_ROOT exists, whether it's marked with
+        # INDEX_VERSION), None means unknown.
+        self._index_state = None
+        # The (configs, stat) of /ha/configuration, kept by a data watch.
+        self._configuration = None
+        self._configuration_lock = threading.Lock()
+        # The options last reported to the configuration listeners.
+        self._configuration_seen = None
+        self._configuration_listeners = []
+        self._change_listeners = []
+        # The node whose live znode is held by this client, see
+        # register_live.
+        self._live_node = None
+        # The children of LIVE_ROOT, kept by a children watch.
+        self._live_nodes = None
+        self._live_listeners = []
+        # lock name -> the kazoo Lock of this client, see acquire_lock.
+        self._locks = {}
+        self._op_listeners = []
 
     def _connection_listener(self, state):
+        # Kazoo keeps reconnecting in the background after SUSPENDED and
+        # LOST, a new session is created once the old one is expired.
         if state == KazooState.LOST:
             self.log.debug("ZooKeeper connection: LOST")
+            self._connected_event.clear()
+            # The watches are gone with the session.
+            self._index_state = None
+            self._configuration = None
+            self._live_nodes = None
+            # The lock znodes are ephemeral, they're gone too.
+            self._locks = {}
         elif state == KazooState.SUSPENDED:
             self.log.debug("ZooKeeper connection: SUSPENDED")
+            self._connected_event.clear()
         else:
             self.log.debug("ZooKeeper connection: CONNECTED")
+            self._connected_event.set()
+            if self._live_node is not None:
+                # The live znode is gone if the session was lost. The
+                # listener must not block, so it's created in the
+                # background.
+                self.client.handler.spawn(self._restore_live)
+
+    def wait_connected(self, timeout=None):
+        """Wait until the client is connected to ZooKeeper.
+
+        :param timeout: How many seconds to wait at most, None means forever.
+        :return: True if connected, False if timed out or never connected.
+        """
+        if self.client is None:
+            return False
+        return self._connected_event.wait(timeout)
 
     def logConnectionRetryEvent(self):
         now = time.monotonic()
@@ -115,10 +213,21 @@ class ZooKeeper(object):
         if timeout <= 0:
             raise exceptions.ClientError("zookeeper_connect_timeout "
                                          "should be larger than 0.")
+        backend_name = self.config.get('ha', 'backend', fallback='kazoo')
+        if backend_name not in backend.BACKENDS:
+            raise exceptions.ClientError("backend should be one of %s."
+                                         % backend.BACKENDS)
+        try:
+            latency = self.config.getfloat(
+                'ha', 'memory_backend_latency_ms', fallback=0) / 1000
+        except ValueError:
+            raise exceptions.ClientError("memory_backend_latency_ms "
+                                         "should be float-like format.")
 
         if self.client is None:
-            self.client = KazooClient(hosts=hosts, timeout=timeout,
-                                      read_only=read_only)
+            self.client = backend.make_client(backend_name, hosts, timeout,
+                                              read_only=read_only,
+                                              latency=latency)
             self.client.add_listener(self._connection_listener)
             # Manually retry initial connection attempt
             tried_times = 0
@@ -134,8 +243,20 @@ class ZooKeeper(object):
                     raise exceptions.ClientError(
                         "Tried %s times, failed connecting "
                         "zookeeper." % retry_limit)
+            if self.use_cache:
+                self._cache = cache.TreeMirror(self.client, '/ha', 3)
+                self._cache.add_listener(self._mirror_listener)
+                self._cache.start()
 
     def disconnect(self):
+        self._index_state = None
+        self._configuration = None
+        self._live_node = None
+        self._live_nodes = None
+        self._locks = {}
+        if self._cache is not None:
+            self._cache.stop()
+            self._cache = None
         if self.client is not None and self.client.connected:
             self.client.stop()
             self.client.close()
@@ -147,9 +268,337 @@ class ZooKeeper(object):
                 raise exceptions.ClientError(
                     "Should call connect function first to initialise "
                     "zookeeper client")
-            return func(self, *args, **kwargs)
+            start = time.monotonic()
+            try:
+                return func(self, *args, **kwargs)
+            except (kze.ConnectionLoss, kze.SessionExpiredError,
+                    kze.ConnectionClosedError, KazooTimeoutError) as e:
+                raise exceptions.ConnectionLostError(
+                    "Lost the connection to zookeeper: %r" % e)
+            finally:
+                if self._op_listeners:
+                    self._report_op(func.__name__, time.monotonic() - start)
         return wrapper
 
+    def add_op_listener(self, listener):
+        """Call listener(name, seconds) after every call of the client API.
+
+        name is the called method, like list_nodes, and seconds is how long
+        it took, whether it succeeded or not. A method which calls another
+        one reports both of them, and the reads served from the mirror are
+        reported too, so these are not the requests sent to ZooKeeper.
+        """
+        self._op_listeners.append(listener)
+
+    def remove_op_listener(self, listener):
+        if listener in self._op_listeners:
+            self._op_listeners.remove(listener)
+
+    def _report_op(self, name, seconds):
+        for listener in list(self._op_listeners):
+            try:
+                listener(name, seconds)
+            except Exception:
+                self.log.exception("Error in op listener")
+
+    def _mirrored(self, path):
+        return (self._cache is not None and self._cache.ready and
+                self._cache.covers(path))
+
+    def _get_object(self, path, factory):
+        """Read a znode and decode it with factory.
+
+        The znode is served from the mirror if the cache is enabled.
+        """
+        if self._mirrored(path):
+            obj = self._cache.get_object(path, factory)
+            if obj is None:
+                raise kze.NoNodeError(path)
+            return obj
+        return factory(self.client.get(path))
+
+    def _get_object_and_stat(self, path, factory):
+        """Like _get_object, but return the znode stat along the object."""
+        if self._mirrored(path):
+            entry = self._cache.get_object_and_stat(path, factory)
+            if entry is None:
+                raise kze.NoNodeError(path)
+            return entry
+        zk_bytes = self.client.get(path)
+        return factory(zk_bytes), zk_bytes[1]
+
+    def _set_object(self, path, obj, version, factory, index_changes=None):
+        """Write obj to path if the znode is still at version.
+
+        :param index_changes: (old, new) index entry paths to move in the
+            same transaction as the write.
+        :return: the object decoded from the written data and the stat
+            returned by ZooKeeper, without reading the znode again.
+        :raise: ConflictError if another client changed the znode since it
+            was read.
+        """
+        value = obj.to_zk_bytes(self.compact_format)
+        try:
+            if index_changes:
+                stat = self._set_with_index(path, value, version,
+                                            index_changes)
+            else:
+                stat = self.client.set(path, value=value, version=version)
+        except (kze.BadVersionError, exceptions.ConflictError):
+            raise exceptions.ConflictError(
+                "%s was changed by another client, reload and retry."
+                % path)
+        except kze.NoNodeError:
+            raise exceptions.ClientError("%s was deleted by another client."
+                                         % path)
+        self._cache_apply(path, value, stat)
+        return factory((value, stat))
+
+    def _set_with_index(self, path, value, version, index_changes):
+        transaction = self.client.transaction()
+        transaction.set_data(path, value, version=version)
+        for old_index_path, new_index_path in index_changes:
+            transaction.delete(old_index_path)
+            transaction.create(new_index_path)
+        try:
+            return self._commit(transaction)[0]
+        except (kze.NoNodeError, kze.NodeExistsError):
+            if not self.client.exists(path):
+                raise kze.NoNodeError(path)
+        # The index is out of sync with the data. Write the data alone, then
+        # move the index entries one by one.
+        self.log.warning("The index entries of %s are out of sync, "
+                         "repairing them.", path)
+        stat = self.client.set(path, value=value, version=version)
+        for old_index_path, new_index_path in index_changes:
+            try:
+                self.client.delete(old_index_path)
+            except kze.NoNodeError:
+                pass
+            try:
+                self.client.create(new_index_path, makepath=True)
+            except kze.NodeExistsError:
+                pass
+        return stat
+
+    def _get_objects(self, paths, factory):
+        """Read many znodes in one pipelined batch and decode them.
+
+        All the requests are sent before any reply is waited for, so the
+        batch costs about one round trip instead of one per znode. The znodes
+        which are deleted in the meantime are skipped.
+        """
+        return [obj for _, obj, _ in self._get_objects_and_stats(paths,
+                                                                 factory)]
+
+    def _get_objects_and_stats(self, paths, factory):
+        """Like _get_objects, but return (path, object, stat) tuples."""
+        result = []
+        pending = []
+        for path in paths:
+            if self._mirrored(path):
+                entry = self._cache.get_object_and_stat(path, factory)
+                if entry is not None:
+                    result.append((path,) + entry)
+            else:
+                pending.append((path, self.client.get_async(path)))
+        for path, async_result in pending:
+            try:
+                zk_bytes = async_result.get()
+            except kze.NoNodeError:
+                continue
+            result.append((path, factory(zk_bytes), zk_bytes[1]))
+        return result
+
+    def _get_children(self, path):
+        if self._mirrored(path):
+            children = self._cache.get_children(path)
+            if children is None:
+                raise kze.NoNodeError(path)
+            return children
+        return self.client.get_children(path)
+
+    def _get_children_many(self, paths):
+        """Pipelined version of _get_children, see _get_objects.
+
+        :return: a list of (path, children) tuples.
+        """
+        result = []
+        pending = []
+        for path in paths:
+            if self._mirrored(path):
+                children = self._cache.get_children(path)
+                if children is not None:
+                    result.append((path, children))
+            else:
+                pending.append((path, self.client.get_children_async(path)))
+        for path, async_result in pending:
+            try:
+                result.append((path, async_result.get()))
+            except kze.NoNodeError:
+                continue
+        return result
+
+    def _cache_apply(self, path, value, stat):
+        if self._cache is not None:
+            self._cache.apply(path, value, stat)
+
+    def _cache_delete(self, path):
+        if self._cache is not None:
+            self._cache.apply_delete(path)
+
+    def _cache_refresh(self, path):
+        if self._cache is not None:
+            self._cache.refresh(path)
+
+    def _index_watcher(self, event):
+        self._index_state = None
+
+    def _load_index_state(self):
+        """Return the _index_state, it's kept until INDEX_ROOT changes."""
+        while self._index_state is None:
+            if self.client.exists(INDEX_ROOT,
+                                  watch=self._index_watcher) is None:
+                self._index_state = (False, False)
+                break
+            try:
+                data, _ = self.client.get(INDEX_ROOT,
+                                          watch=self._index_watcher)
+            except kze.NoNodeError:
+                continue
+            self._index_state = (True, data == INDEX_VERSION)
+        return self._index_state
+
+    def _index_ready(self):
+        """Whether the secondary indexes exist and are kept by the writes."""
+        return self._load_index_state()[0]
+
+    def _use_index(self):
+        # The mirror filters in memory for free, the index would only add
+        # round trips.
+        return (not self._mirrored('/ha') and
+                self._load_index_state()[1])
+
+    @staticmethod
+    def _index_path(kind, value, key=None):
+        path = '%s/%s/%s' % (INDEX_ROOT, kind, value)
+        return path + '/' + key if key else path
+
+    def _node_index_paths(self, node_obj):
+        return [self._index_path('role', node_obj.role, node_obj.name),
+                self._index_path('type', node_obj.type, node_obj.name)]
+
+    def _service_index_path(self, service_path, status):
+        # service_path is /ha/<node>/<role>/<service>
+        return self._index_path('status', status,
+                                ':'.join(service_path.split('/')[2:]))
+
+    def _index_lookup(self, kind, values):
+        """Return the keys indexed under any of the values of kind."""
+        keys = set()
+        for _, children in self._get_children_many(
+                [self._index_path(kind, value) for value in values]):
+            keys.update(children)
+        return keys
+
+    def _delete_node_index(self, node_name):
+        paths = [self._index_path(kind, value, node_name)
+                 for kind in ('role', 'type') for value in INDEX_VALUES[kind]]
+        status_paths = [self._index_path('status', status)
+                        for status in INDEX_VALUES['status']]
+        for status_path, keys in self._get_children_many(status_paths):
+            paths.extend(status_path + '/' + key for key in keys
+                         if key.split(':')[0] == node_name)
+        pending = [self.client.delete_async(path) for path in paths]
+        for async_result in pending:
+            try:
+                async_result.get()
+            except kze.NoNodeError:
+                pass
+
+    def _index_dir_paths(self):
+        """The paths of INDEX_ROOT and its directories, parents first."""
+        dir_paths = [INDEX_ROOT]
+        for kind, values in sorted(INDEX_VALUES.items()):
+            dir_paths.append('%s/%s' % (INDEX_ROOT, kind))
+            dir_paths.extend(self._index_path(kind, value)
+                             for value in values)
+        return dir_paths
+
+    def _index_paths_of_data(self):
+        """Return the index directories and entries of the data under /ha.
+
+        :return: (the directory paths, parents first, the entry paths).
+        """
+        try:
+            node_names = [name for name in self._get_children('/ha')
+                          if name != 'configuration']
+        except kze.NoNodeError:
+            node_names = []
+        nodes = self._get_objects(['/ha/%s' % name for name in node_names],
+                                  node.Node.from_zk_bytes)
+        role_paths = ['/ha/%s/%s' % (node_obj.name, role) for node_obj in nodes
+                      for role in INDEX_VALUES['role']]
+        service_paths = []
+        for path, service_names in self._get_children_many(role_paths):
+            service_paths.extend(path + '/' + service_name
+                                 for service_name in service_names)
+        services = self._get_objects_and_stats(service_paths,
+                                               service.Service.from_zk_bytes)
+
+        index_paths = []
+        for node_obj in nodes:
+            index_paths.extend(self._node_index_paths(node_obj))
+        for path, service_obj, _ in services:
+            index_paths.append(self._service_index_path(path,
+                                                        service_obj.status))
+        dir_paths = set(self._index_dir_paths())
+        dir_paths.update(path.rsplit('/', 1)[0] for path in index_paths)
+        return sorted(dir_paths), index_paths
+
+    def _ensure_index(self, version=b''):
+        """Create the missing index directories and entries of /ha.
+
+        Nothing is deleted and the existing znodes are skipped, so it's safe
+        to run along the other clients.
+
+        :param version: The data of INDEX_ROOT if it's created.
+        """
+        dir_paths, index_paths = self._index_paths_of_data()
+        for path in dir_paths:
+            try:
+                self.client.create(
+                    path, value=version if path == INDEX_ROOT else b'')
+            except kze.NodeExistsError:
+                pass
+        pending = [self.client.create_async(path) for path in index_paths]
+        for async_result in pending:
+            try:
+                async_result.get()
+            except kze.NodeExistsError:
+                pass
+
+    @_client_check_wrapper
+    def rebuild_index(self):
+        """Rebuild the secondary indexes from the data under /ha.
+
+        The indexes are kept in sync by every write, so this is only needed
+        for the deployments created before the indexes existed, or if the
+        indexes are found out of sync. The indexes are read from then on,
+        run it once every client is upgraded.
+        """
+        dir_paths, index_paths = self._index_paths_of_data()
+        try:
+            self.client.delete(INDEX_ROOT, recursive=True)
+        except kze.NoNodeError:
+            pass
+        transaction = self.client.transaction()
+        for path in dir_paths + index_paths:
+            transaction.create(
+                path, value=INDEX_VERSION if path == INDEX_ROOT else b'')
+        self._commit(transaction)
+        self._index_state = (True, True)
+
     @_client_check_wrapper
     def list_nodes(self, with_zk=True, node_role_filter=None,
                    node_type_filter=None):
@@ -166,42 +615,55 @@ class ZooKeeper(object):
                 raise exceptions.ValidationError("node_type_filter should be "
                                                  "a list or string.")
 
-        path = '/ha'
-        try:
-            nodes_objs = []
-            for exist_node in self.client.get_children(path):
-                if exist_node == 'configuration':
-                    continue
-                if not with_zk and 'zookeeper' in exist_node:
-                    continue
-                node_obj = self.get_node(exist_node)
-                if node_role_filter and node_obj.role not in node_role_filter:
-                    continue
-                if node_type_filter and node_obj.type not in node_type_filter:
-                    continue
-                nodes_objs.append(node_obj)
-        except kze.NoNodeError:
-            return []
+        if (node_role_filter or node_type_filter) and self._use_index():
+            exist_nodes = None
+            if node_role_filter:
+                exist_nodes = self._index_lookup('role', node_role_filter)
+            if node_type_filter:
+                typed_nodes = self._index_lookup('type', node_type_filter)
+                exist_nodes = (typed_nodes if exist_nodes is None else
+                               exist_nodes & typed_nodes)
+            exist_nodes = sorted(exist_nodes)
+        else:
+            try:
+                exist_nodes = self._get_children('/ha')
+            except kze.NoNodeError:
+                return []
+        node_paths = []
+        for exist_node in exist_nodes:
+            if exist_node == 'configuration':
+                continue
+            if not with_zk and 'zookeeper' in exist_node:
+                continue
+            node_paths.append('/ha/%s' % exist_node)
+
+        nodes_objs = []
+        for node_obj in self._get_objects(node_paths,
+                                          node.Node.from_zk_bytes):
+            if node_role_filter and node_obj.role not in node_role_filter:
+                continue
+            if node_type_filter and node_obj.type not in node_type_filter:
+                continue
+            nodes_objs.append(node_obj)
         return sorted(nodes_objs, key=lambda x: x.name)
 
     @_client_check_wrapper
     def get_node(self, node_name):
         try:
-            node_bytes = self.client.get('/ha/%s' % node_name)
-            node_obj = node.Node.from_zk_bytes(node_bytes)
-            return node_obj
+            return self._get_object('/ha/%s' % node_name,
+                                    node.Node.from_zk_bytes)
         except kze.NoNodeError:
             raise exceptions.ClientError('Node %s not found.' % node_name)
 
-    def _init_service(self, node_name, node_type):
+    def _init_service(self, transaction, node_name, node_type):
         path = '/ha/%s' % node_name
         master_service_path = path + '/master'
         slave_service_path = path + '/slave'
         zookeeper_service_path = path + '/zookeeper'
 
-        self.client.create(master_service_path)
-        self.client.create(slave_service_path)
-        self.client.create(zookeeper_service_path)
+        transaction.create(master_service_path)
+        transaction.create(slave_service_path)
+        transaction.create(zookeeper_service_path)
 
         for node_role, all_services in service.service_mapping.items():
             new_service_path = path + '/%s' % node_role
@@ -215,9 +677,34 @@ class ZooKeeper(object):
                                  service.UnnecessaryService)
                 for service_name in service_names:
                     new_service = service_class(service_name, node_name)
-                    self.client.create(
-                        new_service_path + '/%s' % service_name,
-                        value=new_service.to_zk_bytes())
+                    service_path = new_service_path + '/%s' % service_name
+                    transaction.create(service_path,
+                                       value=new_service.to_zk_bytes(
+                                           self.compact_format))
+                    transaction.create(self._service_index_path(
+                        service_path, new_service.status))
+
+    def _commit(self, transaction):
+        """Commit the transaction in one round trip.
+
+        Either all the operations are applied or none of them.
+
+        :return: the results of the operations.
+        :raise: the error of the operation which failed the transaction,
+            ConflictError if it's a version mismatch.
+        """
+        results = transaction.commit()
+        for result in results:
+            if (not isinstance(result, Exception) or
+                    isinstance(result, (kze.RolledBackError,
+                                        kze.RuntimeInconsistency))):
+                continue
+            if isinstance(result, kze.BadVersionError):
+                raise exceptions.ConflictError(
+                    "The HA data was changed by another client, reload and "
+                    "retry.")
+            raise result
+        return results
 
     @_client_check_wrapper
     def create_node(self, name, role, n_type, ip):
@@ -227,23 +714,45 @@ class ZooKeeper(object):
                 raise exceptions.ClientError(
                     "The role and type of the node should be unique.")
 
+        if not existed_nodes:
+            self.client.ensure_path('/ha')
         path = '/ha/%s' % name
         new_node = node.Node(name, role, n_type, ip)
+        if not self._index_ready():
+            # A new cluster has no older client, its indexes are complete
+            # and can be read at once. The ones added to an older cluster
+            # are only read after 'openlab ha cluster reindex'.
+            self._ensure_index(b'' if existed_nodes else INDEX_VERSION)
+            self._index_state = None
+        # The node and all its services are created at once, a half
+        # initialized node can't be left behind.
+        transaction = self.client.transaction()
+        transaction.create(path,
+                           value=new_node.to_zk_bytes(self.compact_format))
+        for index_path in self._node_index_paths(new_node):
+            transaction.create(index_path)
+        self._init_service(transaction, name, n_type)
         try:
-            self.client.create(path,
-                               value=new_node.to_zk_bytes(),
-                               makepath=True)
+            self._commit(transaction)
         except kze.NodeExistsError:
             raise exceptions.ClientError("The node %s is already existed."
                                          % name)
-        self._init_service(name, n_type)
+        self._cache_refresh(path)
         node_obj = self.get_node(name)
         return node_obj
 
+    def _get_node_and_stat(self, node_name):
+        try:
+            return self._get_object_and_stat('/ha/%s' % node_name,
+                                             node.Node.from_zk_bytes)
+        except kze.NoNodeError:
+            raise exceptions.ClientError('Node %s not found.' % node_name)
+
     @_client_check_wrapper
     def update_node(self, node_name, maintain=None, role=None, **kwargs):
         path = '/ha/%s' % node_name
-        node_obj = self.get_node(node_name)
+        node_obj, stat = self._get_node_and_stat(node_name)
+        old_role = node_obj.role
         if maintain is not None:
             if maintain:
                 if node_obj.status == node.NodeStatus.UP:
@@ -269,16 +778,22 @@ class ZooKeeper(object):
                 raise exceptions.ClientError(
                     "switch_status must be 'start', 'end'")
         node_obj.update(kwargs)
-        self.client.set(path, value=node_obj.to_zk_bytes())
-
-        node_obj = self.get_node(node_name)
-        return node_obj
+        index_changes = None
+        if node_obj.role != old_role and self._index_ready():
+            index_changes = [
+                (self._index_path('role', old_role, node_name),
+                 self._index_path('role', node_obj.role, node_name))]
+        return self._set_object(path, node_obj, stat.version,
+                                node.Node.from_zk_bytes, index_changes)
 
     @_client_check_wrapper
     def delete_node(self, node_name):
         self.get_node(node_name)
         path = '/ha/%s' % node_name
         self.client.delete(path, recursive=True)
+        self._cache_delete(path)
+        if self._index_ready():
+            self._delete_node_index(node_name)
 
     @_client_check_wrapper
     def list_services(self, node_name_filter=None, node_role_filter=None,
@@ -312,42 +827,81 @@ class ZooKeeper(object):
                 raise exceptions.ValidationError("status_filter should be "
                                                  "a list or string.")
 
-        result = []
-        for exist_node in self.list_nodes():
-            if node_name_filter and exist_node.name not in node_name_filter:
-                continue
+        if status_filter and self._use_index():
+            return self._list_indexed_services(
+                node_name_filter, node_role_filter, status_filter)
+
+        if node_name_filter:
+            node_paths = ['/ha/%s' % name for name in node_name_filter]
+            exist_nodes = self._get_objects(node_paths,
+                                            node.Node.from_zk_bytes)
+        else:
+            exist_nodes = self.list_nodes()
+
+        role_paths = []
+        for exist_node in exist_nodes:
             if node_role_filter and exist_node.role not in node_role_filter:
                 continue
-            path = '/ha/%s/%s' % (exist_node.name, exist_node.role)
-            for service_name in self.client.get_children(path):
-                service_path = path + '/' + service_name
-                service_bytes = self.client.get(service_path)
-                service_obj = service.Service.from_zk_bytes(service_bytes)
-                if status_filter and service_obj.status not in status_filter:
-                    continue
+            role_paths.append('/ha/%s/%s' % (exist_node.name, exist_node.role))
+
+        service_paths = []
+        for path, service_names in self._get_children_many(role_paths):
+            service_paths.extend(path + '/' + service_name
+                                 for service_name in service_names)
+
+        result = []
+        for service_obj in self._get_objects(service_paths,
+                                             service.Service.from_zk_bytes):
+            if status_filter and service_obj.status not in status_filter:
+                continue
+            result.append(service_obj)
+        return sorted(result, key=lambda x: x.node_name)
+
+    def _list_indexed_services(self, node_name_filter, node_role_filter,
+                               status_filter):
+        entries = [key.split(':') for key in
+                   self._index_lookup('status', status_filter)]
+        if node_name_filter:
+            entries = [e for e in entries if e[0] in node_name_filter]
+        if node_role_filter:
+            entries = [e for e in entries if e[1] in node_role_filter]
+        # Only the services under the current role of their node count.
+        node_paths = sorted(set('/ha/%s' % e[0] for e in entries))
+        node_roles = dict((node_obj.name, node_obj.role) for node_obj in
+                          self._get_objects(node_paths,
+                                            node.Node.from_zk_bytes))
+        service_paths = sorted('/ha/%s/%s/%s' % tuple(e) for e in entries
+                               if node_roles.get(e[0]) == e[1])
+        result = []
+        for service_obj in self._get_objects(service_paths,
+                                             service.Service.from_zk_bytes):
+            # The data is the source of truth, the index may lag behind.
+            if service_obj.status in status_filter:
                 result.append(service_obj)
         return sorted(result, key=lambda x: x.node_name)
 
-    @_client_check_wrapper
-    def get_service(self, service_name, node_name):
+    def _get_service_and_stat(self, service_name, node_name):
         service_node = self.get_node(node_name)
         path = '/ha/%s/%s/%s' % (service_node.name, service_node.role,
                                  service_name)
         try:
-            service_bytes = self.client.get(path)
+            service_obj, stat = self._get_object_and_stat(
+                path, service.Service.from_zk_bytes)
         except kze.NoNodeError:
             raise exceptions.ClientError('Service %s not found.' %
                                          service_name)
-        service_obj = service.Service.from_zk_bytes(service_bytes)
-        return service_obj
+        return service_obj, stat, path
+
+    @_client_check_wrapper
+    def get_service(self, service_name, node_name):
+        return self._get_service_and_stat(service_name, node_name)[0]
 
     @_client_check_wrapper
     def update_service(self, service_name, node_name, alarmed=None,
                        restarted=None, status=None, **kwargs):
-        old_service = self.get_service(service_name, node_name)
-        service_node = self.get_node(node_name)
-        path = '/ha/%s/%s/%s' % (service_node.name, service_node.role,
-                                 service_name)
+        old_service, stat, path = self._get_service_and_stat(service_name,
+                                                             node_name)
+        old_status = old_service.status
         current_time = datetime.datetime.utcnow().isoformat()
 
         if alarmed is not None:
@@ -372,10 +926,13 @@ class ZooKeeper(object):
             old_service.status = status
 
         old_service.update(kwargs)
-        self.client.set(path, value=old_service.to_zk_bytes())
-
-        new_service = self.get_service(service_name, node_name)
-        return new_service
+        index_changes = None
+        if old_service.status != old_status and self._index_ready():
+            index_changes = [
+                (self._service_index_path(path, old_status),
+                 self._service_index_path(path, old_service.status))]
+        return self._set_object(path, old_service, stat.version,
+                                service.Service.from_zk_bytes, index_changes)
 
     @_client_check_wrapper
     def switch_master_and_slave(self):
@@ -384,10 +941,41 @@ class ZooKeeper(object):
         This func is called by labkeeper deploy tool. So that operators can
         switch master-slave role by hand. Once health checker find that all
         nodes' switch status are `start`, it will start to switch cluster.
+
+        All the nodes are marked in one transaction, so that the health
+        checkers never see a half marked cluster. The plan of the switch is
+        replaced in the same transaction, see get_switch_plan.
         """
-        for node in self.list_nodes():
-            if node.type != 'zookeeper':
-                self.update_node(node.name, switch_status='start')
+        try:
+            node_paths = ['/ha/%s' % name for name in self._get_children('/ha')
+                          if name != 'configuration']
+        except kze.NoNodeError:
+            return
+        switch_id = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        transaction = self.client.transaction()
+        updates = []
+        for path, node_obj, stat in self._get_objects_and_stats(
+                node_paths, node.Node.from_zk_bytes):
+            if node_obj.type == 'zookeeper':
+                continue
+            node_obj.switch_status = 'start'
+            node_obj.switch_id = switch_id
+            value = node_obj.to_zk_bytes(self.compact_format)
+            transaction.set_data(path, value, version=stat.version)
+            updates.append((path, value))
+        if not updates:
+            return
+        plan_path = self._lock_path('switch')
+        plan = json.dumps({'id': switch_id, 'coordinator': None,
+                           'forced': True}).encode('utf8')
+        if self.client.exists(plan_path):
+            transaction.set_data(plan_path, plan)
+        else:
+            self.client.ensure_path(LOCK_ROOT)
+            transaction.create(plan_path, plan)
+        results = self._commit(transaction)
+        for (path, value), stat in zip(updates, results):
+            self._cache_apply(path, value, stat)
 
     @_client_check_wrapper
     def check_and_repair_deployment_sg(self, is_dry_run=False):
@@ -588,22 +1176,333 @@ class ZooKeeper(object):
         self.client.create(path,
                            value=json.dumps(CONFIGURATION_DICT).encode('utf8'),
                            makepath=True)
+        self._cache_refresh(path)
 
-    @_client_check_wrapper
-    def list_configuration(self):
+    @staticmethod
+    def _configuration_from_zk_bytes(zk_bytes):
+        return json.loads(zk_bytes[0].decode('utf8'))
+
+    def add_change_listener(self, listener):
+        """Call listener(path, obj) once a node or a service changes.
+
+        obj is the new Node or Service object, None if it's deleted. The
+        changes are seen through the mirror of /ha, so this only works
+        with use_cache. The listener is called from the ZooKeeper event
+        thread, it must not block.
+        """
+        self._change_listeners.append(listener)
+
+    def remove_change_listener(self, listener):
+        if listener in self._change_listeners:
+            self._change_listeners.remove(listener)
+
+    def _mirror_listener(self, path):
+        # /ha/<node> or /ha/<node>/<role>/<service>
+        depth = path.count('/')
+        if path == '/ha/configuration' or depth not in (2, 4):
+            return
+        mirror = self._cache
+        if mirror is None:
+            return
+        factory = (node.Node.from_zk_bytes if depth == 2 else
+                   service.Service.from_zk_bytes)
+        obj = mirror.get_object(path, factory)
+        for listener in list(self._change_listeners):
+            try:
+                listener(path, obj)
+            except Exception:
+                self.log.exception("Error in change listener")
+
+    def add_configuration_listener(self, listener):
+        """Call listener(changed) once options of the HA configuration change.
+
+        changed is a dict of the changed option names to their new values.
+        The listener is called from the ZooKeeper event thread, it must not
+        block.
+        """
+        self._configuration_listeners.append(listener)
+
+    def remove_configuration_listener(self, listener):
+        if listener in self._configuration_listeners:
+            self._configuration_listeners.remove(listener)
+
+    def _configuration_watcher(self, event):
+        if self._configuration is None:
+            # Dropped by disconnect or the session loss in the meantime.
+            return
+        try:
+            self._load_configuration()
+        except kze.KazooException:
+            self._configuration = None
+
+    def _load_configuration(self):
         path = '/ha/configuration'
         try:
-            config_bytes = self.client.get(path)
+            zk_bytes = self.client.get(path,
+                                       watch=self._configuration_watcher)
         except kze.NoNodeError:
-            self._init_ha_configuration()
-            config_bytes = self.client.get(path)
-        return json.loads(config_bytes[0].decode('utf8'))
+            self._configuration = None
+            raise
+        self._keep_configuration(self._configuration_from_zk_bytes(zk_bytes),
+                                 zk_bytes[1])
+
+    def _keep_configuration(self, configs, stat):
+        with self._configuration_lock:
+            old = self._configuration
+            if old is not None and old[1].mzxid >= stat.mzxid:
+                return
+            self._configuration = (configs, stat)
+            seen = self._configuration_seen
+            self._configuration_seen = configs
+        if seen is None:
+            return
+        changed = dict((name, value) for name, value in configs.items()
+                       if name not in seen or seen[name] != value)
+        if not changed:
+            return
+        for listener in list(self._configuration_listeners):
+            try:
+                listener(changed)
+            except Exception:
+                self.log.exception("Error in configuration listener")
+
+    def _get_configuration_and_stat(self):
+        if self._configuration is None:
+            try:
+                self._load_configuration()
+            except kze.NoNodeError:
+                self._init_ha_configuration()
+                self._load_configuration()
+        configs, stat = self._configuration
+        return dict(configs), stat
+
+    @_client_check_wrapper
+    def list_configuration(self):
+        """Return the HA configuration.
+
+        It's read once, then kept current by a data watch.
+        """
+        return self._get_configuration_and_stat()[0]
 
     @_client_check_wrapper
     def update_configuration(self, name, value):
         path = '/ha/configuration'
-        configs = self.list_configuration()
-        if name not in configs.keys():
-            raise exceptions.ClientError('There is not option %s' % name)
-        configs[name] = value
-        self.client.set(path, json.dumps(configs).encode('utf8'))
+        # Only the option is changed, so the write is retried on top of the
+        # changes done by other clients in the meantime.
+        for _ in range(3):
+            configs, stat = self._get_configuration_and_stat()
+            if name not in configs.keys():
+                raise exceptions.ClientError('There is not option %s' % name)
+            configs[name] = value
+            data = json.dumps(configs).encode('utf8')
+            try:
+                stat = self.client.set(path, data, version=stat.version)
+            except kze.BadVersionError:
+                self._configuration = None
+                continue
+            self._cache_apply(path, data, stat)
+            self._keep_configuration(configs, stat)
+            return
+        raise exceptions.ConflictError(
+            "The HA configuration is being changed by other clients, "
+            "retry later.")
+
+    @_client_check_wrapper
+    def register_live(self, node_name):
+        """Hold the live znode of node_name for as long as this client lives.
+
+        The znode is ephemeral, the other nodes see it go away once the
+        session of this client expires. It's created again on the new
+        session after a session loss.
+        """
+        self._live_node = node_name
+        self._create_live(node_name)
+
+    def _create_live(self, node_name):
+        path = '%s/%s' % (LIVE_ROOT, node_name)
+        try:
+            self.client.create(path, ephemeral=True, makepath=True)
+            return
+        except kze.NodeExistsError:
+            pass
+        stat = self.client.exists(path)
+        if stat is not None:
+            if stat.ephemeralOwner == self.client.client_id[0]:
+                return
+            # Left by the previous session of this node, the process
+            # restarted before it expired.
+            try:
+                self.client.delete(path, version=stat.version)
+            except (kze.NoNodeError, kze.BadVersionError):
+                pass
+        self.client.create(path, ephemeral=True, makepath=True)
+
+    def _restore_live(self):
+        node_name = self._live_node
+        if node_name is None:
+            return
+        try:
+            self._create_live(node_name)
+        except kze.KazooException as e:
+            self.log.warning("Failed to restore the live znode of %s: %s",
+                             node_name, e)
+
+    def add_live_listener(self, listener):
+        """Call listener(node_name, alive) once a live znode comes or goes.
+
+        The listener is called from the ZooKeeper event thread, it must not
+        block.
+        """
+        self._live_listeners.append(listener)
+
+    def remove_live_listener(self, listener):
+        if listener in self._live_listeners:
+            self._live_listeners.remove(listener)
+
+    def _live_watcher(self, event):
+        old = self._live_nodes
+        if old is None:
+            # Dropped by disconnect or the session loss in the meantime.
+            return
+        self._live_nodes = None
+        try:
+            new = self._load_live_nodes()
+        except kze.KazooException:
+            return
+        for node_name in sorted(old.symmetric_difference(new)):
+            for listener in list(self._live_listeners):
+                try:
+                    listener(node_name, node_name in new)
+                except Exception:
+                    self.log.exception("Error in live listener")
+
+    def _load_live_nodes(self):
+        try:
+            children = self.client.get_children(LIVE_ROOT,
+                                                watch=self._live_watcher)
+        except kze.NoNodeError:
+            # No healthchecker registered yet, watch for the first one.
+            if self.client.exists(LIVE_ROOT, watch=self._live_watcher):
+                return self._load_live_nodes()
+            children = []
+        self._live_nodes = frozenset(children)
+        return self._live_nodes
+
+    @_client_check_wrapper
+    def list_live_nodes(self):
+        """Return the names of the nodes whose healthchecker is alive.
+
+        They're read once, then kept current by a children watch. The
+        healthcheckers of the older versions don't hold a live znode, they
+        only report the heartbeat of their node.
+        """
+        live_nodes = self._live_nodes
+        if live_nodes is None:
+            live_nodes = self._load_live_nodes()
+        return set(live_nodes)
+
+    @staticmethod
+    def _lock_path(name):
+        return '%s/%s' % (LOCK_ROOT, name)
+
+    @_client_check_wrapper
+    def acquire_lock(self, name, identifier):
+        """Try to take the lock name, without blocking.
+
+        The lock is held until release_lock is called or the session is
+        lost, so the holder can call it again to know it still holds it.
+
+        :param identifier: Shown to the other clients as the lock holder.
+        :return: whether this client holds the lock.
+        """
+        lock = self._locks.get(name)
+        if lock is not None and lock.is_acquired:
+            return True
+        try:
+            if self.client.get_children(self._lock_path(name)):
+                # Held by another client, don't queue up behind it.
+                return False
+        except kze.NoNodeError:
+            pass
+        if lock is None:
+            lock = self.client.Lock(self._lock_path(name), identifier)
+            self._locks[name] = lock
+        try:
+            return lock.acquire(blocking=False)
+        except kze.LockTimeout:
+            return False
+
+    @_client_check_wrapper
+    def release_lock(self, name):
+        lock = self._locks.pop(name, None)
+        if lock is not None:
+            lock.release()
+
+    @_client_check_wrapper
+    def get_switch_plan(self):
+        """Return the plan of the switch in progress, None if there is none.
+
+        The plan is kept in the data of the switch lock znode by the
+        coordinator of the switch, it's a dict of:
+
+        * id: The time the switch was started, it identifies the switch. The
+          nodes assigned to the switch have the same switch_id, a plan with
+          another id is left by an older switch.
+        * coordinator: The name of the node which started the switch, None
+          if it's asked for with switch_master_and_slave.
+        * forced: Whether the switch was asked for rather than caused by a
+          failure.
+        """
+        try:
+            data, _ = self.client.get(self._lock_path('switch'))
+        except kze.NoNodeError:
+            return None
+        if not data:
+            return None
+        return json.loads(data.decode('utf8'))
+
+    @_client_check_wrapper
+    def set_switch_plan(self, plan):
+        """Set the plan of the switch in progress, None to clear it."""
+        data = json.dumps(plan).encode('utf8') if plan else b''
+        path = self._lock_path('switch')
+        try:
+            self.client.set(path, data)
+        except kze.NoNodeError:
+            try:
+                self.client.create(path, data, makepath=True)
+            except kze.NodeExistsError:
+                self.client.set(path, data)
+
+    @_client_check_wrapper
+    def add_switch_record(self, record):
+        """Keep the timeline of the part of a switch done by a node.
+
+        Only the last SWITCH_HISTORY_SIZE records are kept.
+
+        :param record: A dict of switch_id, node, role and spans, the
+            steps of the switch. A span is a dict of step, start and
+            duration.
+        """
+        self.client.create(SWITCH_HISTORY_ROOT + '/record-',
+                           json.dumps(record).encode('utf8'),
+                           sequence=True, makepath=True)
+        children = sorted(self.client.get_children(SWITCH_HISTORY_ROOT))
+        for child in children[:-SWITCH_HISTORY_SIZE]:
+            try:
+                self.client.delete('%s/%s' % (SWITCH_HISTORY_ROOT, child))
+            except kze.NoNodeError:
+                pass
+
+    @_client_check_wrapper
+    def list_switch_records(self, limit=None):
+        """Return the records of the last switches, the oldest first."""
+        try:
+            children = sorted(self.client.get_children(SWITCH_HISTORY_ROOT))
+        except kze.NoNodeError:
+            return []
+        if limit:
+            children = children[-limit:]
+        return self._get_objects(
+            ['%s/%s' % (SWITCH_HISTORY_ROOT, child) for child in children],
+            lambda zk_bytes: json.loads(zk_bytes[0].decode('utf8')))